@@ -6,6 +6,12 @@ import hashlib
 import json
 import os
 import time
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
 # ########## 手动配置项 start #######
@@ -16,8 +22,25 @@ REMOTE_PATH = r"/影视合集/动漫/【九龙珠】（风雷剑传奇、剑勇
 alist_ip_port = "192.168.0.196:5244"
 USERNAME = "xxx"
 PASSWORD = "xxx"
+# 同时列目录的线程数
+LIST_WORKERS = 8
+# 列目录时每页的条目数，大目录按页并发获取
+PER_PAGE = 200
+# 同时下载的文件数
+DOWNLOAD_WORKERS = 4
+# 大文件分段下载的连接数，以及启用分段下载的最小文件大小
+SPLIT_CONNECTIONS = 4
+SPLIT_MIN_SIZE = 64 * 1024 * 1024
+# 下载清单文件名，保存在下载目录中
+MANIFEST_NAME = ".alist_manifest.db"
 # ########## 手动配置项 end #######
 
+CHUNK_SIZE = 1024 * 1024
+# 多连接下载时每个分段写入多少字节保存一次进度
+CHECKPOINT_BYTES = 8 * 1024 * 1024
+# 校验时使用的哈希算法，按顺序选择 alist 返回的第一个
+HASH_ALGORITHMS = ("sha1", "md5", "sha256")
+
 base_url = f"http://{alist_ip_port}"
 url_dic = {
     "loginUrl": f"{base_url}/api/auth/login/hash",
@@ -28,6 +51,220 @@ session = requests.session()
 session.headers = {
     "content-type": "application/json;charset=UTF-8"
 }
+# 多个线程共用一个会话，连接池要容纳所有列目录线程和下载连接
+POOL_SIZE = max(LIST_WORKERS + DOWNLOAD_WORKERS * SPLIT_CONNECTIONS, 10)
+session.mount("http://", HTTPAdapter(pool_maxsize=POOL_SIZE))
+session.mount("https://", HTTPAdapter(pool_maxsize=POOL_SIZE))
+
+
+class AlistError(Exception):
+    """alist 接口返回的业务错误（密码错误、路径不存在等），重试没有意义"""
+
+
+class RangeNotSupported(Exception):
+    """服务器不支持 Range 请求，只能单连接下载"""
+
+
+class TransferProgress:
+    """
+    所有下载共用一个进度条：总大小随发现的文件增加，多个下载线程累加已下载字节数
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.files_done = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self.bar = tqdm(total=0, unit='B', unit_scale=True, unit_divisor=1024, desc="下载", dynamic_ncols=True)
+
+    def add_file(self, size):
+        with self._lock:
+            self.files += 1
+            self.bar.total += size or 0
+            self._refresh()
+
+    def update(self, n):
+        self.bar.update(n)
+
+    def file_done(self, failed=False, unused=0):
+        """一个文件结束，unused 为登记过但没有下载的字节数（跳过或失败的文件）"""
+        with self._lock:
+            self.files_done += 1
+            if failed:
+                self.failed += 1
+            self.bar.total -= unused
+            self._refresh()
+
+    def _refresh(self):
+        postfix = f"文件 {self.files_done}/{self.files}"
+        if self.failed:
+            postfix += f", 失败 {self.failed}"
+        self.bar.set_postfix_str(postfix, refresh=True)
+
+    def write(self, message):
+        tqdm.write(message)
+
+    def close(self):
+        self.bar.close()
+
+
+class FileProgress:
+    """
+    单个文件的进度：转发到总进度条，同时记录这个文件已计入的字节数，校验失败或下载失败时按实际计入的字节数回退
+    """
+
+    def __init__(self, progress):
+        self.progress = progress
+        self.counted = 0
+        self._lock = threading.Lock()
+
+    def update(self, n):
+        with self._lock:
+            self.counted += n
+        self.progress.update(n)
+
+    def rollback(self):
+        with self._lock:
+            n, self.counted = self.counted, 0
+        self.progress.update(-n)
+
+
+# 在文件的指定偏移处写入数据；有 os.pwrite 时多个线程可以同时写同一个文件描述符，
+# 否则（Windows）用锁保证 lseek 和 write 不被打断
+if hasattr(os, "pwrite"):
+    def write_at(fd, data, offset):
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+else:
+    _write_lock = threading.Lock()
+
+    def write_at(fd, data, offset):
+        with _write_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+
+
+class VerificationError(Exception):
+    """下载完成的文件大小或哈希与 alist 返回的不一致"""
+
+
+class DownloadManifest:
+    """
+    下载清单（SQLite）：记录已完成文件的大小和哈希，启动时全部读入内存，
+    重新运行时与 alist 返回的大小、哈希比较即可跳过已完成的文件，不需要逐个 stat 本地文件。
+    同时记录多连接下载中各分段已写入的位置，中断后从记录的位置继续
+    """
+
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS files (remote_path TEXT PRIMARY KEY, local_path TEXT NOT NULL, "
+                "size INTEGER, hash TEXT, completed_at REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS parts (remote_path TEXT NOT NULL, size INTEGER NOT NULL, "
+                "start INTEGER NOT NULL, end INTEGER NOT NULL, offset INTEGER NOT NULL, PRIMARY KEY (remote_path, start))"
+            )
+        self.completed = {row[0]: (row[1], row[2]) for row in
+                          self.conn.execute("SELECT remote_path, size, hash FROM files")}
+
+    def get(self, remote_path):
+        return self.completed.get(remote_path)
+
+    def is_done(self, remote_path, size=None, file_hash=None):
+        """已完成，且记录的大小、哈希与 alist 当前返回的一致（任一方未知时不比较）"""
+        record = self.completed.get(remote_path)
+        if record is None:
+            return False
+        done_size, done_hash = record
+        if size and done_size and size != done_size:
+            return False
+        if file_hash and done_hash and file_hash != done_hash:
+            return False
+        return True
+
+    def mark_done(self, remote_path, local_path, size=None, file_hash=None):
+        with self._lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO files (remote_path, local_path, size, hash, completed_at) VALUES (?, ?, ?, ?, ?)",
+                    (remote_path, local_path, size, file_hash, time.time())
+                )
+                self.conn.execute("DELETE FROM parts WHERE remote_path = ?", (remote_path,))
+            self.completed[remote_path] = (size, file_hash)
+
+    def load_parts(self, remote_path, size):
+        """返回 {起点: (终点, 已写到的位置)}，文件大小变化后旧的记录作废"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT size, start, end, offset FROM parts WHERE remote_path = ?", (remote_path,)
+            ).fetchall()
+        if any(row[0] != size for row in rows):
+            self.clear_parts(remote_path)
+            return {}
+        return {start: (end, offset) for _, start, end, offset in rows}
+
+    def save_part(self, remote_path, size, start, end, offset):
+        with self._lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO parts (remote_path, size, start, end, offset) VALUES (?, ?, ?, ?, ?)",
+                    (remote_path, size, start, end, offset)
+                )
+
+    def clear_parts(self, remote_path):
+        with self._lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM parts WHERE remote_path = ?", (remote_path,))
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+# alist 列表返回的哈希（hash_info 字典或 hashinfo JSON 字符串），返回 "算法:十六进制值"，没有可用的哈希时返回 None
+def expected_hash(item):
+    info = item.get("hash_info") or item.get("hashinfo")
+    if isinstance(info, str):
+        try:
+            info = json.loads(info)
+        except ValueError:
+            return None
+    if not isinstance(info, dict):
+        return None
+    for algorithm in HASH_ALGORITHMS:
+        if info.get(algorithm):
+            return f"{algorithm}:{info[algorithm].lower()}"
+    return None
+
+
+# 校验下载的文件：大小与 alist 返回的一致，有哈希时计算哈希比较
+def verify_file(path, size=None, file_hash=None):
+    actual_size = os.path.getsize(path)
+    if size and actual_size != size:
+        raise VerificationError(f"大小不一致: {actual_size}/{size}")
+    if file_hash:
+        algorithm, expected = file_hash.split(":", 1)
+        digest = hashlib.new(algorithm)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+        if digest.hexdigest() != expected:
+            raise VerificationError(f"{algorithm} 不一致: {digest.hexdigest()}/{expected}")
+
+
+# 删除 .part 文件和清单中的分段记录，下次从头下载
+def discard_part(part_path, remote_file_path, manifest=None):
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    if manifest is not None:
+        manifest.clear_parts(remote_file_path)
 
 
 def get_sha256_hash(input_string: str) -> str:
@@ -61,9 +298,13 @@ def list_files(path: str):
     pass
 
 
-# 递归下载文件的函数
-def download_files(path, password="", page=1, per_page=0, refresh=False):
-    # 构建请求数据
+# 远程路径对应的本地路径
+def local_path(remote_path):
+    return os.path.join(DOWNLOAD_PATH, *remote_path.lstrip("/").split("/"))
+
+
+# 获取目录的一页内容，返回 (条目列表, 总条目数)；网络错误按指数退避重试，接口错误直接抛出
+def list_dir_page(path, page=1, per_page=PER_PAGE, password="", refresh=False, retry=3):
     data = {
         "path": path,
         "password": password,
@@ -71,68 +312,329 @@ def download_files(path, password="", page=1, per_page=0, refresh=False):
         "per_page": per_page,
         "refresh": refresh
     }
-
-    # 发送请求获取目录内容
-    response = session.post(url_dic['listFile'], json=data)
-    if response.status_code != 200:
-        print(f"请求失败: {response.status_code}")
-        return
-
-    result = response.json()
+    for attempt in range(retry + 1):
+        try:
+            response = session.post(url_dic['listFile'], json=data, timeout=60)
+            response.raise_for_status()
+            result = response.json()
+            break
+        except (requests.RequestException, ValueError) as e:
+            if attempt == retry:
+                raise
+            print(f"列目录失败，{2 ** attempt} 秒后重试: {path} 第 {page} 页: {e}")
+            time.sleep(2 ** attempt)
 
     # 如果返回的代码不是200，说明请求失败
     if result.get("code") != 200:
-        print(f"API 错误: {result.get('message')}")
-        return
+        raise AlistError(f"API 错误: {result.get('message')}")
+    content = result["data"]["content"] or []
+    return content, result["data"].get("total") or len(content)
 
-    # 获取文件夹内容
-    content = result["data"]["content"]
-    if content is None:
-        return
 
-    for item in content:
-        item_name = item["name"]
-        item_path = path + "/" + item_name # 当前项的路径
-        path_part = [DOWNLOAD_PATH] + path.lstrip("/").split("/") + [item_name]
-        local_item_path = os.path.join(*path_part)  # 本地保存路径
+class DirectoryCrawler:
+    """
+    并发遍历远程目录：每个目录的每一页是线程池中的一个任务，第一页返回总条目数后其余页并发获取。
+    发现的文件立即放入 file_queue，下载不用等整个目录树列完；遍历结束后放入 None 作为结束标记
+    """
 
-        if item["is_dir"]:  # 如果是目录，递归调用
-            os.makedirs(local_item_path, exist_ok=True)  # 创建本地目录
-            download_files(item_path, password, page, per_page, refresh)  # 递归处理子目录
-        else:  # 如果是文件，下载文件
-            download_file(item_path, local_item_path, item['sign'])
+    def __init__(self, file_queue, workers=LIST_WORKERS, per_page=PER_PAGE, password="", refresh=False):
+        self.file_queue = file_queue
+        self.per_page = per_page
+        self.password = password
+        self.refresh = refresh
+        self.dirs = 0
+        self.files = 0
+        self.errors = 0
+        self._pending = 0
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="alist-list")
 
+    def start(self, root):
+        self._submit(root, 1)
 
-# 下载单个文件
-def download_file(remote_file_path, download_item_path, sign, retry=3):
-    if retry == 0:  # 如果重试次数用完
-        return
-    print(remote_file_path, download_item_path, sign)
-    if os.path.exists(download_item_path):
-        print(f"{download_item_path} 已存在，跳过下载")
-        return
+    def _submit(self, path, page):
+        # 先计数再提交，保证子任务提交前计数不会降到 0
+        with self._lock:
+            self._pending += 1
+        self._executor.submit(self._list, path, page)
+
+    def _list(self, path, page):
+        try:
+            if self._stopped:
+                return
+            content, total = list_dir_page(path, page, self.per_page, self.password, self.refresh)
+            if page == 1:
+                with self._lock:
+                    self.dirs += 1
+                if self.per_page and total > self.per_page:
+                    for next_page in range(2, (total + self.per_page - 1) // self.per_page + 1):
+                        self._submit(path, next_page)
+            for item in content:
+                item_path = path.rstrip("/") + "/" + item["name"]  # 当前项的路径
+                if item["is_dir"]:
+                    os.makedirs(local_path(item_path), exist_ok=True)  # 创建本地目录
+                    self._submit(item_path, 1)
+                else:
+                    with self._lock:
+                        self.files += 1
+                    self.file_queue.put((item_path, item))
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            print(f"列目录失败: {path} 第 {page} 页: {e}")
+        finally:
+            with self._lock:
+                self._pending -= 1
+                finished = self._pending == 0
+            if finished:
+                self.file_queue.put(None)
+                self._finished.set()
+
+    def stop(self):
+        """停止遍历，未开始的列目录任务直接丢弃"""
+        self._stopped = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def join(self):
+        self._finished.wait()
+        self._executor.shutdown()
+
+
+# 遍历远程目录并下载其中的文件：目录并发列出，文件边发现边下载，同时下载 workers 个文件
+# 已完成的文件记录在 manifest_path（默认为下载目录中的 .alist_manifest.db），重新运行时直接跳过
+def download_files(path, password="", per_page=PER_PAGE, refresh=False, workers=LIST_WORKERS,
+                   download_workers=DOWNLOAD_WORKERS, manifest_path=None):
+    os.makedirs(DOWNLOAD_PATH, exist_ok=True)
+    manifest = DownloadManifest(manifest_path or os.path.join(DOWNLOAD_PATH, MANIFEST_NAME))
+    file_queue = queue.Queue()
+    crawler = DirectoryCrawler(file_queue, workers, per_page, password, refresh)
+    progress = TransferProgress()
+    # 已提交但未完成的下载数有上限，其余文件留在队列中
+    slots = threading.BoundedSemaphore(download_workers * 2)
+    pool = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="alist-download")
 
-    # 发送GET请求下载文件
-    file_url = f"{url_dic['downFile']}{remote_file_path}?sign={sign}"
-    file_response = session.get(file_url, stream=True)
-    if file_response.status_code == 200:
-        total_size = int(file_response.headers.get('content-length', 0))  # 获取文件总大小
-        # 确保本地目录存在
-        os.makedirs(os.path.dirname(download_item_path), exist_ok=True)
-        with open(download_item_path, "wb") as f, tqdm(
-            total=total_size, unit=' B', unit_scale=True, desc=download_item_path
-        ) as bar:
-            for chunk in file_response.iter_content(chunk_size=4096):
+    def run(item_path, item):
+        try:
+            download_file(item_path, local_path(item_path), item.get("sign", ""), size=item.get("size"),
+                          progress=progress, file_hash=expected_hash(item), manifest=manifest)
+        except Exception as e:
+            progress.write(f"文件下载失败: {item_path}: {e}")
+            # 已下载的字节由 download_file 回退，这里把文件大小从总大小中去掉
+            progress.file_done(failed=True, unused=item.get("size") or 0)
+        finally:
+            slots.release()
+
+    crawler.start(path)
+    try:
+        while True:
+            entry = file_queue.get()
+            if entry is None:
+                break
+            item_path, item = entry
+            slots.acquire()
+            progress.add_file(item.get("size"))
+            pool.submit(run, item_path, item)
+    except BaseException:
+        crawler.stop()
+        pool.shutdown(wait=False, cancel_futures=True)
+        progress.close()
+        manifest.close()
+        raise
+    crawler.join()
+    pool.shutdown()
+    progress.close()
+    manifest.close()
+    print(f"共 {crawler.dirs} 个目录，{crawler.files} 个文件" + (f"，{progress.failed} 个下载失败" if progress.failed else "")
+          + (f"，{crawler.errors} 页列目录失败" if crawler.errors else ""))
+
+
+# 下载文件的字节范围 [start, end] 并写入 fd 的对应位置，从 offset（默认为 start）开始请求，中断时从已写入的位置继续；
+# checkpoint(start, offset) 每写入 CHECKPOINT_BYTES 调用一次，用于保存进度
+def download_range(file_url, fd, start, end, progress=None, retry=3, offset=None, checkpoint=None):
+    offset = start if offset is None else offset
+    saved = offset
+    for attempt in range(retry + 1):
+        if offset > end:
+            break
+        try:
+            headers = {"Range": f"bytes={offset}-{end}"}
+            with session.get(file_url, headers=headers, stream=True, timeout=60) as response:
+                if response.status_code == 200:
+                    raise RangeNotSupported(f"服务器忽略了 Range 请求: {file_url}")
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    write_at(fd, chunk, offset)
+                    offset += len(chunk)
+                    if progress is not None:
+                        progress.update(len(chunk))
+                    if checkpoint is not None and offset - saved >= CHECKPOINT_BYTES:
+                        checkpoint(start, offset)
+                        saved = offset
+            if offset != end + 1:
+                raise IOError(f"分段不完整: {offset - start}/{end + 1 - start}")
+            break
+        except (requests.RequestException, IOError) as e:
+            if checkpoint is not None and offset != saved:
+                checkpoint(start, offset)
+                saved = offset
+            if attempt == retry:
+                raise
+            time.sleep(2 ** attempt)
+    if checkpoint is not None and offset != saved:
+        checkpoint(start, offset)
+    return offset
+
+
+# 多连接下载到 part_path：文件按连接数切成几段，预分配大小后各连接分别请求自己的范围写入同一个文件；
+# 各段写到的位置记录在清单中，中断后从记录的位置继续
+def download_file_ranges(file_url, part_path, size, connections, progress=None, manifest=None, remote_file_path=None):
+    saved = {}
+    if manifest is not None and os.path.exists(part_path):
+        saved = manifest.load_parts(remote_file_path, size)
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        # 预分配空间，减少并发写入造成的文件碎片
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.ftruncate(fd, size)
+        if saved:
+            ranges = [(start, end, offset) for start, (end, offset) in sorted(saved.items())]
+        else:
+            part_size = -(-size // connections)
+            ranges = [(start, min(start + part_size, size) - 1, start) for start in range(0, size, part_size)]
+        checkpoint = None
+        if manifest is not None:
+            ends = {start: end for start, end, _ in ranges}
+            for start, end, offset in ranges:
+                manifest.save_part(remote_file_path, size, start, end, offset)
+
+            def checkpoint(start, offset):
+                manifest.save_part(remote_file_path, size, start, ends[start], offset)
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            futures = [pool.submit(download_range, file_url, fd, start, end, progress, offset=offset,
+                                   checkpoint=checkpoint)
+                       for start, end, offset in ranges]
+            for future in futures:
+                future.result()
+    finally:
+        os.close(fd)
+
+
+# 单连接下载到 part_path，已有部分内容时用 Range 从当前大小继续；收到的字节数与 content-length 不一致时抛出 IOError
+def download_stream(file_url, part_path, progress=None):
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with session.get(file_url, headers=headers, stream=True, timeout=60) as response:
+        if offset and response.status_code == 416:
+            # 请求的起点已到文件末尾，说明上次已经下载完，交给校验判断
+            return
+        response.raise_for_status()
+        if offset and response.status_code != 206:
+            # 服务器不支持 Range，从头下载
+            if progress is not None:
+                progress.update(-offset)
+            offset = 0
+        expected = response.headers.get("content-length")
+        # 压缩传输时 content-length 是压缩后的长度，不能用来校验
+        if response.headers.get("content-encoding") not in (None, "identity"):
+            expected = None
+        received = 0
+        with open(part_path, "ab" if offset else "wb") as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
                 if chunk:
                     f.write(chunk)
-                    bar.update(len(chunk))  # 更新进度条
-        print(f"已下载: {download_item_path}")
-    else:
-        print(f"文件下载失败: {file_url}, 状态码: {file_response.status_code}")
-        time.sleep(60)
-        # 再次尝试下载
-        retry -= 1
-        download_file(remote_file_path, download_item_path, sign, retry)
+                    received += len(chunk)
+                    if progress is not None:
+                        progress.update(len(chunk))  # 更新进度条
+    if expected is not None and received != int(expected):
+        raise IOError(f"下载不完整: {received}/{expected}")
+
+
+# 下载单个文件：先写入 .part 文件，中断后从已下载的位置继续，校验大小和哈希后再改名。
+# size 和 file_hash 为 alist 列表返回的大小和哈希，size 超过 SPLIT_MIN_SIZE 时多连接下载；
+# 清单中记录为已完成且大小、哈希一致的文件直接跳过，不检查本地文件
+def download_file(remote_file_path, download_item_path, sign, retry=3, size=None, progress=None,
+                  connections=SPLIT_CONNECTIONS, file_hash=None, manifest=None):
+    log = progress.write if progress is not None else print
+    if manifest is not None and manifest.is_done(remote_file_path, size, file_hash):
+        if progress is not None:
+            progress.file_done(unused=size or 0)
+        return
+    # 清单中没有记录的已有文件（例如清单建立之前下载的），大小与 alist 一致时视为已完成，不重新计算哈希
+    if (manifest is None or manifest.get(remote_file_path) is None) and os.path.exists(download_item_path) \
+            and (not size or os.path.getsize(download_item_path) == size):
+        log(f"{download_item_path} 已存在，跳过下载")
+        if manifest is not None:
+            manifest.mark_done(remote_file_path, download_item_path, size, file_hash)
+        if progress is not None:
+            progress.file_done(unused=size or 0)
+        return
+
+    file_url = f"{url_dic['downFile']}{quote(remote_file_path)}?sign={sign}"
+    part_path = download_item_path + ".part"
+    # 确保本地目录存在
+    os.makedirs(os.path.dirname(download_item_path), exist_ok=True)
+    split = bool(size and size >= SPLIT_MIN_SIZE and connections > 1)
+    # 多连接下载时 .part 是预分配的，文件大小不代表已下载的字节数，回退进度时按实际计入的字节数
+    file_progress = FileProgress(progress) if progress is not None else None
+
+    # 上次中断时已经下载的部分计入进度
+    if file_progress is not None and os.path.exists(part_path):
+        if split and manifest is not None:
+            file_progress.update(sum(offset - start for start, (_, offset) in
+                                     manifest.load_parts(remote_file_path, size).items()))
+        elif not split:
+            file_progress.update(os.path.getsize(part_path))
+
+    try:
+        for attempt in range(retry + 1):
+            try:
+                if split:
+                    try:
+                        download_file_ranges(file_url, part_path, size, connections, file_progress, manifest,
+                                             remote_file_path)
+                    except RangeNotSupported as e:
+                        # 不支持 Range 时退回单连接从头下载
+                        log(str(e))
+                        split = False
+                        if file_progress is not None:
+                            file_progress.rollback()
+                        discard_part(part_path, remote_file_path, manifest)
+                        download_stream(file_url, part_path, file_progress)
+                else:
+                    download_stream(file_url, part_path, file_progress)
+                verify_file(part_path, size, file_hash)
+                break
+            except VerificationError as e:
+                # 内容已经损坏，不能续传，删除后从头下载
+                if file_progress is not None:
+                    file_progress.rollback()
+                discard_part(part_path, remote_file_path, manifest)
+                if attempt == retry:
+                    raise
+                log(f"文件校验失败，重新下载: {download_item_path}: {e}")
+            except (requests.RequestException, IOError) as e:
+                if attempt == retry:
+                    raise
+                log(f"文件下载失败，{2 ** attempt} 秒后继续: {download_item_path}: {e}")
+                # 指数退避：1s, 2s, 4s ...
+                time.sleep(2 ** attempt)
+    except BaseException:
+        # 失败的文件不计入已下载的字节，.part 保留，下次运行继续
+        if file_progress is not None:
+            file_progress.rollback()
+        raise
+
+    os.replace(part_path, download_item_path)
+    if manifest is not None:
+        manifest.mark_done(remote_file_path, download_item_path, size, file_hash)
+    log(f"已下载: {download_item_path}")
+    if progress is not None:
+        progress.file_done()
 
 
 if __name__ == '__main__':
@@ -2,16 +2,466 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import math
 import time
 import argparse
 import sqlite3
+import hashlib
+import threading
+import queue
+import heapq
+import zlib
+import json
+import shutil
+import signal
+import fnmatch
+import re
+import logging
+import multiprocessing
 import requests
 from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import FileSystemEventHandler, FileCreatedEvent, FileDeletedEvent, DirDeletedEvent
+
+logger = logging.getLogger('strm_monitor')
+
+# 视频文件扩展名
+VIDEO_EXTENSIONS = frozenset([
+    '.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.m4v', '.3gp',
+    '.ts', '.m2ts', '.vob', '.mpg', '.mpeg', '.mp2', '.webm', '.asf',
+    '.rm', '.rmvb', '.ogv', '.divx', '.xvid', '.mxf', '.f4v'
+])
+
+def strm_content_matches(strm_path, data):
+    """
+    判断STRM文件内容是否与data相同：先比较大小，大小一致才读取内容
+
+    Args:
+        strm_path: STRM文件路径
+        data: 期望内容（bytes）
+    """
+    try:
+        if os.stat(strm_path).st_size != len(data):
+            return False
+        with open(strm_path, 'rb') as f:
+            return f.read() == data
+    except OSError:
+        return False
+
+def write_strm_atomic(strm_path, content):
+    """
+    写入STRM文件，内容未变化时不写
+
+    先写同目录下的临时文件再os.replace，Emby不会读到写了一半的STRM；
+    目录不存在时才创建，已存在的目录不会重复调用makedirs。
+
+    Args:
+        strm_path: STRM文件路径
+        content: STRM内容
+
+    Returns:
+        str: created 新建 / updated 内容有变化已重写 / unchanged 内容相同未写入
+    """
+    data = content.encode('utf-8')
+    existed = os.path.lexists(strm_path)
+    if existed and strm_content_matches(strm_path, data):
+        return 'unchanged'
+
+    strm_dir = os.path.dirname(strm_path)
+    # 以点开头、.tmp结尾的临时文件名，Emby扫描时会忽略
+    tmp_path = os.path.join(strm_dir, f".{os.path.basename(strm_path)}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        f = open(tmp_path, 'wb')
+    except FileNotFoundError:
+        os.makedirs(strm_dir, exist_ok=True)
+        f = open(tmp_path, 'wb')
+    try:
+        with f:
+            f.write(data)
+        os.replace(tmp_path, strm_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return 'updated' if existed else 'created'
+
+# 默认随STRM一起复制的附属文件（字幕、元数据、图片）
+SIDECAR_EXTENSIONS = frozenset(['.srt', '.ass', '.ssa', '.sub', '.nfo', '.jpg', '.png'])
+
+class MediaRules:
+    """
+    编译后的媒体文件规则
+
+    扩展名用frozenset查找，include/exclude模式合并成一个正则，每个路径只匹配一次。
+    模式默认按glob解释，以 re: 开头的按正则解释，匹配对象是相对映射源目录的路径（分隔符统一为/）。
+    """
+
+    VIDEO = 'video'
+    SIDECAR = 'sidecar'
+
+    def __init__(self, extensions=VIDEO_EXTENSIONS, include=(), exclude=(), min_size=0, sidecars=()):
+        """
+        Args:
+            extensions: 生成STRM的视频扩展名
+            include: 只处理匹配这些模式的文件，为空时不限制
+            exclude: 跳过匹配这些模式的文件
+            min_size: 视频文件最小大小（字节），用于跳过sample等小文件
+            sidecars: 需要复制到STRM旁边的附属文件扩展名
+        """
+        self.extensions = self._normalize_extensions(extensions)
+        self.sidecars = self._normalize_extensions(sidecars) - self.extensions
+        self.min_size = int(min_size or 0)
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self._include = self._compile(self.include)
+        self._exclude = self._compile(self.exclude)
+
+    @staticmethod
+    def _normalize_extensions(extensions):
+        return frozenset(e.lower() if e.startswith('.') else '.' + e.lower() for e in extensions)
+
+    @staticmethod
+    def _compile(patterns):
+        """把glob/正则模式合并成一个正则，没有模式时返回None"""
+        parts = []
+        for pattern in patterns:
+            if pattern.startswith('re:'):
+                parts.append(f"(?:{pattern[3:]})\\Z")
+            else:
+                parts.append(fnmatch.translate(pattern))
+        return re.compile('|'.join(parts), re.IGNORECASE) if parts else None
+
+    @classmethod
+    def from_dict(cls, config, base=None):
+        """
+        从配置字典创建规则，未配置的项沿用base
+
+        Args:
+            config: 包含 extensions / include / exclude / min_size / sidecars 的字典
+            base: 作为默认值的MediaRules
+        """
+        base = base or DEFAULT_RULES
+        return cls(
+            extensions=config.get('extensions', base.extensions),
+            include=config.get('include', base.include),
+            exclude=config.get('exclude', base.exclude),
+            min_size=config.get('min_size', base.min_size),
+            sidecars=config.get('sidecars', base.sidecars),
+        )
+
+    def match(self, rel_path, size=None):
+        """
+        判断文件类型
+
+        Args:
+            rel_path: 相对映射源目录的路径
+            size: 文件大小，为None时不检查最小大小（例如文件刚创建还没写完时）
+
+        Returns:
+            str: MediaRules.VIDEO / MediaRules.SIDECAR，不需要处理时返回None
+        """
+        dot = rel_path.rfind('.')
+        if dot < 0 or rel_path.find(os.sep, dot) >= 0:
+            return None
+        ext = rel_path[dot:].lower()
+        if ext in self.extensions:
+            kind = self.VIDEO
+        elif ext in self.sidecars:
+            kind = self.SIDECAR
+        else:
+            return None
+
+        if self._include is not None or self._exclude is not None:
+            if os.sep != '/':
+                rel_path = rel_path.replace(os.sep, '/')
+            if self._exclude is not None and self._exclude.match(rel_path):
+                return None
+            if self._include is not None and not self._include.match(rel_path):
+                return None
+
+        if kind == self.VIDEO and size is not None and size < self.min_size:
+            return None
+        return kind
+
+DEFAULT_RULES = MediaRules()
+
+def load_config_file(path):
+    """
+    读取配置文件，.yaml/.yml使用PyYAML，其余按JSON解析
+
+    Args:
+        path: 配置文件路径
+
+    Returns:
+        dict: 配置内容
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.lower().endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise SystemExit("读取YAML配置需要安装PyYAML: pip install pyyaml")
+            return yaml.safe_load(f) or {}
+        return json.load(f)
+
+def load_media_rules(path):
+    """
+    读取规则配置
+
+    格式:
+        {
+            "default": {"exclude": ["*/sample/*"], "min_size": 10485760, "sidecars": [".srt", ".ass", ".nfo", ".jpg"]},
+            "mappings": {"/mnt/cloud/tv": {"min_size": 0}}
+        }
+
+    Args:
+        path: 规则配置文件路径
+
+    Returns:
+        tuple: (默认规则, {源目录: 规则})
+    """
+    config = load_config_file(path)
+    default = MediaRules.from_dict(config.get('default') or {})
+    per_mapping = {
+        os.path.abspath(source_dir): MediaRules.from_dict(rule or {}, default)
+        for source_dir, rule in (config.get('mappings') or {}).items()
+    }
+    return default, per_mapping
+
+class Metrics:
+    """
+    进程内指标注册表，按Prometheus文本格式导出
+
+    counter/gauge按(名称, 标签)累加或设置，histogram使用固定的桶，
+    gauge_callback注册在导出时才求值的指标（如队列深度），避免在热路径上维护。
+    """
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (类型, 说明, 桶)
+        self._meta = {}
+        # (name, labels) -> 值；histogram为 [各桶计数, 总和, 次数]
+        self._values = {}
+        # (name, labels) -> 求值函数
+        self._callbacks = {}
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def describe(self, name, kind, help_text, buckets=None):
+        """
+        声明指标
+
+        Args:
+            name: 指标名
+            kind: counter / gauge / histogram
+            help_text: 说明
+            buckets: histogram的桶上限，默认DEFAULT_BUCKETS
+        """
+        self._meta[name] = (kind, help_text, tuple(buckets or self.DEFAULT_BUCKETS))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, self._labels(labels))
+        buckets = self._meta[name][2]
+        with self._lock:
+            hist = self._values.get(key)
+            if hist is None:
+                hist = self._values[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def gauge_callback(self, name, func, **labels):
+        """注册导出时求值的gauge，同名同标签的后注册者覆盖先注册者"""
+        with self._lock:
+            self._callbacks[(name, self._labels(labels))] = func
+
+    def value(self, name, **labels):
+        """读取counter/gauge当前值，不存在时返回0"""
+        with self._lock:
+            return self._values.get((name, self._labels(labels)), 0)
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        labels = labels + tuple(extra)
+        if not labels:
+            return ''
+        escaped = (
+            (k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels
+        )
+        return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+    def render(self):
+        """
+        导出全部指标
+
+        Returns:
+            str: Prometheus文本格式
+        """
+        with self._lock:
+            values = {key: (list(v[0]), v[1], v[2]) if isinstance(v, list) else v for key, v in self._values.items()}
+            callbacks = list(self._callbacks.items())
+        for key, func in callbacks:
+            try:
+                values[key] = func()
+            except Exception:
+                continue
+
+        lines = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            series = sorted((labels, v) for (n, labels), v in values.items() if n == name)
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, v in series:
+                if kind != 'histogram':
+                    lines.append(f"{name}{self._format_labels(labels)} {v}")
+                    continue
+                counts, total, count = v
+                for bound, n in zip(buckets, counts):
+                    lines.append(f"{name}_bucket{self._format_labels(labels, [('le', str(bound))])} {n}")
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {total}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
+METRICS.describe('strm_events_received_total', 'counter', '收到的文件系统事件数（含同一路径的重复事件）')
+METRICS.describe('strm_events_processed_total', 'counter', '已处理的事件数')
+METRICS.describe('strm_events_dropped_total', 'counter', '处理前文件已消失或停止时丢弃的事件数')
+METRICS.describe('strm_event_queue_depth', 'gauge', '等待和处理中的事件数')
+METRICS.describe('strm_event_queue_lag_seconds', 'gauge', '最老的等待事件已滞留的秒数')
+METRICS.describe('strm_event_lag_seconds', 'histogram', '事件从入队到开始处理的延迟')
+METRICS.describe('strm_files_written_total', 'counter', 'STRM文件写入结果')
+METRICS.describe('strm_sidecars_copied_total', 'counter', '复制的附属文件数')
+METRICS.describe('strm_sqlite_commit_seconds', 'histogram', 'SQLite批量提交耗时')
+METRICS.describe('strm_sqlite_rows_committed_total', 'counter', 'SQLite批量提交的行数')
+METRICS.describe('strm_scan_dirs_listed_total', 'counter', '扫描时实际列出的目录数')
+METRICS.describe('strm_scan_dirs_unchanged_total', 'counter', '扫描时因快照未变化而跳过列目录的目录数')
+METRICS.describe('strm_scan_files_seen_total', 'counter', '扫描时列出的文件数')
+METRICS.describe('strm_scan_pending_dirs', 'gauge', '扫描中等待列出的目录数')
+METRICS.describe('strm_scan_duration_seconds', 'gauge', '最近一次扫描的耗时')
+METRICS.describe('strm_poll_listings_total', 'counter', '轮询模式列目录次数')
+METRICS.describe('strm_poll_checks_total', 'counter', '轮询模式检查目录mtime的次数')
+METRICS.describe('strm_emby_refresh_total', 'counter', 'Emby媒体库刷新通知结果')
+METRICS.describe('strm_log_suppressed_total', 'counter', '被限流丢弃的日志条数')
+
+class MetricsServer:
+    """
+    在后台线程提供HTTP接口: /metrics 返回Prometheus文本格式指标，/health 返回JSON健康状态
+
+    health为无参函数，返回 (是否健康, 详情dict)；不健康时/health返回503。
+    """
+
+    def __init__(self, port, host='127.0.0.1', metrics=METRICS, health=None):
+        health = health or (lambda: (True, {}))
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?', 1)[0]
+                if path == '/metrics':
+                    status, content_type = 200, 'text/plain; version=0.0.4; charset=utf-8'
+                    body = metrics.render()
+                elif path == '/health':
+                    try:
+                        ok, details = health()
+                    except Exception as e:
+                        ok, details = False, {'error': str(e)}
+                    status, content_type = (200 if ok else 503), 'application/json; charset=utf-8'
+                    body = json.dumps(dict(details, status='ok' if ok else 'unhealthy'), ensure_ascii=False)
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug("metrics: " + format, *args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class RateLimitFilter(logging.Filter):
+    """
+    按日志模板限流，防止逐文件日志在大量变化时刷屏
+
+    同一模板（logger.info("...%s", path) 中的格式串）每个周期最多输出burst条，超出的丢弃并计数，
+    该模板下一条被输出的日志会附带上一周期省略的条数。ERROR及以上级别不限流。
+    """
+
+    def __init__(self, burst=20, period=1.0):
+        """
+        Args:
+            burst: 每个周期每个模板最多输出的条数
+            period: 周期（秒）
+        """
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self._lock = threading.Lock()
+        # (logger名, 级别, 模板) -> [周期开始时间, 本周期已输出, 累计省略]
+        self._state = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.get(key)
+            if state is None:
+                if len(self._state) > 10000:
+                    self._state.clear()
+                state = self._state[key] = [now, 0, 0]
+            elif now - state[0] >= self.period:
+                state[0] = now
+                state[1] = 0
+            if state[1] >= self.burst:
+                state[2] += 1
+                METRICS.inc('strm_log_suppressed_total')
+                return False
+            state[1] += 1
+            suppressed, state[2] = state[2], 0
+        if suppressed:
+            record.msg = f"{record.getMessage()} (此前省略 {suppressed} 条同类日志)"
+            record.args = None
+        return True
 
 class DirectoryMapping:
-    def __init__(self, source_dir, target_dir, content_prefix=None):
+    def __init__(self, source_dir, target_dir, content_prefix=None, scan_concurrency=None, watch_mode='inotify',
+                 emby_library=None, rules=None):
         """
         初始化目录映射
         
@@ -19,69 +469,1350 @@ class DirectoryMapping:
             source_dir: 源目录
             target_dir: 目标目录
             content_prefix: STRM文件内容前缀，如果为None则使用源目录
+            scan_concurrency: 扫描该目录时的并发列目录数，如果为None则使用全局默认值
+            watch_mode: 监控方式，inotify使用watchdog，poll使用轮询（适用于收不到inotify事件的网络挂载）
+            emby_library: 对应的Emby媒体库名称，如果为None则按媒体库路径匹配目标目录
+            rules: MediaRules，如果为None则使用默认规则（只处理视频扩展名）
         """
         self.source_dir = os.path.abspath(source_dir)
         self.target_dir = os.path.abspath(target_dir)
         self.content_prefix = content_prefix if content_prefix else self.source_dir
+        self.scan_concurrency = scan_concurrency
+        self.watch_mode = watch_mode
+        self.emby_library = emby_library
+        self.rules = rules or DEFAULT_RULES
+
+    def relative(self, path):
+        """源目录下路径的相对路径"""
+        return path[len(self.source_dir) + 1:]
+
+def path_prefix_bounds(path):
+    """
+    返回匹配path所有子路径的字符串区间 [lower, upper)
+
+    用于 "col >= lower AND col < upper" 形式的范围查询，可以走索引，
+    且不会把 /mnt/a 误匹配到 /mnt/ab。
+    """
+    return path + os.sep, path + chr(ord(os.sep) + 1)
+
+class MappingTrie:
+    """
+    按路径分量组织的目录映射前缀树
+
+    查找时逐级匹配路径分量，返回最长匹配的映射，复杂度只与路径深度有关；
+    按分量匹配也保证 /mnt/a 不会匹配到 /mnt/ab 下的文件。
+    """
+
+    def __init__(self, mappings=()):
+        self.root = {}
+        for mapping in mappings:
+            self.add(mapping)
+
+    @staticmethod
+    def _parts(path):
+        return path.rstrip(os.sep).split(os.sep)
+
+    def add(self, mapping):
+        """加入映射，源目录相同的映射会被替换"""
+        node = self.root
+        for part in self._parts(mapping.source_dir):
+            node = node.setdefault(part, {})
+        # None键存放挂在该节点上的映射，不会与路径分量冲突
+        node[None] = mapping
+
+    def remove(self, source_dir):
+        """移除源目录对应的映射，不存在时忽略"""
+        node = self.root
+        for part in self._parts(source_dir):
+            node = node.get(part)
+            if node is None:
+                return
+        node.pop(None, None)
+
+    def find(self, path):
+        """
+        查找路径所属的映射
+
+        Returns:
+            DirectoryMapping: 最长前缀匹配的映射，没有匹配返回None
+        """
+        node = self.root
+        best = None
+        for part in path.split(os.sep):
+            node = node.get(part)
+            if node is None:
+                break
+            best = node.get(None, best)
+        return best
+
+class BloomFilter:
+    """
+    简单的布隆过滤器，用于在内存中压缩存储海量路径
+
+    只会误报（返回存在但实际不存在），不会漏报，命中后需要回查数据库确认。
+    """
+
+    def __init__(self, capacity, error_rate=0.01, max_bytes=None):
+        """
+        Args:
+            capacity: 预计容纳的元素数量
+            error_rate: 目标误报率
+            max_bytes: 位数组最大字节数，超出时截断（误报率随之上升）
+        """
+        capacity = max(1, capacity)
+        num_bits = int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        if max_bytes:
+            num_bits = min(num_bits, max_bytes * 8)
+        self.num_bits = max(64, num_bits)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        """双重哈希生成k个比特位置"""
+        digest = hashlib.blake2b(item.encode('utf-8', 'surrogateescape'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        bits = self.bits
+        for pos in self._positions(item):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def memory_bytes(self):
+        return sys.getsizeof(self.bits)
+
+    def estimated_error_rate(self):
+        """按当前元素数量估算的误报率"""
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+class SyncedPathIndex:
+    """
+    已同步源路径的内存索引
+
+    mode:
+        set   - 精确集合，命中与否都无需访问数据库
+        bloom - 布隆过滤器，未命中即确定未同步，命中时回查数据库
+        auto  - 按行数估算集合内存，超出上限时自动改用布隆过滤器
+    """
+
+    # 估算集合中每个路径字符串的固定开销（str对象头 + 集合槽位）
+    SET_ENTRY_OVERHEAD = 49 + 40
+
+    def __init__(self, mode, expected_count, avg_path_len, max_bytes):
+        """
+        Args:
+            mode: set / bloom / auto
+            expected_count: 数据库中现有的路径数量
+            avg_path_len: 路径平均长度
+            max_bytes: 内存上限（字节）
+        """
+        # 预留增长空间，监控运行期间新增的路径也要放进索引
+        capacity = int(expected_count * 1.5) + 1024
+        if mode == 'auto':
+            estimated = capacity * (self.SET_ENTRY_OVERHEAD + avg_path_len)
+            mode = 'set' if estimated <= max_bytes else 'bloom'
+        self.mode = mode
+        if mode == 'set':
+            self.items = set()
+        else:
+            self.items = BloomFilter(capacity, max_bytes=max_bytes)
+
+    @property
+    def exact(self):
+        """命中结果是否可以直接信任"""
+        return self.mode == 'set'
+
+    def add(self, path):
+        self.items.add(path)
+
+    def discard(self, path):
+        """移除路径；布隆过滤器无法删除，残留的误报由数据库回查兜底"""
+        if self.exact:
+            self.items.discard(path)
+
+    def __contains__(self, path):
+        return path in self.items
+
+    def __len__(self):
+        return len(self.items) if self.exact else self.items.count
+
+    def memory_bytes(self):
+        """估算索引占用的内存"""
+        if self.exact:
+            return sys.getsizeof(self.items) + sum(sys.getsizeof(p) for p in self.items)
+        return self.items.memory_bytes()
+
+    def describe(self):
+        """索引状态描述，用于启动时输出"""
+        desc = f"{self.mode} 模式, {len(self)} 条, 约 {self.memory_bytes() / 1024 / 1024:.1f} MB"
+        if not self.exact:
+            desc += f", 误报率约 {self.items.estimated_error_rate():.4%}"
+        return desc
+
+class SyncDatabase:
+    """
+    同步记录数据库
+
+    整个进程只持有一个SQLite长连接（WAL模式），查询语句使用固定SQL以命中sqlite3的语句缓存；
+    写入先进入内存缓冲区，累计batch_size条或距上次提交超过flush_interval_ms毫秒后批量提交，
+    关闭时会把剩余缓冲全部刷入数据库。
+    """
+
+    FILE_SELECT_SQL = "SELECT id FROM synced_files WHERE source_path = ?"
+    FILE_INSERT_SQL = "INSERT OR REPLACE INTO synced_files (source_path, target_path) VALUES (?, ?)"
+    SNAPSHOT_INSERT_SQL = (
+        "INSERT OR REPLACE INTO dir_snapshots (dir_path, parent_path, mtime_ns, inode) VALUES (?, ?, ?, ?)"
+    )
+    SNAPSHOT_DELETE_SQL = "DELETE FROM dir_snapshots WHERE dir_path = ? OR (dir_path >= ? AND dir_path < ?)"
+    SNAPSHOT_SELECT_SQL = (
+        "SELECT dir_path, parent_path, mtime_ns, inode FROM dir_snapshots "
+        "WHERE dir_path = ? OR (dir_path >= ? AND dir_path < ?)"
+    )
+
+    def __init__(self, db_path, batch_size=500, flush_interval_ms=1000, index_mode='auto', index_max_mb=256):
+        """
+        初始化数据库连接
+
+        Args:
+            db_path: SQLite数据库路径
+            batch_size: 缓冲区累计多少条写入后提交
+            flush_interval_ms: 缓冲区最长停留时间（毫秒）
+            index_mode: 已同步路径内存索引模式 set / bloom / auto / none
+            index_max_mb: 内存索引的内存上限（MB）
+        """
+        self.db_path = db_path
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0, flush_interval_ms) / 1000.0
+
+        self._lock = threading.RLock()
+        self._pending_files = {}
+        self._pending_snapshots = {}
+        self._pending_snapshot_deletes = []
+        self._last_flush = time.monotonic()
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.init_schema()
+
+        self.index = None
+        if index_mode != 'none':
+            self.load_index(index_mode, index_max_mb * 1024 * 1024)
+
+        # 后台线程负责按时间间隔刷新缓冲区，避免监控模式下写入长时间停留在内存中
+        self._stop_event = threading.Event()
+        self._flusher = None
+        if self.flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name="sqlite-flusher", daemon=True)
+            self._flusher.start()
+
+    def init_schema(self):
+        """创建数据表"""
+        with self._lock, self.conn:
+            # 创建文件同步记录表
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS synced_files (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                source_path TEXT UNIQUE,
+                target_path TEXT,
+                sync_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''')
+
+            # 创建目录快照表，用于增量扫描时判断目录是否发生变化
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS dir_snapshots (
+                dir_path TEXT PRIMARY KEY,
+                parent_path TEXT,
+                mtime_ns INTEGER,
+                inode INTEGER,
+                scan_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''')
+
+            # 每个映射上次完整生成STRM时使用的内容前缀，前缀变化后已同步的文件也要检查内容
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS mapping_prefixes (
+                source_dir TEXT PRIMARY KEY,
+                content_prefix TEXT
+            )
+            ''')
+
+    def load_index(self, mode, max_bytes):
+        """
+        一次性把synced_files中的源路径载入内存索引
+
+        Args:
+            mode: set / bloom / auto
+            max_bytes: 内存上限（字节）
+        """
+        start = time.monotonic()
+        with self._lock:
+            count, total_len = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(source_path)), 0) FROM synced_files"
+            ).fetchone()
+            index = SyncedPathIndex(mode, count, total_len // count if count else 0, max_bytes)
+            cursor = self.conn.execute("SELECT source_path FROM synced_files")
+            while True:
+                rows = cursor.fetchmany(10000)
+                if not rows:
+                    break
+                for (path,) in rows:
+                    index.add(path)
+            self.index = index
+        logger.info("已载入同步记录索引: %s, 耗时 %.2fs", index.describe(), time.monotonic() - start)
+
+    def _flush_loop(self):
+        """后台定时刷新缓冲区"""
+        while not self._stop_event.wait(self.flush_interval):
+            with self._lock:
+                if time.monotonic() - self._last_flush >= self.flush_interval:
+                    self.flush()
+
+    def _pending_count(self):
+        return len(self._pending_files) + len(self._pending_snapshots) + len(self._pending_snapshot_deletes)
+
+    def _maybe_flush(self):
+        """缓冲区达到批量大小时提交"""
+        if self._pending_count() >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """把缓冲区中的写入一次性提交到数据库"""
+        with self._lock:
+            pending = self._pending_count()
+            if pending:
+                start = time.perf_counter()
+                with self.conn:
+                    if self._pending_files:
+                        self.conn.executemany(self.FILE_INSERT_SQL, self._pending_files.items())
+                    if self._pending_snapshot_deletes:
+                        self.conn.executemany(
+                            self.SNAPSHOT_DELETE_SQL,
+                            ((d,) + path_prefix_bounds(d) for d in self._pending_snapshot_deletes)
+                        )
+                    if self._pending_snapshots:
+                        self.conn.executemany(
+                            self.SNAPSHOT_INSERT_SQL,
+                            ((d,) + snap for d, snap in self._pending_snapshots.items())
+                        )
+                self._pending_files.clear()
+                self._pending_snapshots.clear()
+                self._pending_snapshot_deletes.clear()
+                METRICS.observe('strm_sqlite_commit_seconds', time.perf_counter() - start)
+                METRICS.inc('strm_sqlite_rows_committed_total', pending)
+            self._last_flush = time.monotonic()
+
+    def stats(self):
+        """
+        写入缓冲状态
+
+        Returns:
+            dict: pending 尚未提交的写入数, last_flush_age 距上次提交的秒数
+        """
+        with self._lock:
+            return {'pending': self._pending_count(), 'last_flush_age': time.monotonic() - self._last_flush}
+
+    def close(self):
+        """刷新剩余写入并关闭连接"""
+        self._stop_event.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        with self._lock:
+            if self.conn is None:
+                return
+            self.flush()
+            self.conn.close()
+            self.conn = None
+
+    def is_file_synced(self, file_path):
+        """检查文件是否已有同步记录（包含尚未提交的缓冲）"""
+        with self._lock:
+            if file_path in self._pending_files:
+                return True
+            if self.index is not None:
+                # 索引未命中即可确定未同步；精确集合命中也无需回查
+                if file_path not in self.index:
+                    return False
+                if self.index.exact:
+                    return True
+            return self.conn.execute(self.FILE_SELECT_SQL, (file_path,)).fetchone() is not None
+
+    def record_synced_file(self, source_path, target_path):
+        """缓冲一条文件同步记录"""
+        with self._lock:
+            self._pending_files[source_path] = target_path
+            if self.index is not None:
+                self.index.add(source_path)
+            self._maybe_flush()
+
+    def get_target(self, source_path):
+        """查询源文件对应的STRM路径，未同步返回None"""
+        with self._lock:
+            if source_path in self._pending_files:
+                return self._pending_files[source_path]
+            row = self.conn.execute(
+                "SELECT target_path FROM synced_files WHERE source_path = ?", (source_path,)
+            ).fetchone()
+            return row[0] if row else None
+
+    def delete_file(self, source_path):
+        """
+        删除单个文件的同步记录
+
+        Returns:
+            str: 原STRM路径，没有记录时返回None
+        """
+        with self._lock:
+            self.flush()
+            target_path = self.get_target(source_path)
+            if target_path is not None:
+                with self.conn:
+                    self.conn.execute("DELETE FROM synced_files WHERE source_path = ?", (source_path,))
+                if self.index is not None:
+                    self.index.discard(source_path)
+            return target_path
+
+    def delete_prefix(self, dir_path):
+        """
+        按路径前缀删除目录下所有文件的同步记录和目录快照
+
+        Returns:
+            list: 被删除记录的STRM路径
+        """
+        bounds = path_prefix_bounds(dir_path)
+        with self._lock:
+            self.flush()
+            rows = self.conn.execute(
+                "SELECT source_path, target_path FROM synced_files WHERE source_path >= ? AND source_path < ?", bounds
+            ).fetchall()
+            with self.conn:
+                self.conn.execute("DELETE FROM synced_files WHERE source_path >= ? AND source_path < ?", bounds)
+                self.conn.execute(self.SNAPSHOT_DELETE_SQL, (dir_path,) + bounds)
+            if self.index is not None:
+                for source_path, _ in rows:
+                    self.index.discard(source_path)
+        return [target_path for _, target_path in rows]
+
+    def move_prefix(self, old_dir, new_dir, old_target_dir, new_target_dir):
+        """
+        目录改名/移动后，用一条按前缀的UPDATE改写其下所有同步记录
+
+        Args:
+            old_dir: 原源目录
+            new_dir: 新源目录
+            old_target_dir: 原STRM目录
+            new_target_dir: 新STRM目录
+
+        Returns:
+            list: (新源路径, 原STRM路径, 新STRM路径) 列表
+        """
+        bounds = path_prefix_bounds(old_dir)
+        old_len = len(old_dir) + 1
+        old_target_len = len(old_target_dir) + 1
+        with self._lock:
+            self.flush()
+            rows = self.conn.execute(
+                "SELECT source_path, target_path FROM synced_files WHERE source_path >= ? AND source_path < ?", bounds
+            ).fetchall()
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE OR REPLACE synced_files SET source_path = ? || substr(source_path, ?), "
+                    "target_path = ? || substr(target_path, ?) WHERE source_path >= ? AND source_path < ?",
+                    (new_dir, old_len, new_target_dir, old_target_len) + bounds
+                )
+                # 目录快照随目录一起改名，改名后的目录不需要重新列出
+                self.conn.execute(
+                    "UPDATE OR REPLACE dir_snapshots SET dir_path = ? || substr(dir_path, ?), "
+                    "parent_path = ? || substr(parent_path, ?) WHERE dir_path >= ? AND dir_path < ?",
+                    (new_dir, old_len, new_dir, old_len) + bounds
+                )
+                self.conn.execute(
+                    "UPDATE OR REPLACE dir_snapshots SET dir_path = ?, parent_path = ? WHERE dir_path = ?",
+                    (new_dir, os.path.dirname(new_dir), old_dir)
+                )
+            moved = []
+            for source_path, target_path in rows:
+                new_source = new_dir + source_path[len(old_dir):]
+                new_target = new_target_dir + target_path[len(old_target_dir):]
+                if self.index is not None:
+                    self.index.discard(source_path)
+                    self.index.add(new_source)
+                moved.append((new_source, target_path, new_target))
+        return moved
+
+    def clear_prefix(self, dir_path):
+        """
+        删除目录下所有文件的同步记录（保留目录快照），用于对账前重建该映射的记录
+        """
+        bounds = path_prefix_bounds(dir_path)
+        with self._lock:
+            self.flush()
+            if self.index is not None and self.index.exact:
+                for (source_path,) in self.conn.execute(
+                    "SELECT source_path FROM synced_files WHERE source_path >= ? AND source_path < ?", bounds
+                ):
+                    self.index.discard(source_path)
+            with self.conn:
+                self.conn.execute("DELETE FROM synced_files WHERE source_path >= ? AND source_path < ?", bounds)
+
+    def load_dir_snapshots(self, root):
+        """
+        读取root及其所有子目录的快照
+
+        Args:
+            root: 根目录
+
+        Returns:
+            tuple: (快照字典 dir_path -> (mtime_ns, inode), 子目录字典 parent_path -> [dir_path])
+        """
+        snapshots = {}
+        children = {}
+        with self._lock:
+            self.flush()
+            rows = self.conn.execute(self.SNAPSHOT_SELECT_SQL, (root,) + path_prefix_bounds(root)).fetchall()
+        for dir_path, parent_path, mtime_ns, inode in rows:
+            snapshots[dir_path] = (mtime_ns, inode)
+            children.setdefault(parent_path, []).append(dir_path)
+        return snapshots, children
+
+    def get_content_prefix(self, source_dir):
+        """映射上次完整生成STRM时的内容前缀，没有记录时返回None"""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT content_prefix FROM mapping_prefixes WHERE source_dir = ?", (source_dir,)
+            ).fetchone()
+            return row[0] if row else None
+
+    def set_content_prefix(self, source_dir, content_prefix):
+        """记录映射当前的内容前缀"""
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO mapping_prefixes (source_dir, content_prefix) VALUES (?, ?)",
+                (source_dir, content_prefix)
+            )
+
+    def record_dir_snapshot(self, dir_path, mtime_ns, inode):
+        """缓冲一条目录快照"""
+        with self._lock:
+            self._pending_snapshots[dir_path] = (os.path.dirname(dir_path), mtime_ns, inode)
+            self._maybe_flush()
+
+    def delete_dir_snapshots(self, dir_path):
+        """删除目录及其所有子目录的快照（目录被删除或移走时调用）"""
+        with self._lock:
+            lower, upper = path_prefix_bounds(dir_path)
+            for path in [p for p in self._pending_snapshots if p == dir_path or lower <= p < upper]:
+                del self._pending_snapshots[path]
+            self._pending_snapshot_deletes.append(dir_path)
+            self._maybe_flush()
+
+class EventCoalescer:
+    """
+    watchdog事件合并队列
+
+    同一路径的重复事件只保留最后一个；路径在settle_seconds内没有新事件且文件大小不再变化后
+    才视为写入完成，按批交给线程池处理，避免在watchdog回调线程里同步写STRM。
+
+    稳定期内连续的改名会合并（A→B、B→C 合并为 A→C，新建B、B→C 合并为新建C）；
+    被覆盖或目标已消失的移动事件不会直接丢弃，其源路径转为删除事件，保证旧STRM和同步记录被清理。
+    """
+
+    def __init__(self, process_batch, settle_seconds=2.0, batch_size=100, workers=4):
+        """
+        Args:
+            process_batch: 批处理函数，参数为事件列表
+            settle_seconds: 路径静默多久后才处理（秒）
+            batch_size: 每批最多处理的事件数
+            workers: 处理批次的线程数
+        """
+        self.process_batch = process_batch
+        self.settle_seconds = settle_seconds
+        self.batch_size = max(1, batch_size)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="strm-writer")
+
+        # path -> [event, first_seen, last_seen, last_size, stale]
+        # event为None表示只剩stale中的删除事件；stale为处理event前需要先执行的删除事件
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._closed = False
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.last_lag = 0.0
+
+        METRICS.gauge_callback('strm_event_queue_depth', lambda: self.stats()['depth'])
+        METRICS.gauge_callback('strm_event_queue_lag_seconds', lambda: self.stats()['lag'])
+
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="event-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    @staticmethod
+    def _event_path(event):
+        """事件最终指向的路径，移动事件取目标路径"""
+        return getattr(event, 'dest_path', None) or event.src_path
+
+    @staticmethod
+    def _deleted_event(path, is_directory):
+        return DirDeletedEvent(path) if is_directory else FileDeletedEvent(path)
+
+    def _merge_move(self, event, now):
+        """
+        移动事件的源路径还在队列中时与之前的事件合并，调用时需持有锁
+
+        Returns:
+            tuple: (合并后的事件或None, 最早入队时间, 需要先执行的删除事件)
+        """
+        entry = self._pending.get(event.src_path)
+        if entry is None or entry[0] is None or entry[0].event_type == 'deleted':
+            return event, now, []
+        del self._pending[event.src_path]
+        old = entry[0]
+        if old.event_type == 'created':
+            # 新建后改名，按新建处理新路径
+            merged = FileCreatedEvent(event.dest_path)
+        elif old.src_path == event.dest_path:
+            # 改回了原来的名字，什么都不用做
+            merged = None
+        else:
+            merged = type(event)(old.src_path, event.dest_path)
+        return merged, entry[1], entry[4]
+
+    def put(self, event):
+        """加入一个事件，已在队列中的同一路径只刷新事件和时间"""
+        now = time.monotonic()
+        path = self._event_path(event)
+        METRICS.inc('strm_events_received_total')
+        with self._cond:
+            self.received += 1
+            first_seen, stale = now, []
+            if event.event_type == 'moved':
+                event, first_seen, stale = self._merge_move(event, now)
+            entry = self._pending.get(path)
+            if entry is not None:
+                # 被替换的移动事件，其源路径仍需删除
+                old = entry[0]
+                if old is not None and old.event_type == 'moved':
+                    stale = stale + [self._deleted_event(old.src_path, old.is_directory)]
+                stale = entry[4] + stale
+                first_seen = min(first_seen, entry[1])
+            self._pending[path] = [event, first_seen, now, None, stale]
+            self._cond.notify()
+
+    def touch(self, path):
+        """路径仍在写入（modified事件），推迟其处理时间"""
+        with self._cond:
+            entry = self._pending.get(path)
+            if entry is not None:
+                self.received += 1
+                METRICS.inc('strm_events_received_total')
+                entry[2] = time.monotonic()
+
+    def _collect_quiet(self, now):
+        """
+        取出静默时间已到的路径，调用时需持有锁
+
+        删除事件直接取出；其余路径需要确认文件大小不再变化，stat在锁外进行，
+        避免慢速挂载上的stat阻塞watchdog回调线程的put()。
+
+        Returns:
+            tuple: (可以直接处理的条目, 需要stat的(路径, 条目, last_seen))，合计最多batch_size个
+        """
+        ready = []
+        candidates = []
+        for path, entry in list(self._pending.items()):
+            if now - entry[2] < self.settle_seconds:
+                continue
+            if entry[0] is None or entry[0].event_type == 'deleted':
+                del self._pending[path]
+                ready.append(entry)
+            else:
+                candidates.append((path, entry, entry[2]))
+            if len(ready) + len(candidates) >= self.batch_size:
+                break
+        return ready, candidates
+
+    @staticmethod
+    def _stat_sizes(candidates):
+        """在锁外stat候选路径，文件已消失时大小为None"""
+        sized = []
+        for path, entry, seen in candidates:
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                size = None
+            sized.append((path, entry, seen, size))
+        return sized
+
+    def _settle(self, sized, now):
+        """
+        根据stat结果判断路径是否已稳定，调用时需持有锁
+
+        stat期间路径有新事件（条目被替换或last_seen被刷新）时保留在队列中，下次再检查。
+
+        Returns:
+            list: 可以处理的条目
+        """
+        ready = []
+        for path, entry, seen, size in sized:
+            if self._pending.get(path) is not entry or entry[2] != seen:
+                continue
+            if size is None:
+                # 文件已消失，丢弃事件
+                del self._pending[path]
+                event = entry[0]
+                self.dropped += 1
+                METRICS.inc('strm_events_dropped_total')
+                # 移动的目标已消失，仍要删除源路径对应的STRM
+                if event.event_type == 'moved':
+                    entry[4].append(self._deleted_event(event.src_path, event.is_directory))
+                entry[0] = None
+                if entry[4]:
+                    ready.append(entry)
+            elif size != entry[3] and not self._closed:
+                # 首次检查或大小仍在变化，半个稳定周期后再确认一次
+                entry[3] = size
+                entry[2] = now - self.settle_seconds / 2
+            else:
+                del self._pending[path]
+                ready.append(entry)
+        return ready
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                if self._closed and not self._pending:
+                    return
+                if not self._pending:
+                    self._cond.wait()
+                    continue
+                ready, candidates = self._collect_quiet(time.monotonic())
+            sized = self._stat_sizes(candidates)
+            with self._cond:
+                now = time.monotonic()
+                ready += self._settle(sized, now)
+                if not ready:
+                    self._cond.wait(max(0.05, min(self.settle_seconds / 2, 0.5)))
+                    continue
+                events = [event for entry in ready for event in entry[4] + [entry[0]] if event is not None]
+                self._in_flight += len(events)
+                self.last_lag = max(now - entry[1] for entry in ready)
+            for entry in ready:
+                METRICS.observe('strm_event_lag_seconds', now - entry[1])
+            if events:
+                self.pool.submit(self._run_batch, events)
+
+    def _run_batch(self, events):
+        try:
+            self.process_batch(events)
+        except Exception as e:
+            logger.error("处理事件批次失败: %s", e)
+        finally:
+            with self._cond:
+                self._in_flight -= len(events)
+                self.processed += len(events)
+                self._cond.notify_all()
+            METRICS.inc('strm_events_processed_total', len(events))
+
+    def stats(self):
+        """
+        队列指标
+
+        Returns:
+            dict: depth 等待+处理中的事件数, lag 最老等待事件的滞留秒数,
+                  last_lag 最近一批事件从入队到处理的延迟, received/processed/dropped 计数
+        """
+        now = time.monotonic()
+        with self._cond:
+            oldest = min((entry[1] for entry in self._pending.values()), default=now)
+            return {
+                'depth': len(self._pending) + self._in_flight,
+                'lag': now - oldest,
+                'last_lag': self.last_lag,
+                'received': self.received,
+                'processed': self.processed,
+                'dropped': self.dropped,
+            }
+
+    def close(self, drain=True):
+        """
+        停止队列
+
+        Args:
+            drain: 是否立即处理完剩余事件（不再等待稳定时间）
+        """
+        with self._cond:
+            self._closed = True
+            if drain:
+                for entry in self._pending.values():
+                    entry[2] = float('-inf')
+            else:
+                self.dropped += len(self._pending)
+                METRICS.inc('strm_events_dropped_total', len(self._pending))
+                self._pending.clear()
+            self._cond.notify_all()
+        self._dispatcher.join()
+        self.pool.shutdown(wait=True)
+
+class _PolledDir:
+    """轮询模式下单个目录的状态"""
+    # stamp 为目录自身的 (mtime_ns, inode)，full_stat 模式下为None；videos 包含视频和附属文件
+    __slots__ = ('stamp', 'fingerprint', 'subdirs', 'videos', 'interval', 'next_check')
+
+    def __init__(self, stamp, fingerprint, subdirs, videos, interval, next_check):
+        self.stamp = stamp
+        self.fingerprint = fingerprint
+        self.subdirs = subdirs
+        self.videos = videos
+        self.interval = interval
+        self.next_check = next_check
+
+class PollingWatcher:
+    """
+    轮询方式的变化检测，用于inotify不触发事件的FUSE/SMB/NFS挂载
+
+    每个目录保存自身的mtime/inode、列表指纹（名称+类型的哈希）、子目录名和视频文件名。
+    目录按各自的间隔检查：检查只stat目录本身，mtime/inode未变化时不列目录、不stat其中的文件；
+    变化时才重新列出，列目录使用scandir返回的类型，不逐个stat文件，列表指纹不变时也不发事件。
+    没有变化时间隔翻倍直到max_interval，发生变化时恢复为min_interval；新出现的子目录立即列出。
+    稳定的目录树每秒只有约 目录数/max_interval 次stat，列目录次数与变化量成正比。
+    目录mtime只反映直接子项的增删改名，不会随更深层的变化更新，所以子目录不靠父目录剪枝，各自检查。
+
+    目录mtime不可靠的挂载（例如mtime固定不变）可以开启full_stat：每次检查都列出目录并stat所有条目，
+    按名称+大小+mtime比较指纹，开销与目录树大小成正比。
+    检测到的变化转换成watchdog事件交给handler处理。
+    """
+
+    def __init__(self, mapping, handler, min_interval=5.0, max_interval=300.0, full_stat=False):
+        """
+        Args:
+            mapping: DirectoryMapping
+            handler: CloudDriveHandler
+            min_interval: 目录最短轮询间隔（秒）
+            max_interval: 目录最长轮询间隔（秒）
+            full_stat: 不信任目录mtime，每次检查都列目录并stat所有条目
+        """
+        self.mapping = mapping
+        self.handler = handler
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.full_stat = full_stat
+        self.listings = 0
+        self.checks = 0
+        self._dirs = {}
+        self._heap = []
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"poll:{mapping.source_dir}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def join(self):
+        self._thread.join()
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def _schedule(self, dir_path, state, delay):
+        state.next_check = time.monotonic() + delay
+        heapq.heappush(self._heap, (state.next_check, dir_path))
+
+    def _stamp(self, dir_path):
+        """stat目录本身，返回 (mtime_ns, inode)"""
+        self.checks += 1
+        METRICS.inc('strm_poll_checks_total', mapping=self.mapping.source_dir)
+        st = os.stat(dir_path)
+        return st.st_mtime_ns, st.st_ino
+
+    def _list(self, dir_path):
+        """
+        列出目录并计算指纹
+
+        Returns:
+            tuple: (指纹, 子目录名集合, 视频文件名集合)
+        """
+        self.listings += 1
+        METRICS.inc('strm_poll_listings_total', mapping=self.mapping.source_dir)
+        items = []
+        subdirs = set()
+        videos = set()
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                try:
+                    # 不带stat时类型来自目录项本身，大多数文件系统上不需要额外的系统调用
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if self.full_stat:
+                        st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if is_dir:
+                    subdirs.add(entry.name)
+                    items.append((entry.name, 'd', st.st_mtime_ns) if self.full_stat else (entry.name, 'd'))
+                else:
+                    if self.mapping.rules.match(self.mapping.relative(entry.path)) is not None:
+                        videos.add(entry.name)
+                    items.append((entry.name, st.st_size, st.st_mtime_ns) if self.full_stat else (entry.name, 'f'))
+        items.sort()
+        fingerprint = hashlib.blake2b(repr(items).encode('utf-8', 'surrogateescape'), digest_size=8).digest()
+        return fingerprint, frozenset(subdirs), frozenset(videos)
+
+    def _forget(self, dir_path):
+        """移除目录及其子目录的状态"""
+        lower, upper = path_prefix_bounds(dir_path)
+        for path in [p for p in self._dirs if p == dir_path or lower <= p < upper]:
+            del self._dirs[path]
+
+    def _unchanged(self, dir_path, state):
+        """目录没有变化，加大检查间隔"""
+        state.interval = min(state.interval * 2, self.max_interval)
+        self._schedule(dir_path, state, state.interval)
+        return []
+
+    def _poll(self, dir_path, emit=True):
+        """
+        轮询单个目录
+
+        Args:
+            dir_path: 目录路径
+            emit: 是否把变化作为事件发出（启动时建立基线不发事件）
+
+        Returns:
+            list: 需要立即列出的子目录
+        """
+        old = self._dirs.get(dir_path)
+        try:
+            # 先stat再列目录，两者之间发生的变化会让下次检查时mtime不一致，不会漏掉
+            stamp = None if self.full_stat else self._stamp(dir_path)
+            if old is not None and stamp is not None and stamp == old.stamp:
+                return self._unchanged(dir_path, old)
+            fingerprint, subdirs, videos = self._list(dir_path)
+        except FileNotFoundError:
+            if old is not None:
+                self._forget(dir_path)
+                if emit:
+                    self.handler.dispatch(DirDeletedEvent(dir_path))
+            return []
+        except OSError as e:
+            logger.warning("轮询目录失败: %s: %s", dir_path, e)
+            if old is not None:
+                self._schedule(dir_path, old, old.interval)
+            return []
+
+        if old is not None and old.fingerprint == fingerprint:
+            # mtime变了但名称没变（例如临时文件建了又删），不需要发事件
+            old.stamp = stamp
+            return self._unchanged(dir_path, old)
+
+        state = _PolledDir(stamp, fingerprint, subdirs, videos, self.min_interval, 0)
+        self._dirs[dir_path] = state
+        self._schedule(dir_path, state, self.min_interval)
+
+        if emit:
+            old_videos = old.videos if old is not None else frozenset()
+            for name in videos - old_videos:
+                path = os.path.join(dir_path, name)
+                if not self.handler.is_file_synced(path):
+                    self.handler.dispatch(FileCreatedEvent(path))
+            for name in old_videos - videos:
+                self.handler.dispatch(FileDeletedEvent(os.path.join(dir_path, name)))
+
+        old_subdirs = old.subdirs if old is not None else frozenset()
+        for name in old_subdirs - subdirs:
+            child = os.path.join(dir_path, name)
+            self._forget(child)
+            if emit:
+                self.handler.dispatch(DirDeletedEvent(child))
+        # 新出现的子目录立即列出，已知的子目录按各自的间隔检查
+        return [os.path.join(dir_path, name) for name in subdirs if os.path.join(dir_path, name) not in self._dirs]
+
+    def _poll_tree(self, dir_path, emit):
+        """从dir_path开始轮询，并继续处理需要立即列出的子目录"""
+        stack = [dir_path]
+        while stack and not self._stop_event.is_set():
+            stack.extend(self._poll(stack.pop(), emit))
+
+    def _run(self):
+        start = time.monotonic()
+        self._poll_tree(self.mapping.source_dir, emit=False)
+        logger.info("轮询基线已建立: %s, %s 个目录, 耗时 %.1fs",
+                    self.mapping.source_dir, len(self._dirs), time.monotonic() - start)
+
+        while not self._stop_event.is_set():
+            if not self._heap:
+                self._stop_event.wait(self.min_interval)
+                continue
+            next_check, dir_path = self._heap[0]
+            delay = next_check - time.monotonic()
+            if delay > 0:
+                self._stop_event.wait(min(delay, self.min_interval))
+                continue
+            heapq.heappop(self._heap)
+            state = self._dirs.get(dir_path)
+            # 堆中可能有过期条目（目录已删除或已重新调度）
+            if state is None or state.next_check != next_check:
+                continue
+            self._poll_tree(dir_path, emit=True)
+
+class EmbyNotifier:
+    """
+    合并后的Emby媒体库刷新通知
+
+    STRM变化时只记录受影响的映射，每个媒体库在首次变化delay_seconds秒后才刷新，
+    且同一媒体库两次刷新至少间隔window_seconds秒，从不触发整个服务器的刷新。
+    映射到媒体库的解析（需要请求VirtualFolders）在后台线程中进行，写STRM的线程不会等待HTTP请求；
+    媒体库列表和解析结果（包括找不到的结果）都缓存cache_ttl秒。
+    """
+
+    def __init__(self, emby_url, api_key, window_seconds=300, delay_seconds=30, cache_ttl=600):
+        """
+        Args:
+            emby_url: Emby服务器URL，例如 http://localhost:8096
+            api_key: Emby API密钥
+            window_seconds: 同一媒体库两次刷新的最小间隔（秒）
+            delay_seconds: 首次变化后等待多久再刷新，用于合并一批变化（秒）
+            cache_ttl: 媒体库列表缓存时间（秒）
+        """
+        self.emby_url = emby_url.rstrip('/')
+        self.api_key = api_key
+        self.window_seconds = window_seconds
+        self.delay_seconds = delay_seconds
+        self.cache_ttl = cache_ttl
+        self.session = requests.Session()
+
+        self._lock = threading.Lock()
+        self._touched = {}       # (目标目录, 配置的媒体库名称) -> 待解析的映射
+        self._pending = {}       # 媒体库ID -> 计划刷新时间
+        self._last_sent = {}     # 媒体库ID -> 上次刷新时间
+        self._names = {}         # 媒体库ID -> 名称
+        self._mapping_library = {}  # (目标目录, 配置的媒体库名称) -> ((媒体库ID, 名称)或None, 解析时间)
+        self._folders = None
+        self._folders_time = 0.0
+        self._lookup_failed_at = None
+        self.sent = 0
+        self.failed = 0
+        self.unresolved = 0
+
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="emby-notifier", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        按配置创建通知器
+
+        Args:
+            config: {url, api_key, window, delay}
+
+        Returns:
+            EmbyNotifier: 缺少url或api_key时返回None
+        """
+        if not config or not config.get('url') or not config.get('api_key'):
+            return None
+        return cls(config['url'], config['api_key'], config.get('window', 300), config.get('delay', 30))
+
+    def _virtual_folders(self, refresh=False):
+        """获取媒体库列表，带缓存"""
+        if refresh or self._folders is None or time.monotonic() - self._folders_time > self.cache_ttl:
+            response = self.session.get(
+                f"{self.emby_url}/emby/Library/VirtualFolders", params={'api_key': self.api_key}, timeout=10
+            )
+            response.raise_for_status()
+            self._folders = response.json()
+            self._folders_time = time.monotonic()
+            self._mapping_library.clear()
+        return self._folders
+
+    def _find_library(self, mapping, refresh=False):
+        """
+        查找映射对应的媒体库
+
+        优先按映射配置的媒体库名称查找，否则找Locations包含映射目标目录的媒体库。
+
+        Returns:
+            tuple: (媒体库ID, 名称)，找不到返回None
+        """
+        for folder in self._virtual_folders(refresh):
+            if mapping.emby_library:
+                if folder.get('Name') == mapping.emby_library:
+                    return folder.get('ItemId'), folder.get('Name')
+                continue
+            for location in folder.get('Locations') or []:
+                location = location.rstrip('/\\')
+                if mapping.target_dir == location or mapping.target_dir.startswith(location + os.sep):
+                    return folder.get('ItemId'), folder.get('Name')
+        return None
+
+    def library_for(self, mapping):
+        """解析映射对应的媒体库（结果缓存cache_ttl秒），找不到时刷新一次媒体库列表再试"""
+        # 按决定查找结果的字段缓存，热加载会创建新的映射对象，不能按对象id缓存
+        key = (mapping.target_dir, mapping.emby_library)
+        cached = self._mapping_library.get(key)
+        if cached is not None and time.monotonic() - cached[1] <= self.cache_ttl:
+            return cached[0]
+        library = self._find_library(mapping)
+        if library is None:
+            library = self._find_library(mapping, refresh=True)
+        self._mapping_library[key] = (library, time.monotonic())
+        return library
+
+    def clear_library_cache(self):
+        """映射重新加载后清空映射到媒体库的缓存"""
+        with self._lock:
+            self._mapping_library.clear()
+
+    def touch(self, mapping):
+        """
+        记录映射下的STRM发生了变化，只记录不请求Emby，媒体库由后台线程解析
+
+        Args:
+            mapping: DirectoryMapping
+        """
+        with self._lock:
+            # 获取媒体库列表失败后一分钟内不再记录，避免失败期间反复请求
+            if self._lookup_failed_at is not None and time.monotonic() - self._lookup_failed_at < 60:
+                return
+            self._touched.setdefault((mapping.target_dir, mapping.emby_library), mapping)
+
+    def _resolve_touched(self):
+        """解析有变化的映射对应的媒体库并安排刷新，HTTP请求不持有锁"""
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        for mapping in touched.values():
+            try:
+                library = self.library_for(mapping)
+            except requests.exceptions.RequestException as e:
+                logger.warning("获取Emby媒体库列表失败: %s", e)
+                with self._lock:
+                    self._lookup_failed_at = time.monotonic()
+                self.failed += 1
+                METRICS.inc('strm_emby_refresh_total', result='failed')
+                return
+            if library is None:
+                self.unresolved += 1
+                METRICS.inc('strm_emby_refresh_total', result='unresolved')
+                if self.unresolved == 1:
+                    logger.warning("找不到目录对应的Emby媒体库，不会通知刷新: %s", mapping.target_dir)
+                continue
+            library_id, name = library
+            with self._lock:
+                self._lookup_failed_at = None
+                if library_id in self._pending:
+                    continue
+                now = time.monotonic()
+                last_sent = self._last_sent.get(library_id)
+                due = now + self.delay_seconds
+                if last_sent is not None:
+                    due = max(due, last_sent + self.window_seconds)
+                self._pending[library_id] = due
+                self._names[library_id] = name
+
+    def _scan_library(self, library_id):
+        """发送单个媒体库的刷新请求"""
+        name = self._names.get(library_id, library_id)
+        try:
+            response = self.session.post(
+                f"{self.emby_url}/emby/Items/{library_id}/Refresh",
+                params={'api_key': self.api_key, 'Recursive': 'true'}, timeout=10
+            )
+            response.raise_for_status()
+            self.sent += 1
+            METRICS.inc('strm_emby_refresh_total', result='sent')
+            logger.info("已通知Emby刷新媒体库: %s", name)
+        except requests.exceptions.RequestException as e:
+            self.failed += 1
+            METRICS.inc('strm_emby_refresh_total', result='failed')
+            logger.warning("通知Emby刷新媒体库失败: %s: %s", name, e)
+
+    def flush(self, force=False):
+        """
+        发送已到期的刷新请求
+
+        Args:
+            force: 忽略等待时间，立即发送所有待刷新的媒体库
+        """
+        self._resolve_touched()
+        now = time.monotonic()
+        with self._lock:
+            due = [lid for lid, when in self._pending.items() if force or when <= now]
+            for library_id in due:
+                del self._pending[library_id]
+                self._last_sent[library_id] = now
+        for library_id in due:
+            self._scan_library(library_id)
+
+    def _run(self):
+        while not self._stop_event.wait(1):
+            self.flush()
+
+    def close(self):
+        """停止后台线程并立即发送剩余的刷新请求"""
+        self._stop_event.set()
+        self._thread.join()
+        self.flush(force=True)
 
 class CloudDriveHandler(FileSystemEventHandler):
-    def __init__(self, dir_mappings, db_path):
+    def __init__(self, dir_mappings, db_path, notifier=None, **db_options):
         """
         初始化处理器
         
         Args:
             dir_mappings: 目录映射列表
             db_path: SQLite数据库路径
+            notifier: EmbyNotifier，为None时不通知Emby
+            db_options: 传给SyncDatabase的参数（batch_size、flush_interval_ms、index_mode等）
         """
         self.dir_mappings = dir_mappings
+        self.mapping_trie = MappingTrie(dir_mappings)
         self.db_path = db_path
-        self.init_db()
-        
-    def init_db(self):
-        """初始化SQLite数据库"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # 创建文件同步记录表
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS synced_files (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            source_path TEXT UNIQUE,
-            target_path TEXT,
-            sync_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        # 创建目录同步记录表
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS synced_dirs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            dir_path TEXT UNIQUE,
-            sync_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        self.db = SyncDatabase(db_path, **db_options)
+        self.notifier = notifier
+        self.event_queue = None
+        # 内容前缀与数据库记录不一致的映射（源目录），这些映射下已同步的文件不能跳过
+        self._stale_prefixes = set()
+        for mapping in dir_mappings:
+            self._check_content_prefix(mapping)
+
+    def start_event_queue(self, settle_seconds=2.0, batch_size=100, workers=4):
+        """
+        启用事件合并队列，之后watchdog回调只负责入队，STRM由后台线程池批量生成
+
+        Args:
+            settle_seconds: 文件静默多久后才生成STRM（秒）
+            batch_size: 每批最多处理的事件数
+            workers: 生成STRM的线程数
+        """
+        self.event_queue = EventCoalescer(self.process_events, settle_seconds, batch_size, workers)
+
+    def add_mapping(self, mapping):
+        """运行中加入映射，源目录相同的映射会被替换"""
+        self.dir_mappings = [m for m in self.dir_mappings if m.source_dir != mapping.source_dir] + [mapping]
+        self.mapping_trie.add(mapping)
+        self._check_content_prefix(mapping)
+
+    def remove_mapping(self, source_dir):
+        """运行中移除映射，之后该目录下的事件不再处理"""
+        self.dir_mappings = [m for m in self.dir_mappings if m.source_dir != source_dir]
+        self.mapping_trie.remove(source_dir)
+        self._stale_prefixes.discard(source_dir)
+
+    def _check_content_prefix(self, mapping):
+        if self.db.get_content_prefix(mapping.source_dir) == mapping.content_prefix:
+            self._stale_prefixes.discard(mapping.source_dir)
+        else:
+            self._stale_prefixes.add(mapping.source_dir)
+
+    def content_prefix_changed(self, mapping):
+        """映射的内容前缀是否与上次完整生成STRM时不同（包括从未完整生成过）"""
+        return mapping.source_dir in self._stale_prefixes
+
+    def mark_content_prefix(self, mapping):
+        """
+        映射下的STRM已全部按当前内容前缀生成（完整扫描或对账成功后调用）
+
+        Args:
+            mapping: 完成扫描的映射，期间被热加载替换时以当前映射为准重新判断
+        """
+        self.db.set_content_prefix(mapping.source_dir, mapping.content_prefix)
+        current = next((m for m in self.dir_mappings if m.source_dir == mapping.source_dir), None)
+        if current is not None:
+            self._check_content_prefix(current)
+
+    def close(self):
+        """关闭处理器，处理完队列中剩余事件并刷新尚未提交的数据库写入"""
+        if self.event_queue is not None:
+            self.event_queue.close()
+            self.event_queue = None
+        self.db.close()
+
+    def classify(self, file_path, size=None):
+        """
+        按所属映射的规则判断文件类型
+
+        Args:
+            file_path: 文件路径
+            size: 文件大小，为None时不检查最小大小
+
+        Returns:
+            str: MediaRules.VIDEO / MediaRules.SIDECAR，不属于任何映射或不需要处理时返回None
+        """
+        mapping = self.find_mapping_for_file(file_path)
+        if mapping is None or file_path == mapping.source_dir:
+            return None
+        return mapping.rules.match(mapping.relative(file_path), size)
+
         
     def on_created(self, event):
         """当检测到新文件创建时触发"""
-        if event.is_directory:
+        if event.is_directory or self.classify(event.src_path) is None:
             return
-            
-        # 获取文件路径
-        file_path = event.src_path
-        
-        # 检查文件扩展名，只处理视频文件
-        video_extensions = [
-            '.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.m4v', '.3gp',
-            '.ts', '.m2ts', '.vob', '.mpg', '.mpeg', '.mp2', '.webm', '.asf',
-            '.rm', '.rmvb', '.ogv', '.divx', '.xvid', '.mxf', '.f4v'
-        ]
-        file_ext = os.path.splitext(file_path)[1].lower()
-        
-        if file_ext in video_extensions:
-            self.create_strm_file(file_path)
+
+        if self.event_queue is not None:
+            self.event_queue.put(event)
+        else:
+            self.create_file(event.src_path)
+
+    def on_moved(self, event):
+        """文件或目录被移动/改名"""
+        # 目录移动时watchdog会为其中每个子项补发移动事件，整个目录已按前缀一次性处理，忽略这些补发事件
+        if getattr(event, 'is_synthetic', False):
+            return
+        if not event.is_directory and self.classify(event.src_path) is None and self.classify(event.dest_path) is None:
+            return
+
+        if self.event_queue is not None:
+            self.event_queue.put(event)
+        else:
+            self.handle_move(event.src_path, event.dest_path, event.is_directory)
+
+    def on_deleted(self, event):
+        """文件或目录被删除"""
+        if getattr(event, 'is_synthetic', False):
+            return
+        if not event.is_directory and self.classify(event.src_path) is None:
+            return
+
+        if self.event_queue is not None:
+            self.event_queue.put(event)
+        else:
+            self.handle_delete(event.src_path, event.is_directory)
+
+    def on_modified(self, event):
+        """文件仍在写入时推迟其处理"""
+        if self.event_queue is not None and not event.is_directory:
+            self.event_queue.touch(event.src_path)
+
+    def process_events(self, events):
+        """
+        处理一批已合并、已稳定的事件
+
+        Args:
+            events: watchdog事件列表
+        """
+        for event in events:
+            try:
+                if event.event_type == 'created':
+                    self.create_file(event.src_path)
+                elif event.event_type == 'moved':
+                    self.handle_move(event.src_path, event.dest_path, event.is_directory)
+                elif event.event_type == 'deleted':
+                    self.handle_delete(event.src_path, event.is_directory)
+            except OSError as e:
+                logger.warning("处理事件失败: %s: %s", event.src_path, e)
     
     def is_file_synced(self, file_path):
         """
@@ -93,238 +1824,1145 @@ class CloudDriveHandler(FileSystemEventHandler):
         Returns:
             bool: 是否已同步
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT id FROM synced_files WHERE source_path = ?", (file_path,))
-        result = cursor.fetchone()
+        return self.db.is_file_synced(file_path)
+    
+    def record_synced_file(self, source_path, target_path):
+        """
+        记录已同步的文件
         
-        conn.close()
-        return result is not None
+        Args:
+            source_path: 源文件路径
+            target_path: 目标STRM文件路径
+        """
+        self.db.record_synced_file(source_path, target_path)
     
-    def is_dir_synced(self, dir_path):
+    def find_mapping_for_file(self, file_path):
         """
-        检查目录是否已经同步过
+        查找文件对应的目录映射
         
         Args:
-            dir_path: 目录的完整路径
+            file_path: 文件路径
             
         Returns:
-            bool: 是否已同步
+            DirectoryMapping: 最长前缀匹配的目录映射，如果没有找到则返回None
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT id FROM synced_dirs WHERE dir_path = ?", (dir_path,))
-        result = cursor.fetchone()
-        
-        conn.close()
-        return result is not None
+        return self.mapping_trie.find(file_path)
     
-    def record_synced_file(self, source_path, target_path):
+    @staticmethod
+    def strm_path_for(mapping, file_path):
+        """源文件对应的STRM文件路径"""
+        rel_path = os.path.relpath(file_path, mapping.source_dir)
+        return os.path.join(mapping.target_dir, os.path.splitext(rel_path)[0] + '.strm')
+
+    @staticmethod
+    def strm_content_for(mapping, file_path):
+        """源文件对应的STRM文件内容"""
+        return os.path.join(mapping.content_prefix, os.path.relpath(file_path, mapping.source_dir))
+
+    def notify_changed(self, mapping):
+        """通知Emby映射下的STRM有变化"""
+        if self.notifier is not None and mapping is not None:
+            self.notifier.touch(mapping)
+
+    def handle_move(self, src_path, dest_path, is_directory):
         """
-        记录已同步的文件
-        
+        处理移动/改名事件
+
+        Args:
+            src_path: 原路径
+            dest_path: 新路径
+            is_directory: 是否为目录
+        """
+        if is_directory:
+            self.move_directory(src_path, dest_path)
+            return
+
+        self.handle_delete(src_path, False)
+        self.create_file(dest_path)
+
+    def handle_delete(self, src_path, is_directory):
+        """
+        处理删除事件，删除对应的STRM文件和同步记录
+
+        Args:
+            src_path: 被删除的路径
+            is_directory: 是否为目录
+        """
+        mapping = self.find_mapping_for_file(src_path)
+        if is_directory:
+            targets = self.db.delete_prefix(src_path)
+            sidecars = []
+            if mapping is not None and src_path != mapping.source_dir:
+                sidecars = self._orphan_sidecars(mapping, os.path.join(mapping.target_dir, mapping.relative(src_path)))
+        elif self.classify(src_path) == MediaRules.SIDECAR:
+            self.remove_sidecar(src_path)
+            return
+        else:
+            target = self.db.delete_file(src_path)
+            targets = [target] if target is not None else []
+            sidecars = []
+            if target is not None and mapping is not None:
+                stem = os.path.splitext(os.path.basename(target))[0]
+                sidecars = self._orphan_sidecars(mapping, os.path.dirname(target), stem)
+        if targets or sidecars:
+            # 附属文件和STRM一起删除，否则目录不为空无法清理
+            self._remove_strm_files(targets + sidecars)
+        if targets:
+            self.notify_changed(mapping)
+            logger.info("已删除 %d 个STRM文件: %s", len(targets), src_path)
+        if sidecars:
+            logger.info("已删除 %d 个附属文件: %s", len(sidecars), src_path)
+
+    def move_directory(self, src_dir, dest_dir):
+        """
+        目录改名/移动：同一映射内直接移动STRM目录并按前缀更新数据库，无需重新扫描
+
+        Args:
+            src_dir: 原目录
+            dest_dir: 新目录
+        """
+        src_mapping = self.find_mapping_for_file(src_dir)
+        dest_mapping = self.find_mapping_for_file(dest_dir)
+        if src_mapping is None or src_mapping is not dest_mapping:
+            # 跨映射或移出/移入监控范围，按删除+新建处理
+            if src_mapping is not None:
+                self.handle_delete(src_dir, True)
+            if dest_mapping is not None:
+                self.sync_directory(dest_dir)
+            return
+
+        mapping = src_mapping
+        old_target_dir = os.path.join(mapping.target_dir, os.path.relpath(src_dir, mapping.source_dir))
+        new_target_dir = os.path.join(mapping.target_dir, os.path.relpath(dest_dir, mapping.source_dir))
+        moved = self.db.move_prefix(src_dir, dest_dir, old_target_dir, new_target_dir)
+
+        # 目标目录不存在时整体改名（连同Emby生成的元数据一起移动），否则逐个移动STRM文件
+        renamed_dir = False
+        if os.path.isdir(old_target_dir) and not os.path.exists(new_target_dir):
+            os.makedirs(os.path.dirname(new_target_dir), exist_ok=True)
+            os.rename(old_target_dir, new_target_dir)
+            renamed_dir = True
+
+        for source_path, old_target, new_target in moved:
+            if not renamed_dir and os.path.exists(old_target):
+                os.makedirs(os.path.dirname(new_target), exist_ok=True)
+                os.replace(old_target, new_target)
+            # STRM内容包含相对路径，需要改写
+            write_strm_atomic(new_target, self.strm_content_for(mapping, source_path))
+        if not renamed_dir:
+            # 附属文件副本不在数据库中，旧目录里的删除，新目录按源文件重新复制
+            sidecars = self._orphan_sidecars(mapping, old_target_dir)
+            if sidecars:
+                self._remove_strm_files(sidecars)
+                for root, dirs, files in os.walk(dest_dir):
+                    for file in files:
+                        path = os.path.join(root, file)
+                        if mapping.rules.match(mapping.relative(path)) == MediaRules.SIDECAR:
+                            self.copy_sidecar(path, mapping)
+            self._prune_empty_dirs([old_target for _, old_target, _ in moved], mapping.target_dir)
+        if moved:
+            self.notify_changed(mapping)
+        logger.info("目录已移动: %s -> %s, 更新 %s 个STRM文件", src_dir, dest_dir, len(moved))
+
+    def sync_directory(self, dir_path):
+        """为目录下所有视频文件创建STRM、复制附属文件（用于移入监控范围的目录）"""
+        for root, dirs, files in os.walk(dir_path):
+            for file in files:
+                self.create_file(os.path.join(root, file))
+
+    def create_file(self, file_path):
+        """按规则处理一个新文件：视频生成STRM，附属文件复制到STRM目录"""
+        mapping = self.find_mapping_for_file(file_path)
+        if mapping is None or file_path == mapping.source_dir:
+            return
+        # 规则只匹配一次，结果连同大小和映射一起传下去
+        rules = mapping.rules
+        kind = rules.match(mapping.relative(file_path))
+        if kind == MediaRules.VIDEO:
+            size = None
+            if rules.min_size:
+                try:
+                    size = os.stat(file_path).st_size
+                except OSError:
+                    return
+                if size < rules.min_size:
+                    return
+            self.create_strm_file(file_path, size, mapping)
+        elif kind == MediaRules.SIDECAR:
+            self.copy_sidecar(file_path, mapping)
+
+    def copy_sidecar(self, file_path, mapping=None):
+        """
+        把字幕、nfo、图片等附属文件复制到对应的STRM目录，大小和修改时间相同则跳过
+
         Args:
-            source_path: 源文件路径
-            target_path: 目标STRM文件路径
+            file_path: 附属文件路径
+            mapping: 所属映射，为None时自动查找
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "INSERT OR REPLACE INTO synced_files (source_path, target_path) VALUES (?, ?)",
-            (source_path, target_path)
-        )
-        
-        conn.commit()
-        conn.close()
-    
-    def record_synced_dir(self, dir_path):
+        mapping = mapping or self.find_mapping_for_file(file_path)
+        if mapping is None:
+            return
+        target_path = os.path.join(mapping.target_dir, mapping.relative(file_path))
+        try:
+            src_stat = os.stat(file_path)
+            try:
+                dst_stat = os.stat(target_path)
+                if dst_stat.st_size == src_stat.st_size and int(dst_stat.st_mtime) == int(src_stat.st_mtime):
+                    return
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            shutil.copy2(file_path, target_path)
+            METRICS.inc('strm_sidecars_copied_total')
+            logger.info("已复制附属文件: %s", target_path)
+        except OSError as e:
+            logger.warning("复制附属文件失败: %s: %s", file_path, e)
+
+    def remove_sidecar(self, file_path):
+        """删除复制到STRM目录的附属文件"""
+        mapping = self.find_mapping_for_file(file_path)
+        if mapping is not None:
+            self._remove_strm_files([os.path.join(mapping.target_dir, mapping.relative(file_path))])
+
+    @staticmethod
+    def _orphan_sidecars(mapping, target_dir, stem=None):
         """
-        记录已同步的目录
-        
+        查找STRM目录中源文件已不存在的附属文件副本
+
         Args:
-            dir_path: 目录路径
+            mapping: 所属映射
+            target_dir: 要检查的STRM目录
+            stem: 只检查以该视频名开头的文件（删除单个视频时），为None时递归检查整个目录
+
+        Returns:
+            list: 附属文件副本路径
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "INSERT OR REPLACE INTO synced_dirs (dir_path) VALUES (?)",
-            (dir_path,)
-        )
-        
-        conn.commit()
-        conn.close()
-    
-    def find_mapping_for_file(self, file_path):
+        sidecars = mapping.rules.sidecars
+        if not sidecars:
+            return []
+        if stem is None:
+            tree = os.walk(target_dir)
+        else:
+            try:
+                tree = [(target_dir, [], os.listdir(target_dir))]
+            except OSError:
+                return []
+        orphans = []
+        for root, _, files in tree:
+            for name in files:
+                if stem is not None and not name.startswith(stem + '.'):
+                    continue
+                if os.path.splitext(name)[1].lower() not in sidecars:
+                    continue
+                path = os.path.join(root, name)
+                if not os.path.exists(os.path.join(mapping.source_dir, os.path.relpath(path, mapping.target_dir))):
+                    orphans.append(path)
+        return orphans
+
+    def _remove_strm_files(self, strm_paths):
+        """删除STRM文件并清理变空的目录"""
+        for strm_path in strm_paths:
+            try:
+                os.remove(strm_path)
+            except FileNotFoundError:
+                pass
+        mapping_roots = [m.target_dir for m in self.dir_mappings]
+        for root in mapping_roots:
+            lower, upper = path_prefix_bounds(root)
+            self._prune_empty_dirs([p for p in strm_paths if lower <= p < upper], root)
+
+    @staticmethod
+    def _prune_empty_dirs(file_paths, stop_dir):
+        """自底向上删除空目录，不会删除stop_dir本身；含有其他文件（如元数据）的目录保留"""
+        dirs = set()
+        for path in file_paths:
+            parent = os.path.dirname(path)
+            while parent != stop_dir and parent.startswith(stop_dir + os.sep) and parent not in dirs:
+                dirs.add(parent)
+                parent = os.path.dirname(parent)
+        for dir_path in sorted(dirs, key=len, reverse=True):
+            try:
+                os.rmdir(dir_path)
+            except OSError:
+                pass
+
+    def prepare_strm(self, file_path, size=None, mapping=None):
         """
-        查找文件对应的目录映射
-        
+        判断文件是否需要生成STRM，单进程和多进程写入共用
+
         Args:
-            file_path: 文件路径
-            
+            file_path: 原始文件的完整路径
+            size: 已知的文件大小，为None且规则要求最小大小时会stat文件
+            mapping: 调用方已按规则判定为视频时传入所属映射，不再重复匹配规则
+
         Returns:
-            DirectoryMapping: 匹配的目录映射，如果没有找到则返回None
+            tuple: (映射, STRM路径, STRM内容)，已同步或不需要生成时返回None
         """
-        for mapping in self.dir_mappings:
-            if file_path.startswith(mapping.source_dir):
-                return mapping
-        return None
-    
-    def create_strm_file(self, file_path):
+        # 检查文件是否已经同步过；内容前缀变化的映射仍要比较STRM内容
+        if self.is_file_synced(file_path):
+            owner = mapping
+            if self._stale_prefixes and owner is None:
+                owner = self.find_mapping_for_file(file_path)
+            if owner is None or not self.content_prefix_changed(owner):
+                logger.debug("文件已同步过，跳过: %s", file_path)
+                return None
+
+        if mapping is None:
+            # 查找对应的目录映射
+            mapping = self.find_mapping_for_file(file_path)
+            if not mapping:
+                logger.warning("找不到文件的目录映射，跳过: %s", file_path)
+                return None
+            # 配置了最小大小时检查文件大小
+            if mapping.rules.min_size and size is None:
+                try:
+                    size = os.stat(file_path).st_size
+                except OSError:
+                    return None
+            if mapping.rules.match(mapping.relative(file_path), size) != MediaRules.VIDEO:
+                return None
+
+        return mapping, self.strm_path_for(mapping, file_path), self.strm_content_for(mapping, file_path)
+
+    def create_strm_file(self, file_path, size=None, mapping=None):
         """
         为指定文件创建STRM文件
+
+        已存在的STRM会比较内容，只有内容变化时才原子替换。
         
         Args:
             file_path: 原始文件的完整路径
+            size: 已知的文件大小，为None且规则要求最小大小时会stat文件
+            mapping: 调用方已按规则判定为视频时传入所属映射
+
+        Returns:
+            str: created / updated / unchanged，跳过时返回None
         """
-        # 检查文件是否已经同步过
-        if self.is_file_synced(file_path):
-            print(f"文件已同步过，跳过: {file_path}")
-            return
-        
-        # 查找对应的目录映射
-        mapping = self.find_mapping_for_file(file_path)
-        if not mapping:
-            print(f"找不到文件的目录映射，跳过: {file_path}")
-            return
-            
-        # 获取相对路径
-        rel_path = os.path.relpath(file_path, mapping.source_dir)
-        
-        # 构建目标STRM文件路径
-        strm_path = os.path.join(mapping.target_dir, os.path.splitext(rel_path)[0] + '.strm')
+        prepared = self.prepare_strm(file_path, size, mapping)
+        if prepared is None:
+            return None
+        mapping, strm_path, content_path = prepared
         
-        # 检查STRM文件是否已存在
-        if os.path.exists(strm_path):
-            print(f"STRM文件已存在，跳过: {strm_path}")
-            # 记录到数据库
-            self.record_synced_file(file_path, strm_path)
-            return
-        
-        # 确保目标目录存在
-        os.makedirs(os.path.dirname(strm_path), exist_ok=True)
-        
-        # 构建STRM文件内容
-        content_path = os.path.join(mapping.content_prefix, rel_path)
-        
-        # 写入STRM文件
-        with open(strm_path, 'w', encoding='utf-8') as f:
-            f.write(content_path)
+        # 写入STRM文件，内容相同则跳过
+        result = write_strm_atomic(strm_path, content_path)
             
         # 记录到数据库
         self.record_synced_file(file_path, strm_path)
-        
-        print(f"已创建STRM文件: {strm_path} -> {content_path}")
+        METRICS.inc('strm_files_written_total', result=result)
+
+        if result == 'unchanged':
+            logger.debug("STRM文件已存在，跳过: %s", strm_path)
+        else:
+            self.notify_changed(mapping)
+            action = "已创建" if result == 'created' else "已更新"
+            logger.info("%sSTRM文件: %s -> %s", action, strm_path, content_path)
+        return result
 
-def scan_existing_files(dir_mappings, db_path):
+def scan_existing_files(dir_mappings, db_path, scan_workers=4, full_scan=False, notifier=None, write_workers=0,
+                        **db_options):
     """
     扫描现有文件并创建STRM文件
+
+    每个目录的mtime/inode会记录到dir_snapshots表，再次扫描时快照未变化的目录
+    不会重新列目录，只检查其已知子目录，因此未变化的目录树几乎没有开销。
     
     Args:
         dir_mappings: 目录映射列表
         db_path: SQLite数据库路径
+        scan_workers: 每个映射默认的并发列目录数（映射自身的scan_concurrency优先）
+        full_scan: 是否忽略目录快照，重新列出所有目录
+        notifier: EmbyNotifier，为None时不通知Emby
+        write_workers: 写STRM文件的进程数，小于2时在扫描线程中直接写
+        db_options: 传给SyncDatabase的参数
     """
-    handler = CloudDriveHandler(dir_mappings, db_path)
-    
-    video_extensions = [
-        '.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.m4v', '.3gp',
-        '.ts', '.m2ts', '.vob', '.mpg', '.mpeg', '.mp2', '.webm', '.asf',
-        '.rm', '.rmvb', '.ogv', '.divx', '.xvid', '.mxf', '.f4v'
-    ]
-    
-    for mapping in dir_mappings:
-        source_dir = mapping.source_dir
-        print(f"扫描目录: {source_dir}")
-        for root, dirs, files in os.walk(source_dir):
-            # 检查当前目录是否已同步过
-            if handler.is_dir_synced(root):
-                print(f"目录已同步过，跳过: {root}")
-                dirs[:] = []  # 清空dirs列表，阻止os.walk继续遍历子目录
+    handler = CloudDriveHandler(dir_mappings, db_path, notifier, **db_options)
+    writer = ShardedStrmWriter(handler, write_workers) if write_workers > 1 else StrmWriter(handler)
+    completed = False
+    try:
+        _scan_mappings(handler, dir_mappings, scan_workers, full_scan, writer)
+        completed = True
+    finally:
+        writer.close()
+        if completed and not writer.counts['failed']:
+            for mapping in dir_mappings:
+                handler.mark_content_prefix(mapping)
+        handler.close()
+
+def _write_strm_batch(items):
+    """
+    在子进程中写一批STRM文件
+
+    Args:
+        items: (源文件路径, STRM路径, STRM内容) 列表
+
+    Returns:
+        list: (源文件路径, STRM路径, 结果) 列表，结果为 created / updated / unchanged
+    """
+    return [(source_path, strm_path, write_strm_atomic(strm_path, content))
+            for source_path, strm_path, content in items]
+
+class StrmWriter:
+    """扫描时为视频文件生成STRM的默认实现：在扫描线程中直接写"""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self._count_lock = threading.Lock()
+        self.counts = {'created': 0, 'updated': 0, 'unchanged': 0, 'failed': 0}
+
+    def _count(self, result, n=1):
+        with self._count_lock:
+            self.counts[result] += n
+
+    def submit(self, file_path, size=None, mapping=None):
+        """
+        为源文件生成STRM
+
+        Args:
+            file_path: 源文件路径
+            size: 已知的文件大小（用于最小大小规则）
+            mapping: 调用方已按规则判定为视频时传入所属映射
+        """
+        result = self.handler.create_strm_file(file_path, size, mapping)
+        if result is not None:
+            self._count(result)
+
+    def finish_dir(self, dir_path, mtime_ns, inode):
+        """目录中的文件都已提交，记录目录快照"""
+        self.handler.db.record_dir_snapshot(dir_path, mtime_ns, inode)
+
+    def close(self):
+        pass
+
+class ShardedStrmWriter(StrmWriter):
+    """
+    多进程写STRM文件
+
+    候选文件按目标目录的哈希分片，同一目录总是落在同一分片，每个分片同一时间只有一个批次在子进程中执行，
+    子进程只负责建目录和写文件；数据库只由主进程写入，批次完成后才记录同步结果。
+    目录快照要等该目录下所有文件都写完后才记录，中途中断后重新扫描会从未完成的目录继续。
+    """
+
+    def __init__(self, handler, workers, batch_size=256):
+        """
+        Args:
+            handler: CloudDriveHandler
+            workers: 进程数
+            batch_size: 每批交给子进程的文件数
+        """
+        super().__init__(handler)
+        self.workers = workers
+        self.batch_size = batch_size
+        # 扫描线程和数据库刷新线程已在运行，直接fork子进程可能继承被占用的锁，优先使用forkserver
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver') if 'forkserver' in methods else None
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        self._cond = threading.Condition()
+        self._buffers = [[] for _ in range(workers)]
+        self._busy = [False] * workers
+        self._dir_pending = {}
+        self._dir_snapshots = {}
+
+    def submit(self, file_path, size=None, mapping=None):
+        prepared = self.handler.prepare_strm(file_path, size, mapping)
+        if prepared is None:
+            return
+        _, strm_path, content = prepared
+        dir_path = os.path.dirname(file_path)
+        shard = zlib.crc32(os.path.dirname(strm_path).encode('utf-8', 'surrogateescape')) % self.workers
+
+        with self._cond:
+            # 分片积压过多时等待，限制内存占用
+            while len(self._buffers[shard]) >= self.batch_size * 8:
+                self._cond.wait()
+            self._buffers[shard].append((file_path, strm_path, content))
+            self._dir_pending[dir_path] = self._dir_pending.get(dir_path, 0) + 1
+            if not self._busy[shard] and len(self._buffers[shard]) >= self.batch_size:
+                self._dispatch(shard)
+
+    def finish_dir(self, dir_path, mtime_ns, inode):
+        with self._cond:
+            if self._dir_pending.get(dir_path):
+                self._dir_snapshots[dir_path] = (mtime_ns, inode)
+                return
+        super().finish_dir(dir_path, mtime_ns, inode)
+
+    def _dispatch(self, shard):
+        """把分片缓冲交给子进程，调用时需持有锁"""
+        items = self._buffers[shard][:self.batch_size]
+        del self._buffers[shard][:self.batch_size]
+        self._busy[shard] = True
+        try:
+            future = self.pool.submit(_write_strm_batch, items)
+        except Exception as e:
+            # 进程池已损坏时按批次失败处理，保证close不会一直等待
+            future = Future()
+            future.set_exception(e)
+        future.add_done_callback(lambda f: self._on_done(shard, items, f))
+
+    def _on_done(self, shard, items, future):
+        """批次完成：记录同步结果，目录全部完成时记录快照，并继续派发该分片"""
+        try:
+            results = future.result()
+        except Exception as e:
+            logger.error("写入STRM批次失败: %s", e)
+            results = []
+            self._count('failed', len(items))
+            METRICS.inc('strm_files_written_total', len(items), result='failed')
+
+        for source_path, strm_path, result in results:
+            self.handler.record_synced_file(source_path, strm_path)
+            self._count(result)
+            METRICS.inc('strm_files_written_total', result=result)
+            if result != 'unchanged':
+                self.handler.notify_changed(self.handler.find_mapping_for_file(source_path))
+
+        finished = []
+        with self._cond:
+            for source_path, _, _ in items:
+                dir_path = os.path.dirname(source_path)
+                self._dir_pending[dir_path] -= 1
+                if not self._dir_pending[dir_path]:
+                    del self._dir_pending[dir_path]
+                    snapshot = self._dir_snapshots.pop(dir_path, None)
+                    # 失败的批次不记录快照，下次扫描会重新处理该目录
+                    if snapshot is not None and results:
+                        finished.append((dir_path, snapshot))
+            self._busy[shard] = False
+            if self._buffers[shard]:
+                self._dispatch(shard)
+            self._cond.notify_all()
+
+        for dir_path, snapshot in finished:
+            super().finish_dir(dir_path, *snapshot)
+
+    def close(self):
+        """派发剩余缓冲并等待所有批次完成"""
+        with self._cond:
+            for shard in range(self.workers):
+                if self._buffers[shard] and not self._busy[shard]:
+                    self._dispatch(shard)
+            while any(self._busy):
+                self._cond.wait()
+        self.pool.shutdown(wait=True)
+        counts = self.counts
+        logger.info("多进程写入STRM: 新建 %s, 更新 %s, 未变化 %s, 失败 %s",
+                    counts['created'], counts['updated'], counts['unchanged'], counts['failed'])
+
+def _scan_directory(handler, mapping, dir_path, snapshots, children, writer):
+    """
+    扫描单个目录，为其中的视频文件创建STRM
+
+    目录快照未变化时不列目录，直接返回快照中记录的子目录。
+
+    Args:
+        handler: CloudDriveHandler
+        mapping: 目录所属的DirectoryMapping
+        dir_path: 目录路径
+        snapshots: 上次扫描的目录快照
+        children: 上次扫描的子目录关系
+        writer: StrmWriter
+
+    Returns:
+        list: 需要继续检查的子目录
+    """
+    try:
+        st = os.stat(dir_path)
+    except OSError:
+        # 目录已不存在，清理其快照
+        if dir_path in snapshots:
+            handler.db.delete_dir_snapshots(dir_path)
+        return []
+
+    old = snapshots.get(dir_path)
+    if old is not None and old[0] == st.st_mtime_ns and old[1] == st.st_ino:
+        METRICS.inc('strm_scan_dirs_unchanged_total', mapping=mapping.source_dir)
+        return children.get(dir_path, [])
+
+    try:
+        with os.scandir(dir_path) as it:
+            entries = list(it)
+    except OSError as e:
+        logger.warning("读取目录失败，跳过: %s: %s", dir_path, e)
+        return []
+    METRICS.inc('strm_scan_dirs_listed_total', mapping=mapping.source_dir)
+
+    subdirs = []
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            # 与os.walk默认行为一致，不进入符号链接目录
+            if not entry.is_symlink():
+                subdirs.append(entry.path)
+            continue
+
+        rules = mapping.rules
+        rel_path = mapping.relative(entry.path)
+        kind = rules.match(rel_path)
+        if kind == MediaRules.VIDEO:
+            size = None
+            if rules.min_size:
+                try:
+                    size = entry.stat().st_size
+                except OSError:
+                    continue
+                if size < rules.min_size:
+                    continue
+            writer.submit(entry.path, size, mapping)
+        elif kind == MediaRules.SIDECAR:
+            handler.copy_sidecar(entry.path, mapping)
+
+    METRICS.inc('strm_scan_files_seen_total', len(entries) - len(subdirs), mapping=mapping.source_dir)
+
+    # 清理已经消失的子目录的快照
+    if old is not None:
+        current = set(subdirs)
+        for child in children.get(dir_path, []):
+            if child not in current:
+                handler.db.delete_dir_snapshots(child)
+
+    # 使用列目录前的stat结果，列目录期间发生的变化会在下次扫描时被发现
+    writer.finish_dir(dir_path, st.st_mtime_ns, st.st_ino)
+    return subdirs
+
+def _scan_mappings(handler, dir_mappings, default_concurrency=4, full_scan=False, writer=None):
+    """
+    并发遍历所有映射的源目录
+
+    每个映射使用独立的线程池，并发数由映射的scan_concurrency决定，
+    这样同一个挂载点的列目录请求数有上限，多个挂载点之间互不阻塞。
+    """
+    writer = writer or StrmWriter(handler)
+    pools = []
+    done_queue = queue.Queue()
+    outstanding = 0
+    # 每个映射待列出的目录数和开始时间，用于扫描进度指标
+    pending = {}
+    started = {}
+
+    def submit(pool, mapping, dir_path, snapshots, children):
+        nonlocal outstanding
+        future = pool.submit(_scan_directory, handler, mapping, dir_path, snapshots, children, writer)
+        future.add_done_callback(lambda f: done_queue.put((pool, mapping, snapshots, children, f)))
+        outstanding += 1
+        pending[mapping.source_dir] = pending.get(mapping.source_dir, 0) + 1
+
+    try:
+        for mapping in dir_mappings:
+            workers = max(1, mapping.scan_concurrency or default_concurrency)
+            if full_scan or handler.content_prefix_changed(mapping):
+                # 内容前缀变化时目录快照不能用来跳过目录，已有STRM都要检查一遍
+                snapshots, children = {}, {}
+            else:
+                snapshots, children = handler.db.load_dir_snapshots(mapping.source_dir)
+            pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scan")
+            pools.append(pool)
+            logger.info("扫描目录: %s (并发: %s, 已有快照: %s)", mapping.source_dir, workers, len(snapshots))
+            started[mapping.source_dir] = time.monotonic()
+            submit(pool, mapping, mapping.source_dir, snapshots, children)
+
+        while outstanding:
+            pool, mapping, snapshots, children, future = done_queue.get()
+            outstanding -= 1
+            pending[mapping.source_dir] -= 1
+            for subdir in future.result():
+                submit(pool, mapping, subdir, snapshots, children)
+            METRICS.set('strm_scan_pending_dirs', pending[mapping.source_dir], mapping=mapping.source_dir)
+            if not pending[mapping.source_dir]:
+                METRICS.set('strm_scan_duration_seconds', time.monotonic() - started[mapping.source_dir],
+                            mapping=mapping.source_dir)
+    finally:
+        for pool in pools:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+def _iter_sorted_tree(root, accept):
+    """
+    按路径分量的字典序遍历目录树
+
+    文件以去掉扩展名后的相对路径分量元组作为键，源目录树和STRM目录树的键可以直接比较，
+    两边用同样的顺序遍历即可做归并对比。
+
+    Args:
+        root: 根目录
+        accept: 判断文件是否需要的函数，参数为 (完整路径, 小写扩展名)
+
+    Yields:
+        tuple: (键, 文件完整路径)
+    """
+    def walk(dir_path, prefix):
+        try:
+            with os.scandir(dir_path) as it:
+                entries = list(it)
+        except OSError as e:
+            logger.warning("读取目录失败，跳过: %s: %s", dir_path, e)
+            return
+        items = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
                 continue
-            
-            # 处理当前目录中的文件
-            has_video_files = False
-            for file in files:
-                file_ext = os.path.splitext(file)[1].lower()
-                if file_ext in video_extensions:
-                    has_video_files = True
-                    file_path = os.path.join(root, file)
-                    handler.create_strm_file(file_path)
-            
-            # 如果当前目录包含视频文件，标记为已同步
-            if has_video_files:
-                handler.record_synced_dir(root)
+            if is_dir:
+                items.append((entry.name, 1, entry.name, entry.path))
+            else:
+                stem, ext = os.path.splitext(entry.name)
+                if accept(entry.path, ext.lower()):
+                    items.append((stem, 0, entry.name, entry.path))
+        # 同名时文件排在目录前面，与元组比较 ('a',) < ('a', 'x') 的顺序一致
+        items.sort()
+        for key, is_dir, _, path in items:
+            if is_dir:
+                yield from walk(path, prefix + (key,))
+            else:
+                yield prefix + (key,), path
+
+    return walk(root, ())
 
-def notify_emby_scan(emby_url, api_key, library_name=None):
+def reconcile_mapping(handler, mapping, writer=None):
     """
-    通知Emby服务器扫描媒体库
-    
+    对比源目录树和STRM目录树，修复缺失、多余和内容不一致的STRM文件
+
+    两棵树按相同顺序流式遍历并归并对比，内存占用与目录树大小无关。
+    有源文件的STRM交给writer写入（内容相同的不会重写），该映射的同步记录会按对比结果重建；
+    writer为None时只统计不修改。
+
     Args:
-        emby_url: Emby服务器URL，例如 http://localhost:8096
-        api_key: Emby API密钥
-        library_name: 要扫描的媒体库名称，如果为None则扫描所有媒体库
-        
+        handler: CloudDriveHandler
+        mapping: DirectoryMapping
+        writer: StrmWriter，为None时为只读模式
+
     Returns:
-        bool: 是否成功通知
+        dict: missing / orphaned 的数量，只读模式下还有 mismatched / ok
     """
-    if not emby_url or not api_key:
-        print("未提供Emby服务器URL或API密钥，跳过通知")
-        return False
-    
-    # 移除URL末尾的斜杠
-    emby_url = emby_url.rstrip('/')
-    
+    dry_run = writer is None
+    stats = {'missing': 0, 'orphaned': 0, 'mismatched': 0, 'ok': 0}
+    rules = mapping.rules
+
+    def is_source_video(path, ext):
+        if ext not in rules.extensions:
+            return False
+        if rules.match(mapping.relative(path)) != MediaRules.VIDEO:
+            return False
+        if rules.min_size:
+            try:
+                return os.stat(path).st_size >= rules.min_size
+            except OSError:
+                return False
+        return True
+
+    source_iter = _iter_sorted_tree(mapping.source_dir, is_source_video)
+    target_iter = _iter_sorted_tree(mapping.target_dir, lambda path, ext: ext == '.strm')
+
+    if not dry_run:
+        handler.db.clear_prefix(mapping.source_dir)
+
+    orphans = []
+    source = next(source_iter, None)
+    target = next(target_iter, None)
+    while source is not None or target is not None:
+        if target is None or (source is not None and source[0] < target[0]):
+            # 源文件没有对应的STRM
+            stats['missing'] += 1
+            key, source_path = source
+            if not dry_run:
+                writer.submit(source_path, mapping=mapping)
+        elif source is None or target[0] < source[0]:
+            # STRM没有对应的源文件
+            stats['orphaned'] += 1
+            key = target[0]
+            orphans.append(target[1])
+            target = next(target_iter, None)
+            continue
+        else:
+            key, source_path = source
+            if dry_run:
+                expected = handler.strm_content_for(mapping, source_path).encode('utf-8')
+                stats['ok' if strm_content_matches(target[1], expected) else 'mismatched'] += 1
+            else:
+                writer.submit(source_path, mapping=mapping)
+            target = next(target_iter, None)
+
+        # 扩展名不同的同名视频对应同一个STRM，只保留排序在前的那个
+        source = next(source_iter, None)
+        while source is not None and source[0] == key:
+            source = next(source_iter, None)
+
+    if orphans and not dry_run:
+        handler._remove_strm_files(orphans)
+    return stats
+
+def reconcile(dir_mappings, db_path, dry_run=False, notifier=None, write_workers=0, **db_options):
+    """
+    对所有映射执行对账
+
+    Args:
+        dir_mappings: 目录映射列表
+        db_path: SQLite数据库路径
+        dry_run: 只统计不修改
+        notifier: EmbyNotifier，为None时不通知Emby
+        write_workers: 写STRM文件的进程数，小于2时在当前线程直接写
+        db_options: 传给SyncDatabase的参数
+    """
+    handler = CloudDriveHandler(dir_mappings, db_path, notifier, **db_options)
     try:
-        # 如果指定了媒体库名称，先获取媒体库ID
-        if library_name:
-            # 获取所有媒体库
-            libraries_url = f"{emby_url}/emby/Library/VirtualFolders?api_key={api_key}"
-            response = requests.get(libraries_url, timeout=10)
-            response.raise_for_status()
-            
-            libraries = response.json()
-            library_id = None
-            
-            # 查找指定名称的媒体库
-            for library in libraries:
-                if library.get('Name') == library_name:
-                    library_id = library.get('ItemId')
-                    break
-            
-            if not library_id:
-                print(f"找不到名为 '{library_name}' 的媒体库，将扫描所有媒体库")
-                library_name = None
-        
-        # 构建扫描URL
-        if library_name and library_id:
-            # 扫描指定媒体库
-            scan_url = f"{emby_url}/emby/Library/VirtualFolders/LibraryScan?api_key={api_key}&ItemId={library_id}"
-            print(f"正在通知Emby扫描媒体库: {library_name}")
+        for mapping in dir_mappings:
+            logger.info("对账: %s -> %s", mapping.source_dir, mapping.target_dir)
+            start = time.monotonic()
+            if dry_run:
+                stats = reconcile_mapping(handler, mapping)
+                logger.info("  发现: 缺失 %s, 多余 %s, 内容不一致 %s, 正常 %s, 耗时 %.1fs",
+                            stats['missing'], stats['orphaned'], stats['mismatched'], stats['ok'],
+                            time.monotonic() - start)
+                continue
+
+            writer = ShardedStrmWriter(handler, write_workers) if write_workers > 1 else StrmWriter(handler)
+            try:
+                stats = reconcile_mapping(handler, mapping, writer)
+            finally:
+                writer.close()
+            if not writer.counts['failed']:
+                handler.mark_content_prefix(mapping)
+            if stats['orphaned']:
+                handler.notify_changed(mapping)
+            counts = writer.counts
+            logger.info("  修复: 新建 %s, 删除多余 %s, 改写内容不一致 %s, 正常 %s, 失败 %s, 耗时 %.1fs",
+                        counts['created'], stats['orphaned'], counts['updated'], counts['unchanged'], counts['failed'],
+                        time.monotonic() - start)
+    finally:
+        handler.close()
+
+def load_service_config(path):
+    """
+    读取服务模式的配置文件（YAML或JSON）
+
+    格式:
+        db: /var/lib/strm/strm_monitor.db       # 可选，默认使用 --db
+        scan: true                              # 启动时扫描全部映射
+        rules: {min_size: 10485760, sidecars: [.srt, .ass, .nfo]}
+        emby: {url: http://localhost:8096, api_key: xxx, window: 300, delay: 30}
+        mappings:
+          - source: /mnt/cloud/tv
+            target: /strm/tv
+            content_prefix: http://alist:5244/d/tv   # 可选
+            scan_concurrency: 8                      # 可选
+            watch: poll                              # 可选，inotify或poll
+            emby_library: 电视剧                      # 可选
+            rules: {min_size: 0}                     # 可选，覆盖默认规则中的对应项
+
+    Args:
+        path: 配置文件路径
+
+    Returns:
+        dict: 配置内容，其中mappings转换为 {源目录: (DirectoryMapping, 布局指纹)}，
+              布局指纹相同表示目标目录、内容前缀和规则都没有变化；mtime_ns为读取前文件的修改时间
+
+    Raises:
+        ValueError: 配置内容不正确
+    """
+    mtime_ns = os.stat(path).st_mtime_ns
+    config = load_config_file(path)
+    if not isinstance(config, dict):
+        raise ValueError("配置文件顶层必须是字典")
+    default_config = config.get('rules') or {}
+    default_rules = MediaRules.from_dict(default_config)
+
+    mappings = {}
+    for item in config.get('mappings') or []:
+        if not isinstance(item, dict) or not item.get('source') or not item.get('target'):
+            raise ValueError(f"映射必须包含source和target: {item}")
+        watch_mode = item.get('watch', 'inotify')
+        if watch_mode not in ('inotify', 'poll'):
+            raise ValueError(f"监控方式必须是 inotify 或 poll: {item}")
+        scan_concurrency = item.get('scan_concurrency')
+        if scan_concurrency is not None and (not isinstance(scan_concurrency, int) or scan_concurrency < 1):
+            raise ValueError(f"扫描并发数必须是正整数: {item}")
+        rule_config = item.get('rules') or {}
+        mapping = DirectoryMapping(
+            item['source'], item['target'], item.get('content_prefix'), scan_concurrency, watch_mode,
+            item.get('emby_library'), MediaRules.from_dict(rule_config, default_rules)
+        )
+        if mapping.source_dir in mappings:
+            raise ValueError(f"源目录重复: {mapping.source_dir}")
+        layout = json.dumps([mapping.target_dir, mapping.content_prefix, default_config, rule_config],
+                            sort_keys=True, default=str)
+        mappings[mapping.source_dir] = (mapping, layout)
+
+    config['mappings'] = mappings
+    config['mtime_ns'] = mtime_ns
+    return config
+
+class StrmService:
+    """
+    常驻监控服务：所有映射共用一个CloudDriveHandler（同一个数据库连接和内存索引）和一个Observer
+
+    映射可以在运行中增删改：新增的映射加入监控后只扫描该映射；目标目录、内容前缀或规则变化的映射
+    重新对账；删除的映射停止监控，已生成的STRM和同步记录保留。其他映射的监控和索引不受影响。
+    扫描和对账任务在单独的线程中依次执行，执行期间的文件事件照常处理。
+    """
+
+    def __init__(self, db_path, emby=None, config_path=None, config_mtime=None, write_workers=0, scan_workers=4,
+                 settle_seconds=2.0, event_batch=100, event_workers=4, poll_interval=5.0, poll_max_interval=300.0,
+                 poll_full_stat=False, **db_options):
+        """
+        Args:
+            db_path: SQLite数据库路径
+            emby: 默认Emby配置 {url, api_key, window, delay}，配置文件中没有emby时使用
+            config_path: 配置文件路径，为None时不支持热加载
+            config_mtime: 启动时读取的配置文件的修改时间
+            write_workers: 扫描/对账时写STRM文件的进程数
+            scan_workers: 扫描时每个映射默认的并发列目录数
+            settle_seconds/event_batch/event_workers: 事件合并队列参数
+            poll_interval/poll_max_interval: 轮询模式的最短/最长间隔（秒）
+            poll_full_stat: 轮询模式不信任目录mtime，每次检查都列目录并stat所有条目
+            db_options: 传给SyncDatabase的参数
+        """
+        self.config_path = config_path
+        self.write_workers = write_workers
+        self.scan_workers = scan_workers
+        self.poll_interval = poll_interval
+        self.poll_max_interval = poll_max_interval
+        self.poll_full_stat = poll_full_stat
+        self.started = time.time()
+
+        self.handler = CloudDriveHandler([], db_path, **db_options)
+        self.handler.start_event_queue(settle_seconds, event_batch, event_workers)
+        self.observer = Observer()
+        self.jobs = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mapping-job")
+        # 源目录 -> (DirectoryMapping, 布局指纹)
+        self._specs = {}
+        # 源目录 -> ObservedWatch 或 PollingWatcher
+        self._watches = {}
+        self._lock = threading.Lock()
+        self._config_mtime = config_mtime
+        self.default_emby = emby
+        self._emby_config = None
+        self._stop_event = threading.Event()
+        self._reload_event = threading.Event()
+        self.set_emby(emby)
+
+    def start(self, mappings, scan=False, full_scan=False):
+        """
+        启动监控
+
+        Args:
+            mappings: {源目录: (DirectoryMapping, 布局指纹)}
+            scan: 是否扫描全部映射（在开始监控之后进行，扫描期间的变化不会遗漏）
+            full_scan: 扫描时是否忽略目录快照
+        """
+        self.observer.start()
+        self.apply_mappings(mappings, scan_new=scan, full_scan=full_scan)
+
+    def _watch(self, mapping):
+        if mapping.watch_mode == 'poll':
+            poller = PollingWatcher(mapping, self.handler, self.poll_interval, self.poll_max_interval,
+                                    self.poll_full_stat)
+            poller.start()
+            self._watches[mapping.source_dir] = poller
+            logger.info("已设置轮询监控: %s -> %s", mapping.source_dir, mapping.target_dir)
         else:
-            # 扫描所有媒体库
-            scan_url = f"{emby_url}/emby/Library/Refresh?api_key={api_key}"
-            print("正在通知Emby扫描所有媒体库")
-        
-        # 发送扫描请求
-        response = requests.post(scan_url, timeout=10)
-        response.raise_for_status()
-        
-        print("已成功通知Emby开始扫描")
-        return True
-        
-    except requests.exceptions.RequestException as e:
-        print(f"通知Emby扫描失败: {str(e)}")
-        return False
+            self._watches[mapping.source_dir] = self.observer.schedule(self.handler, mapping.source_dir, recursive=True)
+            logger.info("已设置监控: %s -> %s", mapping.source_dir, mapping.target_dir)
+        if mapping.content_prefix != mapping.source_dir:
+            logger.info("  STRM内容前缀: %s", mapping.content_prefix)
+
+    def _unwatch(self, source_dir):
+        watch = self._watches.pop(source_dir, None)
+        if isinstance(watch, PollingWatcher):
+            watch.stop()
+            watch.join()
+        elif watch is not None:
+            self.observer.unschedule(watch)
+
+    def apply_mappings(self, mappings, scan_new=True, full_scan=False):
+        """
+        按新的映射集合调整监控，只处理有变化的映射
+
+        Args:
+            mappings: {源目录: (DirectoryMapping, 布局指纹)}
+            scan_new: 新增的映射是否扫描
+            full_scan: 扫描时是否忽略目录快照
+        """
+        with self._lock:
+            for source_dir in list(self._specs):
+                if source_dir not in mappings:
+                    self._unwatch(source_dir)
+                    self.handler.remove_mapping(source_dir)
+                    del self._specs[source_dir]
+                    logger.info("已移除映射: %s", source_dir)
+
+            for source_dir, (mapping, layout) in mappings.items():
+                if not os.path.isdir(source_dir):
+                    logger.error("错误: 源目录 '%s' 不存在，跳过该映射", source_dir)
+                    continue
+                os.makedirs(mapping.target_dir, exist_ok=True)
+                old = self._specs.get(source_dir)
+                self._specs[source_dir] = (mapping, layout)
+                self.handler.add_mapping(mapping)
+                if old is None:
+                    self._watch(mapping)
+                    if scan_new:
+                        self._submit_job('scan', source_dir, layout, full_scan)
+                    continue
+                old_mapping, old_layout = old
+                # 轮询监控按映射的规则过滤文件，布局（含规则）变化时也要重建
+                if old_mapping.watch_mode != mapping.watch_mode or \
+                        (mapping.watch_mode == 'poll' and old_layout != layout):
+                    self._unwatch(source_dir)
+                    self._watch(mapping)
+                if old_layout != layout:
+                    logger.info("映射已变化，重新对账: %s -> %s", source_dir, mapping.target_dir)
+                    self._submit_job('reconcile', source_dir, layout)
+
+    def _submit_job(self, kind, source_dir, layout, full_scan=False):
+        self.jobs.submit(self._run_job, kind, source_dir, layout, full_scan)
+
+    def _run_job(self, kind, source_dir, layout, full_scan=False):
+        """
+        在任务线程中扫描或对账单个映射
+
+        任务按提交时的布局指纹判断是否仍然有效：热加载会为未变化的映射创建新的映射对象，
+        布局相同时任务继续执行（使用当前的映射对象），布局变化或映射删除时放弃，由新提交的对账任务处理。
+        """
+        with self._lock:
+            spec = self._specs.get(source_dir)
+        if spec is None or spec[1] != layout or self._stop_event.is_set():
+            # 任务排队期间映射的布局已变化或映射已删除
+            return
+        mapping = spec[0]
+        handler = self.handler
+        writer = ShardedStrmWriter(handler, self.write_workers) if self.write_workers > 1 else StrmWriter(handler)
+        action = '扫描' if kind == 'scan' else '对账'
+        start = time.monotonic()
+        completed = False
+        try:
+            if kind == 'scan':
+                _scan_mappings(handler, [mapping], self.scan_workers, full_scan, writer)
+            else:
+                stats = reconcile_mapping(handler, mapping, writer)
+                if stats['orphaned']:
+                    handler.notify_changed(mapping)
+            completed = True
+        except Exception as e:
+            logger.error("%s失败: %s: %s", action, mapping.source_dir, e)
+        finally:
+            writer.close()
+        if completed and not writer.counts['failed']:
+            handler.mark_content_prefix(mapping)
+        counts = writer.counts
+        logger.info("%s完成: %s, 新建 %s, 更新 %s, 失败 %s, 耗时 %.1fs",
+                    action, mapping.source_dir, counts['created'], counts['updated'], counts['failed'],
+                    time.monotonic() - start)
+
+    def set_emby(self, emby_config):
+        """按配置替换Emby通知器，配置未变化时不做任何事"""
+        emby_config = emby_config or None
+        if emby_config == self._emby_config:
+            return
+        self._emby_config = emby_config
+        old = self.handler.notifier
+        notifier = EmbyNotifier.from_config(emby_config)
+        self.handler.notifier = notifier
+        if old is not None:
+            old.close()
+        logger.info("已更新Emby配置" if notifier else "未配置Emby，不通知Emby刷新")
+
+    def reload_if_changed(self, force=False):
+        """
+        配置文件的修改时间变化（或force）时重新加载，配置不正确时保留当前配置
+
+        只有mappings、rules和emby会热加载，db等其他配置需要重启服务。
+        """
+        if self.config_path is None:
+            return
+        try:
+            mtime = os.stat(self.config_path).st_mtime_ns
+        except OSError:
+            return
+        if not force and mtime == self._config_mtime:
+            return
+        # 出错时也记下修改时间，文件再次修改前不重复报错
+        self._config_mtime = mtime
+        logger.info("重新加载配置: %s", self.config_path)
+        try:
+            config = load_service_config(self.config_path)
+        except (Exception, SystemExit) as e:
+            # YAML语法错误等都不应让常驻服务退出
+            logger.error("加载配置失败，保留当前配置: %s: %s", self.config_path, e)
+            return
+        self._config_mtime = config['mtime_ns']
+        self.set_emby(config.get('emby') or self.default_emby)
+        if self.handler.notifier is not None:
+            self.handler.notifier.clear_library_cache()
+        self.apply_mappings(config['mappings'])
+
+    def request_reload(self):
+        """请求在主循环中重新加载配置（可在信号处理函数中调用）"""
+        self._reload_event.set()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self, reload_interval=5.0):
+        """主循环：定期检查配置文件变化，队列有积压时输出队列状态，直到stop"""
+        last_check = last_report = time.monotonic()
+        while not self._stop_event.wait(1):
+            now = time.monotonic()
+            if self._reload_event.is_set() or now - last_check >= reload_interval:
+                force = self._reload_event.is_set()
+                self._reload_event.clear()
+                last_check = now
+                self.reload_if_changed(force)
+            # 队列有积压时定期输出队列深度和延迟
+            if now - last_report >= 30:
+                last_report = now
+                stats = self.handler.event_queue.stats()
+                if stats['depth']:
+                    logger.info("事件队列: 深度 %s, 等待 %.1fs, 最近延迟 %.1fs, 已处理 %s/%s",
+                                stats['depth'], stats['lag'], stats['last_lag'], stats['processed'], stats['received'])
+
+    def health(self, max_lag=600):
+        """
+        健康状态
+
+        Returns:
+            tuple: (是否健康, 详情dict)
+        """
+        pollers = [w for w in self._watches.values() if isinstance(w, PollingWatcher)]
+        details = {
+            'phase': 'monitor',
+            'uptime': round(time.time() - self.started, 1),
+            'mappings': len(self._specs),
+            'observer_alive': self.observer.is_alive(),
+            'pollers_alive': sum(1 for poller in pollers if poller.is_alive()),
+            'db': self.handler.db.stats(),
+        }
+        ok = details['observer_alive'] and details['pollers_alive'] == len(pollers)
+        if self.handler.event_queue is not None:
+            details['event_queue'] = self.handler.event_queue.stats()
+            ok = ok and details['event_queue']['lag'] <= max_lag
+        return ok, details
+
+    def close(self):
+        """停止监控，等待当前任务结束，处理完剩余事件"""
+        self._stop_event.set()
+        self.observer.stop()
+        for source_dir in [s for s, w in self._watches.items() if isinstance(w, PollingWatcher)]:
+            self._unwatch(source_dir)
+        self.observer.join()
+        self.jobs.shutdown(wait=True, cancel_futures=True)
+        notifier = self.handler.notifier
+        self.handler.close()
+        if notifier is not None:
+            notifier.close()
+        logger.info("已停止监控")
 
 def parse_directory_mappings(mappings_str):
     """
     解析目录映射字符串
     
     Args:
-        mappings_str: 格式为 "源目录#目标目录#内容前缀" 的字符串列表
+        mappings_str: 格式为 "源目录#目标目录#内容前缀#扫描并发数#监控方式#Emby媒体库" 的字符串列表
         
     Returns:
         list: DirectoryMapping对象列表
@@ -335,89 +2973,193 @@ def parse_directory_mappings(mappings_str):
         parts = mapping_str.split('#')
         
         if len(parts) < 2:
-            print(f"错误: 映射格式不正确: {mapping_str}")
-            print("正确格式: 源目录#目标目录#[内容前缀]")
+            logger.error("错误: 映射格式不正确: %s", mapping_str)
+            logger.error("正确格式: 源目录#目标目录#[内容前缀]#[扫描并发数]#[inotify|poll]#[Emby媒体库]")
             continue
             
         source_dir = parts[0]
         target_dir = parts[1]
         content_prefix = parts[2] if len(parts) > 2 else None
+        scan_concurrency = None
+        if len(parts) > 3 and parts[3]:
+            if not parts[3].isdigit():
+                logger.error("错误: 扫描并发数必须是正整数: %s", mapping_str)
+                continue
+            scan_concurrency = int(parts[3])
+        watch_mode = parts[4] if len(parts) > 4 and parts[4] else 'inotify'
+        if watch_mode not in ('inotify', 'poll'):
+            logger.error("错误: 监控方式必须是 inotify 或 poll: %s", mapping_str)
+            continue
+        emby_library = parts[5] if len(parts) > 5 and parts[5] else None
         
-        mappings.append(DirectoryMapping(source_dir, target_dir, content_prefix))
+        mappings.append(DirectoryMapping(source_dir, target_dir, content_prefix, scan_concurrency, watch_mode,
+                                         emby_library))
         
     return mappings
 
 def main():
     # 解析命令行参数
     parser = argparse.ArgumentParser(description='监控云盘目录并生成STRM文件')
-    parser.add_argument('--mappings', '-m', required=True, nargs='+', 
-                        help='目录映射，格式: "源目录#目标目录#[内容前缀]"')
+    parser.add_argument('--mappings', '-m', nargs='+',
+                        help='目录映射，格式: "源目录#目标目录#[内容前缀]#[扫描并发数]#[inotify|poll]#[Emby媒体库]"')
+    parser.add_argument('--config', help='服务配置文件（YAML或JSON），包含映射、规则和Emby配置，运行中修改会自动重新加载')
+    parser.add_argument('--reload-interval', type=float, default=5.0, help='检查配置文件是否变化的间隔（秒）')
     parser.add_argument('--scan', '-c', action='store_true', help='启动时扫描现有文件')
     parser.add_argument('--db', '-d', default='strm_monitor.db', help='SQLite数据库文件路径')
-    parser.add_argument('--no-monitor', '-n', default=True, action='store_true', help='扫描后不启动监控')
-    
-    # parser.add_argument('--emby-url', '-e', help='Emby服务器URL，例如 http://localhost:8096')
-    # parser.add_argument('--api-key', '-k', help='Emby API密钥')
-    # parser.add_argument('--library', '-l', help='要扫描的Emby媒体库名称，不指定则扫描所有媒体库')
+    parser.add_argument('--no-monitor', '-n', action='store_true', help='扫描后不启动监控')
+    parser.add_argument('--reconcile', action='store_true', help='对比源目录和STRM目录，修复缺失、多余和内容不一致的STRM文件')
+    parser.add_argument('--dry-run', action='store_true', help='配合--reconcile使用，只统计不修改')
+    parser.add_argument('--rules', '-r', help='媒体文件规则配置文件（JSON或YAML），包含扩展名、include/exclude、最小大小、附属文件')
+    parser.add_argument('--full-scan', action='store_true', help='忽略目录快照，重新列出所有目录')
+    parser.add_argument('--workers', type=int, default=0, help='扫描/对账时写STRM文件的进程数，小于2时不使用多进程')
+    parser.add_argument('--scan-workers', type=int, default=4, help='扫描时每个映射默认的并发列目录数')
+    parser.add_argument('--settle-seconds', type=float, default=2.0, help='监控模式下文件静默多久后才生成STRM（秒）')
+    parser.add_argument('--event-batch', type=int, default=100, help='监控模式下每批处理的事件数')
+    parser.add_argument('--event-workers', type=int, default=4, help='监控模式下生成STRM的线程数')
+    parser.add_argument('--poll-interval', type=float, default=5.0, help='轮询模式下目录最短轮询间隔（秒）')
+    parser.add_argument('--poll-max-interval', type=float, default=300.0, help='轮询模式下目录最长轮询间隔（秒）')
+    parser.add_argument('--poll-full-stat', action='store_true',
+                        help='轮询模式不信任目录mtime，每次都列目录并stat所有文件（开销与目录树大小成正比）')
+    parser.add_argument('--batch-size', type=int, default=500, help='数据库批量提交的行数')
+    parser.add_argument('--flush-ms', type=int, default=1000, help='数据库写入缓冲最长停留时间（毫秒）')
+    parser.add_argument('--index-mode', choices=['auto', 'set', 'bloom', 'none'], default='auto',
+                        help='已同步路径内存索引: set精确集合, bloom布隆过滤器, auto按内存上限自动选择, none不使用')
+    parser.add_argument('--index-max-mb', type=int, default=256, help='内存索引的内存上限（MB）')
     
+    parser.add_argument('--emby-url', '-e', help='Emby服务器URL，例如 http://localhost:8096')
+    parser.add_argument('--api-key', '-k', help='Emby API密钥')
+    parser.add_argument('--emby-window', type=float, default=300, help='同一Emby媒体库两次刷新的最小间隔（秒）')
+    parser.add_argument('--emby-delay', type=float, default=30, help='STRM变化后等待多久再通知Emby刷新（秒）')
+
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO', help='日志级别')
+    parser.add_argument('--log-rate', type=int, default=20, help='同一类日志每秒最多输出的条数，0表示不限流')
+    parser.add_argument('--metrics-port', type=int, help='在该端口提供 /metrics 和 /health 接口，不指定则不启动')
+    parser.add_argument('--metrics-host', default='127.0.0.1', help='指标接口监听地址，对外暴露时设为0.0.0.0')
+    parser.add_argument('--health-max-lag', type=float, default=600,
+                        help='事件队列最老事件滞留超过该秒数时 /health 返回不健康')
     
     args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level, stream=sys.stdout, format='%(asctime)s %(levelname)s %(message)s')
+    if args.log_rate > 0:
+        for log_handler in logging.getLogger().handlers:
+            log_handler.addFilter(RateLimitFilter(args.log_rate))
     
-    # 解析目录映射
-    dir_mappings = parse_directory_mappings(args.mappings)
+    # 读取目录映射：配置文件或命令行
+    config = {}
+    if args.config:
+        try:
+            config = load_service_config(args.config)
+        except (OSError, ValueError) as e:
+            logger.error("错误: 读取配置文件失败: %s: %s", args.config, e)
+            return
+        mappings = config['mappings']
+        dir_mappings = [mapping for mapping, _ in mappings.values()]
+    elif args.mappings:
+        dir_mappings = parse_directory_mappings(args.mappings)
+        mappings = {mapping.source_dir: (mapping, None) for mapping in dir_mappings}
+    else:
+        parser.error("需要 --mappings 或 --config")
     if not dir_mappings:
-        print("错误: 没有有效的目录映射")
+        logger.error("错误: 没有有效的目录映射")
         return
         
-    db_path = os.path.abspath(args.db)
+    db_path = os.path.abspath(config.get('db') or args.db)
+
+    # 加载媒体文件规则（配置文件中的规则优先）
+    if args.rules and not args.config:
+        default_rules, mapping_rules = load_media_rules(args.rules)
+        for mapping in dir_mappings:
+            mapping.rules = mapping_rules.get(mapping.source_dir, default_rules)
+    db_options = {
+        'batch_size': args.batch_size,
+        'flush_interval_ms': args.flush_ms,
+        'index_mode': args.index_mode,
+        'index_max_mb': args.index_max_mb,
+    }
     
     # 检查源目录是否存在
     for mapping in dir_mappings:
         if not os.path.exists(mapping.source_dir):
-            print(f"错误: 源目录 '{mapping.source_dir}' 不存在")
+            logger.error("错误: 源目录 '%s' 不存在", mapping.source_dir)
             return
         
         # 确保目标目录存在
         os.makedirs(mapping.target_dir, exist_ok=True)
-    
-    # 如果需要，扫描现有文件
-    if args.scan:
-        print(f"扫描现有文件...")
-        scan_existing_files(dir_mappings, db_path)
-        
-        # 扫描完成后通知Emby
-        emby_url = "http://192.168.0.210:8096"
-        api_key = "1aeb2181561440a796ff1649c591a825"
-        notify_emby_scan(emby_url, api_key)
-    
-    # 如果指定了不监控，则直接返回
-    if args.no_monitor:
-        print("扫描完成，不启动监控")
+
+    # 运行状态，供 /health 使用
+    runtime = {'started': time.time(), 'phase': 'starting', 'service': None}
+
+    def health():
+        if runtime['service'] is not None:
+            return runtime['service'].health(args.health_max_lag)
+        return True, {'phase': runtime['phase'], 'uptime': round(time.time() - runtime['started'], 1)}
+
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = MetricsServer(args.metrics_port, args.metrics_host, health=health)
+        metrics_server.start()
+        logger.info("指标接口: http://%s:%s/metrics", args.metrics_host, args.metrics_port)
+
+    emby = config.get('emby')
+    if not emby and args.emby_url and args.api_key:
+        emby = {'url': args.emby_url, 'api_key': args.api_key, 'window': args.emby_window, 'delay': args.emby_delay}
+    if not emby:
+        logger.info("未提供Emby服务器URL或API密钥，不通知Emby刷新")
+    scan = args.scan or bool(config.get('scan'))
+
+    # 对账模式
+    if args.reconcile:
+        runtime['phase'] = 'reconcile'
+        logger.info("对账STRM文件...")
+        notifier = EmbyNotifier.from_config(emby)
+        reconcile(dir_mappings, db_path, args.dry_run, notifier, args.workers, **db_options)
+        if notifier is not None:
+            notifier.close()
+
+    # 不监控时直接扫描后退出；监控时扫描在开始监控之后进行
+    if args.no_monitor or args.dry_run:
+        if scan and args.dry_run:
+            # --dry-run 只统计不修改，扫描会写STRM和同步记录，不执行
+            logger.warning("--dry-run 时不扫描现有文件，忽略 --scan/配置中的 scan")
+        elif scan:
+            runtime['phase'] = 'scan'
+            logger.info("扫描现有文件...")
+            notifier = EmbyNotifier.from_config(emby)
+            scan_existing_files(dir_mappings, db_path, args.scan_workers, args.full_scan, notifier, args.workers,
+                                **db_options)
+            # 扫描完成后立即通知Emby刷新有变化的媒体库
+            if notifier is not None:
+                notifier.close()
+        logger.info("%s完成，不启动监控", "对账统计" if args.dry_run else "扫描")
+        if metrics_server is not None:
+            metrics_server.close()
         return
     
     # 设置监控
-    event_handler = CloudDriveHandler(dir_mappings, db_path)
-    observer = Observer()
-    
-    # 为每个源目录设置监控
-    for mapping in dir_mappings:
-        observer.schedule(event_handler, mapping.source_dir, recursive=True)
-        print(f"已设置监控: {mapping.source_dir} -> {mapping.target_dir}")
-        if mapping.content_prefix != mapping.source_dir:
-            print(f"  STRM内容前缀: {mapping.content_prefix}")
-    
-    # 启动监控
-    observer.start()
-    print(f"同步记录保存到: {db_path}")
-    print("按 Ctrl+C 停止监控")
+    service = StrmService(
+        db_path, emby, args.config, config.get('mtime_ns'), args.workers, args.scan_workers,
+        args.settle_seconds, args.event_batch, args.event_workers, args.poll_interval, args.poll_max_interval,
+        args.poll_full_stat, **db_options
+    )
+    service.start(mappings, scan=scan, full_scan=args.full_scan)
+    runtime['service'] = service
+
+    # SIGHUP立即重新加载配置，SIGTERM与Ctrl+C一样正常退出
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: service.request_reload())
+    signal.signal(signal.SIGTERM, lambda signum, frame: service.stop())
+
+    logger.info("同步记录保存到: %s", db_path)
+    logger.info("按 Ctrl+C 停止监控")
     
     try:
-        while True:
-            time.sleep(1)
+        service.run(args.reload_interval)
     except KeyboardInterrupt:
-        observer.stop()
-    
-    observer.join()
+        pass
+    service.close()
+    if metrics_server is not None:
+        metrics_server.close()
 
 if __name__ == "__main__":
     main()
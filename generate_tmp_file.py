@@ -48,15 +48,15 @@ def create_files_in_directory(directory, total_size, total_count, extensions):
         print(f"Generated: {filename} ({size} bytes)")
 
 
-# 配置参数
-output_directory = r"E:\DeskTop\tmp\Att"  # 目标目录
-total_size_in_mb = 1024 * 10  # 文件总大小（MB）
-total_count = 10000  # 文件总数量
-file_extensions = ["jpg", "mp4", "avi", "jpeg", "png"]  # 支持的文件格式
-
-# 转换大小到字节
-total_size_in_bytes = total_size_in_mb * 1024 * 1024
-
-# 调用生成函数
-create_files_in_directory(output_directory, total_size_in_bytes, total_count, file_extensions)
-
+if __name__ == "__main__":
+    # 配置参数
+    output_directory = r"E:\DeskTop\tmp\Att"  # 目标目录
+    total_size_in_mb = 1024 * 10  # 文件总大小（MB）
+    total_count = 10000  # 文件总数量
+    file_extensions = ["jpg", "mp4", "avi", "jpeg", "png"]  # 支持的文件格式
+
+    # 转换大小到字节
+    total_size_in_bytes = total_size_in_mb * 1024 * 1024
+
+    # 调用生成函数
+    create_files_in_directory(output_directory, total_size_in_bytes, total_count, file_extensions)
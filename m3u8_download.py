@@ -1,85 +1,1060 @@
 # --coding: utf-8--
 import os
+import sys
+import time
+import json
+import sqlite3
+import hashlib
+import argparse
+import threading
+import subprocess
+from collections import deque
+from urllib.parse import urljoin, urlsplit, urlunsplit, parse_qsl, urlencode
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
 import m3u8
 import requests
 import ffmpeg
+from requests.adapters import HTTPAdapter
+
+CHUNK_SIZE = 64 * 1024
+
+# MP4 容器可以直接封装（-c copy）的编码，其余编码需要转码
+MP4_VIDEO_CODECS = {'h264', 'hevc', 'mpeg4', 'av1'}
+MP4_AUDIO_CODECS = {'aac', 'mp3', 'ac3', 'eac3', 'opus'}
+
+
+class IncompleteSegmentError(Exception):
+    """收到的分段长度与 Content-Length 不一致"""
+
+
+# 创建共享连接池的会话，同一主机的连接会被复用（keep-alive）
+def create_session(concurrency=8):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(concurrency, 10))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 
 # 下载 m3u8 文件并解析
-def download_m3u8(m3u8_url):
-    # 获取 m3u8 文件内容
-    response = requests.get(m3u8_url)
-    playlist = m3u8.loads(response.text)
+def download_m3u8(m3u8_url, session=None):
+    # 获取 m3u8 文件内容，相对地址以重定向后的地址为基准
+    response = (session or requests).get(m3u8_url, timeout=30)
+    response.raise_for_status()
+    playlist = m3u8.loads(response.text, uri=response.url)
     return playlist
 
 
-# 下载 TS 文件
-def download_ts_files(playlist, download_dir):
-    ts_urls = []
-    for segment in playlist.segments:
-        ts_url = segment.uri
-        if not ts_url.startswith("http"):
-            ts_url = os.path.join(os.path.dirname(playlist.base_uri), ts_url)
-
-
-        # 下载 TS 文件
-        ts_filename = os.path.join(download_dir, os.path.basename(ts_url))
-        if not os.path.exists(ts_filename):
-            print(f"Downloading {ts_filename}...")
-            ts_response = requests.get(ts_url, stream=True)
-            with open(ts_filename, 'wb') as f:
-                for chunk in ts_response.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
-        ts_urls.append(ts_filename)
-    return ts_urls
-
-
-# 合并 TS 文件并转换为 MP4
-def merge_and_convert_to_mp4(ts_files, output_mp4):
-    # 使用 ffmpeg 合并并转换
-    ts_list_file = "ts_list.txt"
-    with open(ts_list_file, 'w') as f:
+# 从主播放列表中选择一个码流：先按最大高度和最大码率过滤，再取码率最高（best）或最低（worst）的
+def select_variant(playlist, quality='best', max_height=None, max_bandwidth=None):
+    variants = []
+    for variant in playlist.playlists:
+        info = variant.stream_info
+        height = info.resolution[1] if info.resolution else None
+        if max_height and height and height > max_height:
+            continue
+        if max_bandwidth and info.bandwidth and info.bandwidth > max_bandwidth:
+            continue
+        variants.append(variant)
+    # 没有满足条件的码流时退回到全部码流中最低的
+    if not variants:
+        variants, quality = list(playlist.playlists), 'worst'
+    variants.sort(key=lambda v: (v.stream_info.bandwidth or 0, (v.stream_info.resolution or (0, 0))[1]))
+    return variants[-1] if quality == 'best' else variants[0]
+
+
+# 下载媒体播放列表，遇到主播放列表时按条件选择码流，返回 (媒体播放列表地址, 播放列表)
+def resolve_media_playlist(m3u8_url, session=None, quality='best', max_height=None, max_bandwidth=None):
+    playlist = download_m3u8(m3u8_url, session)
+    while playlist.is_variant:
+        variant = select_variant(playlist, quality, max_height, max_bandwidth)
+        info = variant.stream_info
+        print(f"Selected variant: bandwidth={info.bandwidth}, resolution={info.resolution}")
+        m3u8_url = variant.absolute_uri
+        playlist = download_m3u8(m3u8_url, session)
+    return m3u8_url, playlist
+
+
+def load_media_playlist(m3u8_url, session=None, quality='best', max_height=None, max_bandwidth=None):
+    return resolve_media_playlist(m3u8_url, session, quality, max_height, max_bandwidth)[1]
+
+
+class SegmentJob:
+    """一个待下载的分段：媒体序列号、地址、字节范围 (偏移, 长度) 和解密参数 (密钥地址, IV)"""
+    __slots__ = ('index', 'sequence', 'url', 'byterange', 'key_url', 'iv')
+
+    def __init__(self, index, url, byterange=None, key_url=None, iv=None, sequence=None):
+        self.index = index
+        self.sequence = index if sequence is None else sequence
+        self.url = url
+        self.byterange = byterange
+        self.key_url = key_url
+        self.iv = iv
+
+
+# 把播放列表的分段转换为下载任务，处理 EXT-X-BYTERANGE 的隐含偏移和 EXT-X-KEY 的 IV
+def build_segment_jobs(playlist):
+    jobs = []
+    next_offset = {}
+    sequence = playlist.media_sequence or 0
+    for index, segment in enumerate(playlist.segments):
+        url = urljoin(segment.base_uri or '', segment.uri)
+        byterange = None
+        if segment.byterange:
+            # 格式为 长度[@偏移]，没有偏移时紧接同一地址的上一个范围
+            length, _, offset = segment.byterange.partition('@')
+            offset = int(offset) if offset else next_offset.get(url, 0)
+            byterange = (offset, int(length))
+            next_offset[url] = offset + int(length)
+
+        key_url = iv = None
+        key = segment.key
+        if key is not None and key.method and key.method != 'NONE':
+            if key.method != 'AES-128':
+                raise RuntimeError(f"不支持的加密方式: {key.method}")
+            key_url = urljoin(key.base_uri or '', key.uri)
+            if key.iv:
+                iv = bytes.fromhex(key.iv[2:] if key.iv.lower().startswith('0x') else key.iv).rjust(16, b'\0')
+            else:
+                # 没有 IV 时使用媒体序列号
+                iv = (sequence + index).to_bytes(16, 'big')
+        jobs.append(SegmentJob(index, url, byterange, key_url, iv, sequence + index))
+    return jobs
+
+
+class KeyCache:
+    """AES 密钥缓存：同一密钥地址只下载一次，多个下载线程共享"""
+
+    def __init__(self, session):
+        self.session = session
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def get(self, key_url):
+        key = self._keys.get(key_url)
+        if key is not None:
+            return key
+        with self._lock:
+            lock = self._locks.setdefault(key_url, threading.Lock())
+        with lock:
+            # 等待期间可能已被其他线程下载
+            if key_url not in self._keys:
+                response = self.session.get(key_url, timeout=30)
+                response.raise_for_status()
+                if len(response.content) != 16:
+                    raise RuntimeError(f"AES-128 密钥长度不正确: {key_url}: {len(response.content)}")
+                self._keys[key_url] = response.content
+            return self._keys[key_url]
+
+
+# AES-128-CBC 解密并去除 PKCS7 填充，需要 pycryptodome
+def decrypt_segment(data, key, iv):
+    try:
+        from Crypto.Cipher import AES
+        from Crypto.Util.Padding import unpad
+    except ImportError:
+        raise SystemExit("解密 AES-128 加密的分段需要安装 pycryptodome: pip install pycryptodome")
+    return unpad(AES.new(key, AES.MODE_CBC, iv).decrypt(data), AES.block_size)
+
+
+class DownloadProgress:
+    """
+    下载进度：多个下载线程累加字节数和完成的分段数，后台线程每隔interval秒输出一次速度
+    """
+
+    def __init__(self, total_segments, interval=1.0):
+        self.total_segments = total_segments
+        self.interval = interval
+        self.bytes = 0
+        self.segments = 0
+        self.skipped = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._last = (self._start, 0, 0)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def add_bytes(self, n):
+        with self._lock:
+            self.bytes += n
+
+    def segment_done(self, skipped=False):
+        with self._lock:
+            self.segments += 1
+            if skipped:
+                self.skipped += 1
+
+    def retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def _report(self, final=False):
+        now = time.monotonic()
+        with self._lock:
+            last_time, last_bytes, last_segments = self._last
+            elapsed = max(now - (self._start if final else last_time), 1e-6)
+            bytes_rate = (self.bytes - (0 if final else last_bytes)) / elapsed
+            segment_rate = (self.segments - (0 if final else last_segments)) / elapsed
+            self._last = (now, self.bytes, self.segments)
+            line = (f"{self.segments}/{self.total_segments} 段, {self.bytes / 1048576:.1f} MB, "
+                    f"{bytes_rate / 1048576:.2f} MB/s, {segment_rate:.1f} 段/s")
+            if self.skipped:
+                line += f", 已跳过 {self.skipped}"
+            if self.retries:
+                line += f", 重试 {self.retries}"
+        sys.stdout.write(("\r" + line + " " * 4) + ("\n" if final else ""))
+        sys.stdout.flush()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self._report()
+
+    def close(self):
+        """停止输出并打印整体平均速度"""
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self._report(final=True)
+
+
+class Throttle:
+    """
+    多个下载线程共享的限速器：全局带宽按令牌桶限制（rate 字节/秒），每个主机同时打开的连接数不超过 per_host
+
+    主机名额由调度方在提交任务前用 try_acquire 占用、任务结束后 release，不在下载线程里等待，
+    一个主机名额用完时线程池仍可以处理其他主机的分段。
+    """
+
+    def __init__(self, rate=None, per_host=None):
+        self.rate = rate
+        self.per_host = per_host
+        # 桶容量为一秒的流量，至少一个读取块
+        self.capacity = max(rate, CHUNK_SIZE) if rate else None
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    @staticmethod
+    def host_of(url):
+        return (urlsplit(url).hostname or '').lower()
+
+    def try_acquire(self, host):
+        """占用主机的一个连接名额，名额已用完时返回 False，不等待"""
+        if not self.per_host:
+            return True
+        with self._lock:
+            used = self._hosts.get(host, 0)
+            if used >= self.per_host:
+                return False
+            self._hosts[host] = used + 1
+            return True
+
+    def release(self, host):
+        """归还 try_acquire 占用的名额"""
+        if not self.per_host:
+            return
+        with self._lock:
+            self._hosts[host] -= 1
+
+    def consume(self, n):
+        """扣除 n 字节的令牌，令牌不足时等待到补足为止"""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # 允许欠账，欠下的令牌由当前线程等待补足，后来的线程排在它后面
+            self.tokens -= n
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+# 下载单个分段到内存并在当前线程解密，长度与 Content-Length 不一致或请求失败时按指数退避重试
+# throttle 用于批量下载时限制全局带宽，每个主机的连接数由调度方在提交前控制
+def fetch_segment(session, job, progress=None, retries=5, keys=None, backoff=1.0, timeout=30, throttle=None):
+    headers = {}
+    if job.byterange:
+        offset, length = job.byterange
+        headers['Range'] = f"bytes={offset}-{offset + length - 1}"
+    for attempt in range(retries + 1):
+        received = 0
+        try:
+            chunks = []
+            with session.get(job.url, headers=headers, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                expected = response.headers.get('Content-Length')
+                # 压缩传输时 Content-Length 是压缩后的长度，不能用来校验
+                if response.headers.get('Content-Encoding') not in (None, 'identity'):
+                    expected = None
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    chunks.append(chunk)
+                    received += len(chunk)
+                    if progress is not None:
+                        progress.add_bytes(len(chunk))
+                    if throttle is not None:
+                        throttle.consume(len(chunk))
+            if expected is not None and received != int(expected):
+                raise IncompleteSegmentError(f"分段长度不完整: {received}/{expected}")
+            data = b''.join(chunks)
+            if job.byterange:
+                if response.status_code != 206:
+                    # 服务器忽略了 Range，返回的是整个文件
+                    data = data[offset:offset + length]
+                if len(data) != length:
+                    raise IncompleteSegmentError(f"字节范围不完整: {len(data)}/{length}")
+            key = keys.get(job.key_url) if job.key_url else None
+            break
+        except (requests.RequestException, IncompleteSegmentError) as e:
+            if progress is not None:
+                progress.add_bytes(-received)
+            if attempt == retries:
+                raise RuntimeError(f"分段下载失败: {job.url}: {e}") from e
+            if progress is not None:
+                progress.retry()
+            # 指数退避：1s, 2s, 4s ...
+            time.sleep(backoff * (2 ** attempt))
+
+    # 在下载线程中解密，多个分段的解密并行进行
+    if key is not None:
+        data = decrypt_segment(data, key, job.iv)
+    return data
+
+
+# CDN 鉴权参数，每次获取播放列表都可能变化，不参与缓存键
+TOKEN_PARAMS = {
+    'token', 'sign', 'signature', 'expires', 'expire', 'auth', 'auth_key', 'authkey', 'key-pair-id', 'policy',
+    'hdnts', 'hdnea', 'txsecret', 'txtime', 'awsaccesskeyid', 'wssecret', 'wstime',
+}
+
+
+# 规范化地址：协议和主机名小写、去掉默认端口和片段、去掉鉴权参数、其余参数排序
+def normalize_url(url):
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.hostname or ''
+    if parts.port and (scheme, parts.port) not in (('http', 80), ('https', 443)):
+        netloc += f":{parts.port}"
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k.lower() not in TOKEN_PARAMS and not k.lower().startswith('x-amz-')
+    )
+    return urlunsplit((scheme, netloc, parts.path, urlencode(query), ''))
+
+
+class SegmentCache:
+    """
+    分段缓存：按 (播放列表标识, 分段序号, 规范化分段地址, 字节范围) 索引，多次下载、多个任务之间共享
+
+    manifest.db 记录每个分段对应的文件和长度，中断后重新运行时只比较本地文件长度，不需要 HEAD 请求。
+    dedupe 时文件按内容的 SHA-256 命名，内容相同的分段只保存一份。
+    总大小超过 max_bytes 时按最近使用时间淘汰，本进程中用到的分段不会被淘汰。
+    """
+
+    def __init__(self, cache_dir, max_bytes=None, dedupe=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.dedupe = dedupe
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pinned = set()
+        self.conn = sqlite3.connect(os.path.join(cache_dir, 'manifest.db'), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, blob TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS blobs (blob TEXT PRIMARY KEY, size INTEGER NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_last_used ON entries(last_used)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_blob ON entries(blob)")
+
+    @staticmethod
+    def make_key(playlist_id, job):
+        byterange = f"{job.byterange[0]}:{job.byterange[1]}" if job.byterange else ''
+        # 带上分段序号，即使地址中用来区分分段的参数被当作鉴权参数去掉，不同分段也不会共用一个键
+        raw = f"{playlist_id}\n{job.sequence}\n{normalize_url(job.url)}\n{byterange}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def blob_path(self, blob):
+        return os.path.join(self.objects_dir, blob[:2], blob + '.ts')
+
+    def get(self, key):
+        """返回缓存的分段文件路径，不存在或文件长度不符时返回 None"""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT e.blob, b.size FROM entries e JOIN blobs b ON b.blob = e.blob WHERE e.key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            path = self.blob_path(row[0])
+            try:
+                complete = os.path.getsize(path) == row[1]
+            except OSError:
+                complete = False
+            with self.conn:
+                if not complete:
+                    self._delete_entry(key)
+                    return None
+                self.conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._pinned.add(key)
+            return path
+
+    def put(self, key, data):
+        """保存分段内容，返回文件路径"""
+        blob = hashlib.sha256(data).hexdigest() if self.dedupe else key
+        path = self.blob_path(blob)
+        with self._lock:
+            exists = self.conn.execute("SELECT size FROM blobs WHERE blob = ?", (blob,)).fetchone()
+        if exists is None or exists[0] != len(data) or not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            part_path = f"{path}.{threading.get_ident()}.part"
+            with open(part_path, 'wb') as f:
+                f.write(data)
+            os.replace(part_path, path)
+        with self._lock:
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO blobs (blob, size) VALUES (?, ?)", (blob, len(data)))
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, blob, last_used) VALUES (?, ?, ?)", (key, blob, time.time())
+                )
+            self._pinned.add(key)
+            self._evict()
+        return path
+
+    def _delete_entry(self, key):
+        """删除一条记录，没有其他记录引用的文件一起删除；调用时需持有锁和事务"""
+        row = self.conn.execute("SELECT blob FROM entries WHERE key = ?", (key,)).fetchone()
+        self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        if row is None:
+            return 0
+        blob = row[0]
+        if self.conn.execute("SELECT 1 FROM entries WHERE blob = ? LIMIT 1", (blob,)).fetchone():
+            return 0
+        size = self.conn.execute("SELECT size FROM blobs WHERE blob = ?", (blob,)).fetchone()
+        self.conn.execute("DELETE FROM blobs WHERE blob = ?", (blob,))
+        try:
+            os.remove(self.blob_path(blob))
+        except OSError:
+            pass
+        return size[0] if size else 0
+
+    def total_bytes(self):
+        with self._lock:
+            return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def _evict(self):
+        """总大小超过上限时按最近使用时间淘汰，调用时需持有锁"""
+        if not self.max_bytes:
+            return
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        with self.conn:
+            for (key,) in self.conn.execute("SELECT key FROM entries ORDER BY last_used").fetchall():
+                if key in self._pinned:
+                    continue
+                total -= self._delete_entry(key)
+                if total <= self.max_bytes:
+                    break
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+# 下载单个分段到文件：先写入 .part 文件再改名，已存在的完整分段直接跳过
+def download_segment(session, job, path, progress=None, retries=5, keys=None, throttle=None):
+    if os.path.exists(path):
+        if progress is not None:
+            progress.segment_done(skipped=True)
+        return path
+
+    data = fetch_segment(session, job, progress, retries, keys, throttle=throttle)
+    part_path = path + '.part'
+    with open(part_path, 'wb') as f:
+        f.write(data)
+    os.replace(part_path, path)
+    if progress is not None:
+        progress.segment_done()
+    return path
+
+
+# 通过缓存下载单个分段，返回缓存中的文件路径
+def download_cached_segment(session, job, cache, key, progress=None, retries=5, keys=None, throttle=None):
+    path = cache.get(key)
+    if path is not None:
+        if progress is not None:
+            progress.segment_done(skipped=True)
+        return path
+    path = cache.put(key, fetch_segment(session, job, progress, retries, keys, throttle=throttle))
+    if progress is not None:
+        progress.segment_done()
+    return path
+
+
+# 下载 TS 文件，指定 cache 时分段保存在缓存中，playlist_id 为播放列表标识（规范化的播放列表地址）
+# 不使用缓存时每个播放列表的分段目录，按规范化的播放列表地址区分，不同视频的分段不会互相覆盖
+def playlist_work_dir(download_dir, playlist_id):
+    return os.path.join(download_dir, hashlib.sha1(playlist_id.encode('utf-8')).hexdigest()[:16])
+
+
+def download_ts_files(playlist, download_dir, concurrency=8, retries=5, session=None, cache=None, playlist_id=None):
+    session = session or create_session(concurrency)
+    keys = KeyCache(session)
+    jobs = build_segment_jobs(playlist)
+
+    progress = DownloadProgress(len(jobs))
+    progress.start()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            playlist_id = playlist_id or normalize_url(playlist.base_uri or '')
+            if cache is not None:
+                futures = [pool.submit(download_cached_segment, session, job, cache,
+                                       SegmentCache.make_key(playlist_id, job), progress, retries, keys)
+                           for job in jobs]
+            else:
+                segment_dir = playlist_work_dir(download_dir, playlist_id)
+                os.makedirs(segment_dir, exist_ok=True)
+                # 按序号命名，不同分段的文件名不会冲突，合并时也按序号排列
+                futures = [pool.submit(download_segment, session, job,
+                                       os.path.join(segment_dir, f"{job.index:05d}.ts"), progress, retries, keys)
+                           for job in jobs]
+            for future in as_completed(futures):
+                # 任一分段重试后仍失败则取消剩余分段，已完成的分段保留，下次运行会跳过
+                if future.exception() is not None:
+                    for other in futures:
+                        other.cancel()
+                    raise future.exception()
+    finally:
+        progress.close()
+    # 按播放列表顺序返回，与完成顺序无关
+    return [future.result() for future in futures]
+
+
+# 用 ffprobe 读取第一个视频流和音频流的编码，source 可以是文件路径或分段内容
+def probe_codecs(source):
+    command = ['ffprobe', '-v', 'error', '-show_streams', '-of', 'json']
+    if isinstance(source, bytes):
+        result = subprocess.run(command + ['-'], input=source, capture_output=True)
+    else:
+        result = subprocess.run(command + [source], capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe 失败: {result.stderr.decode('utf-8', 'replace').strip()}")
+    streams = json.loads(result.stdout).get('streams', [])
+    video = next((s['codec_name'] for s in streams if s.get('codec_type') == 'video'), None)
+    audio = next((s['codec_name'] for s in streams if s.get('codec_type') == 'audio'), None)
+    return video, audio
+
+
+# 根据编码决定每个流是直接封装还是转码，返回 ffmpeg 输出参数
+def mp4_output_options(video_codec, audio_codec, transcode=False):
+    options = {}
+    if video_codec is not None:
+        copy_video = not transcode and video_codec in MP4_VIDEO_CODECS
+        options['vcodec'] = 'copy' if copy_video else 'libx264'
+        if copy_video and video_codec == 'hevc':
+            # 苹果设备只识别 hvc1 标签的 HEVC
+            options['tag:v'] = 'hvc1'
+    if audio_codec is not None:
+        copy_audio = not transcode and audio_codec in MP4_AUDIO_CODECS
+        options['acodec'] = 'copy' if copy_audio else 'aac'
+        if copy_audio and audio_codec == 'aac':
+            # TS 中的 AAC 是 ADTS 格式，封装进 MP4 需要转换
+            options['bsf:a'] = 'aac_adtstoasc'
+    return options
+
+
+def _needs_transcode(options):
+    return options.get('vcodec', 'copy') != 'copy' or options.get('acodec', 'copy') != 'copy'
+
+
+# 合并 TS 文件并转换为 MP4：编码兼容时直接封装，不兼容时才转码
+def merge_and_convert_to_mp4(ts_files, output_mp4, transcode=False, cleanup=True):
+    video_codec, audio_codec = probe_codecs(ts_files[0])
+    options = mp4_output_options(video_codec, audio_codec, transcode)
+    print(f"Source codecs: video={video_codec}, audio={audio_codec}")
+
+    # 使用 ffmpeg concat 合并，列表文件放在输出文件旁边
+    ts_list_file = os.path.abspath(output_mp4) + ".ts_list.txt"
+    with open(ts_list_file, 'w', encoding='utf-8') as f:
         for ts_file in ts_files:
-            f.write(f"file '{ts_file}'\n")
+            escaped = os.path.abspath(ts_file).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
 
-    print("Merging and converting to MP4...")
-    output = ffmpeg.input(ts_list_file, format='concat', safe=0).output(output_mp4, vcodec='libx264', acodec='aac')
+    print("Merging and converting to MP4..." if _needs_transcode(options) else "Remuxing to MP4...")
+    output = ffmpeg.input(ts_list_file, format='concat', safe=0).output(output_mp4, movflags='+faststart', **options)
+    output = output.overwrite_output()
     command = output.compile()
     print(" ".join(command))
     output.run()
 
-    # 删除中间文件
+    # 删除中间文件，缓存中的分段保留
     os.remove(ts_list_file)
-    for ts_file in ts_files:
-        os.remove(ts_file)
+    if cleanup:
+        for ts_file in ts_files:
+            os.remove(ts_file)
+
 
+# 边下载边把分段按顺序写入 ffmpeg 标准输入，不在磁盘上保存 TS 文件
+def stream_to_mp4(playlist, output_mp4, concurrency=8, retries=5, session=None, transcode=False):
+    session = session or create_session(concurrency)
+    jobs = build_segment_jobs(playlist)
+    keys = KeyCache(session)
+    progress = DownloadProgress(len(jobs))
+    process = None
+    # 最多同时缓存 2 倍并发数的分段，内存占用有上限
+    pending = deque()
+    next_index = 0
+    progress.start()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            while pending or next_index < len(jobs):
+                while next_index < len(jobs) and len(pending) < concurrency * 2:
+                    pending.append(pool.submit(fetch_segment, session, jobs[next_index], progress, retries, keys))
+                    next_index += 1
+                data = pending.popleft().result()
+                if process is None:
+                    video_codec, audio_codec = probe_codecs(data)
+                    options = mp4_output_options(video_codec, audio_codec, transcode)
+                    output = ffmpeg.input('pipe:', format='mpegts').output(output_mp4, movflags='+faststart', **options)
+                    # 只输出错误信息，stderr 不经过管道，避免缓冲区写满阻塞 ffmpeg
+                    output = output.overwrite_output().global_args('-loglevel', 'error', '-nostats')
+                    print(" ".join(output.compile()))
+                    process = output.run_async(pipe_stdin=True)
+                process.stdin.write(data)
+                progress.segment_done()
+    except BaseException:
+        for future in pending:
+            future.cancel()
+        if process is not None:
+            process.kill()
+        raise
+    finally:
+        progress.close()
 
-def main(m3u8_url, output_mp4):
-    # 创建临时下载目录
-    download_dir = "downloaded_ts"
-    os.makedirs(download_dir, exist_ok=True)
+    if process is not None:
+        process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"ffmpeg 失败，返回码 {process.returncode}")
+
+
+# 直播录制：按目标时长轮询媒体播放列表，按媒体序列号识别新分段并发下载，按顺序追加写入 output_ts
+def record_live(m3u8_url, output_ts, concurrency=8, retries=3, session=None, max_duration=None, window=None):
+    session = session or create_session(concurrency)
+    keys = KeyCache(session)
+    # 已下载但还不能按顺序写出的分段数上限，超过时暂不提交新分段，内存占用有上限
+    window = window or concurrency * 4
+    pending = {}
+    last_sequence = None
+    next_write = None
+    written = gaps = 0
+    deadline = time.monotonic() + max_duration if max_duration else None
+    progress = DownloadProgress(0)
+
+    def drain():
+        # 按序号写出已完成的分段；播放列表跳过的或下载失败的序号记为缺口，不阻塞后续分段
+        nonlocal next_write, written, gaps
+        while pending:
+            if next_write not in pending:
+                gaps += min(pending) - next_write
+                print(f"\n分段 {next_write}-{min(pending) - 1} 已从播放列表中移除，录制出现缺口")
+                next_write = min(pending)
+            future = pending[next_write]
+            if not future.done():
+                return
+            del pending[next_write]
+            try:
+                out.write(future.result())
+                out.flush()
+                written += 1
+                progress.segment_done()
+            except Exception as e:
+                gaps += 1
+                print(f"\n分段 {next_write} 下载失败，跳过: {e}")
+            next_write += 1
+
+    print(f"Recording live stream to {output_ts}...")
+    progress.start()
+    try:
+        # 每次录制都从头写，重新运行不会把两次录制接在一起（与 ffmpeg -y 覆盖输出一致）
+        with open(output_ts, 'wb') as out, ThreadPoolExecutor(max_workers=concurrency) as pool:
+            ended = False
+            try:
+                while not ended:
+                    poll_start = time.monotonic()
+                    interval = 2.0
+                    try:
+                        playlist = download_m3u8(m3u8_url, session)
+                    except requests.RequestException as e:
+                        print(f"\n刷新播放列表失败: {e}")
+                        playlist = None
+                    added = 0
+                    if playlist is not None:
+                        ended = playlist.is_endlist
+                        interval = playlist.target_duration or interval
+                        for job in build_segment_jobs(playlist):
+                            if last_sequence is not None and job.sequence <= last_sequence:
+                                continue
+                            if len(pending) >= window:
+                                # 窗口已满，剩余分段下次轮询再提交
+                                ended = False
+                                break
+                            if next_write is None:
+                                next_write = job.sequence
+                            pending[job.sequence] = pool.submit(fetch_segment, session, job, progress, retries, keys)
+                            last_sequence = job.sequence
+                            added += 1
+                        progress.total_segments += added
+                    if deadline is not None and time.monotonic() >= deadline:
+                        break
+                    # 播放列表没有变化时按半个目标时长重试；等待期间持续写出已完成的分段
+                    next_poll = poll_start + (interval if added else interval / 2)
+                    if deadline is not None:
+                        next_poll = min(next_poll, deadline)
+                    while not ended:
+                        drain()
+                        remaining = next_poll - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        if pending:
+                            wait(list(pending.values()), timeout=remaining, return_when=FIRST_COMPLETED)
+                        else:
+                            time.sleep(remaining)
+            except KeyboardInterrupt:
+                print("\n停止录制，等待已开始的分段完成...")
+            # 写出剩余分段
+            while pending:
+                wait(list(pending.values()))
+                drain()
+    finally:
+        progress.close()
+    print(f"已录制 {written} 个分段" + (f"，缺少 {gaps} 个" if gaps else ""))
+    return written
+
+
+# 读取批量任务文件：每行一个 JSON 对象，必须有 url；id（或 request_id）缺省时用行号，
+# output 缺省时为 output_dir/<id>.mp4，quality、max_height、max_bandwidth、transcode 可覆盖命令行参数
+def load_batch_jobs(job_file, output_dir='.'):
+    jobs = []
+    seen = set()
+    with open(job_file, 'r', encoding='utf-8') as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{job_file}:{lineno}: 不是有效的 JSON: {e}") from e
+            if not isinstance(item, dict) or not item.get('url'):
+                raise ValueError(f"{job_file}:{lineno}: 缺少 url")
+            job_id = str(item.get('id') or item.get('request_id') or f"job-{lineno}")
+            if job_id in seen:
+                raise ValueError(f"{job_file}:{lineno}: 任务 id 重复: {job_id}")
+            seen.add(job_id)
+            item['id'] = job_id
+            item.setdefault('output', os.path.join(output_dir, f"{job_id}.mp4"))
+            jobs.append(item)
+    return jobs
+
+
+class BatchJob:
+    """批量下载中的一个播放列表任务"""
+
+    def __init__(self, spec):
+        self.id = spec['id']
+        self.url = spec['url']
+        self.output = spec['output']
+        self.spec = spec
+        self.segment_dir = None
+        self.ts_files = []
+        self.futures = set()
+        self.remaining = 0
+        self.failed = False
+
+
+class BatchDownloader:
+    """
+    批量下载多个播放列表：所有任务的播放列表解析和分段下载共用一个线程池，同时下载的任务不超过 max_active 个，
+    分段下载完的任务交给单独的线程合并，不占用下载线程。
+
+    限制每个主机的连接数时，请求按主机放入各自的待提交队列，主机有空闲名额时才提交到线程池，
+    下载线程不会因为等某个主机的名额而空闲，其他主机的分段不受影响。
+
+    任务状态（running/done/failed）保存在 state_path 中，每次变化后原子写入；中断后重新运行会跳过已完成的任务，
+    未完成的任务重新解析播放列表，已下载的分段（分段目录或缓存中）直接跳过。
+    """
+
+    def __init__(self, jobs, state_path, concurrency=8, retries=5, download_dir="downloaded_ts", transcode=False,
+                 quality='best', max_height=None, max_bandwidth=None, max_active=4, throttle=None, cache=None,
+                 session=None):
+        self.jobs = [BatchJob(spec) for spec in jobs]
+        self.state_path = state_path
+        self.concurrency = concurrency
+        self.retries = retries
+        self.download_dir = download_dir
+        self.transcode = transcode
+        self.quality = quality
+        self.max_height = max_height
+        self.max_bandwidth = max_bandwidth
+        self.max_active = max_active
+        self.throttle = throttle or Throttle()
+        self.cache = cache
+        self.session = session or create_session(concurrency)
+        self.keys = KeyCache(self.session)
+        self.progress = DownloadProgress(0)
+        self.state = self._load_state()
+        # 主机 -> 等待名额的 (任务, 类型, 分段位置, 函数, 参数)，按提交顺序排列
+        self._ready = {}
+
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _set_state(self, job, status, error=None):
+        entry = {'status': status, 'url': job.url, 'output': job.output, 'updated': time.time()}
+        if error is not None:
+            entry['error'] = str(error)
+        self.state[job.id] = entry
+        # 先写临时文件再改名，崩溃时状态文件不会只写了一半
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.state_path)
+
+    def _is_done(self, job):
+        entry = self.state.get(job.id)
+        return bool(entry) and entry.get('status') == 'done' and os.path.exists(job.output)
+
+    def _resolve(self, job):
+        """解析播放列表，在下载线程中执行"""
+        quality = job.spec.get('quality', self.quality)
+        max_height = job.spec.get('max_height', self.max_height)
+        max_bandwidth = job.spec.get('max_bandwidth', self.max_bandwidth)
+        media_url, playlist = resolve_media_playlist(job.url, self.session, quality, max_height, max_bandwidth)
+        if not playlist.is_endlist:
+            raise ValueError("批量模式不支持直播播放列表")
+        if not playlist.segments:
+            raise ValueError("播放列表中没有分段")
+        return media_url, playlist
+
+    def _submit_segments(self, pool, job, media_url, playlist, running):
+        segment_jobs = build_segment_jobs(playlist)
+        if self.cache is not None:
+            playlist_id = normalize_url(media_url)
+        else:
+            # 每个任务单独一个分段目录，目录名取任务 id，中断后重新运行可以找回已下载的分段
+            job.segment_dir = os.path.join(self.download_dir, job.id)
+            os.makedirs(job.segment_dir, exist_ok=True)
+        job.ts_files = [None] * len(segment_jobs)
+        job.remaining = len(segment_jobs)
+        self.progress.total_segments += len(segment_jobs)
+        hosts = set()
+        for position, segment in enumerate(segment_jobs):
+            if self.cache is not None:
+                args = (download_cached_segment, self.session, segment, self.cache,
+                        SegmentCache.make_key(playlist_id, segment), self.progress, self.retries,
+                        self.keys, self.throttle)
+            else:
+                path = os.path.join(job.segment_dir, f"{segment.index:05d}.ts")
+                args = (download_segment, self.session, segment, path, self.progress, self.retries,
+                        self.keys, self.throttle)
+            host = Throttle.host_of(segment.url)
+            self._ready.setdefault(host, deque()).append((job, 'segment', position, args))
+            hosts.add(host)
+        for host in hosts:
+            self._dispatch(pool, host, running)
+
+    def _enqueue(self, pool, job, kind, position, host, args, running):
+        self._ready.setdefault(host, deque()).append((job, kind, position, args))
+        self._dispatch(pool, host, running)
+
+    def _dispatch(self, pool, host, running):
+        """主机有空闲名额时从它的待提交队列中取出请求提交到线程池，已失败任务的请求直接丢弃"""
+        ready = self._ready.get(host)
+        while ready:
+            if ready[0][0].failed:
+                ready.popleft()
+                continue
+            if not self.throttle.try_acquire(host):
+                return
+            job, kind, position, args = ready.popleft()
+            future = pool.submit(*args)
+            running[future] = (job, kind, position, host)
+            job.futures.add(future)
+        self._ready.pop(host, None)
+
+    def _merge(self, job):
+        os.makedirs(os.path.dirname(os.path.abspath(job.output)), exist_ok=True)
+        transcode = job.spec.get('transcode', self.transcode)
+        merge_and_convert_to_mp4(job.ts_files, job.output, transcode, cleanup=self.cache is None)
+        if job.segment_dir is not None:
+            try:
+                os.rmdir(job.segment_dir)
+            except OSError:
+                pass
+
+    def _fail(self, job, error):
+        job.failed = True
+        for future in job.futures:
+            future.cancel()
+        print(f"\n任务 {job.id} 失败: {error}")
+        self._set_state(job, 'failed', error)
+
+    def run(self):
+        """运行全部任务，返回失败的任务数"""
+        queue = deque(job for job in self.jobs if not self._is_done(job))
+        if len(queue) < len(self.jobs):
+            print(f"跳过 {len(self.jobs) - len(queue)} 个已完成的任务")
+        # future -> (任务, 类型, 分段位置, 占用名额的主机)
+        running = {}
+        active = failed = 0
+        pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        merge_pool = ThreadPoolExecutor(max_workers=1)
+        self.progress.start()
+        try:
+            while queue or running:
+                # 下载中的任务未达上限时开始新任务，分段按提交顺序执行，先开始的任务先完成
+                while queue and active < self.max_active:
+                    job = queue.popleft()
+                    self._set_state(job, 'running')
+                    self._enqueue(pool, job, 'playlist', None, Throttle.host_of(job.url), (self._resolve, job), running)
+                    active += 1
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, kind, position, host = running.pop(future)
+                    job.futures.discard(future)
+                    if host is not None:
+                        # 归还名额后立即提交该主机排队中的下一个请求
+                        self.throttle.release(host)
+                        self._dispatch(pool, host, running)
+                    if job.failed or future.cancelled():
+                        continue
+                    error = future.exception()
+                    if error is not None:
+                        # 一个任务失败只取消它自己的分段，其他任务继续
+                        self._fail(job, error)
+                        failed += 1
+                        if kind != 'merge':
+                            active -= 1
+                    elif kind == 'playlist':
+                        self._submit_segments(pool, job, *future.result(), running)
+                    elif kind == 'segment':
+                        job.ts_files[position] = future.result()
+                        job.remaining -= 1
+                        if job.remaining == 0:
+                            active -= 1
+                            running[merge_pool.submit(self._merge, job)] = (job, 'merge', None, None)
+                    else:
+                        self._set_state(job, 'done')
+                        print(f"\n任务 {job.id} 完成: {job.output}")
+        except BaseException:
+            # 中断时未完成的任务保持 running 状态，下次运行继续
+            pool.shutdown(wait=False, cancel_futures=True)
+            merge_pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            self.progress.close()
+        pool.shutdown()
+        merge_pool.shutdown()
+        return failed
+
+
+def main(m3u8_url, output_mp4, concurrency=8, retries=5, download_dir="downloaded_ts", pipe=False, transcode=False,
+         quality='best', max_height=None, max_bandwidth=None, live=False, max_duration=None,
+         cache_dir=None, cache_max_bytes=None, dedupe=False):
+    session = create_session(concurrency)
 
     # 下载并解析 m3u8 文件
     print("Parsing M3U8...")
-    playlist = download_m3u8(m3u8_url)
+    media_url, playlist = resolve_media_playlist(m3u8_url, session, quality, max_height, max_bandwidth)
 
-    # 下载 TS 文件
-    ts_files = download_ts_files(playlist, download_dir)
+    if live and not playlist.is_endlist:
+        # 直播先录制为 TS，输出不是 TS 时录制结束后再封装
+        output_ts = output_mp4 if output_mp4.lower().endswith('.ts') else os.path.splitext(output_mp4)[0] + '.ts'
+        record_live(media_url, output_ts, concurrency, retries, session, max_duration)
+        if output_ts != output_mp4:
+            merge_and_convert_to_mp4([output_ts], output_mp4, transcode)
+    elif pipe:
+        # 分段直接写入 ffmpeg，不保存 TS 文件
+        stream_to_mp4(playlist, output_mp4, concurrency, retries, session, transcode)
+    else:
+        # 下载 TS 文件，使用缓存时按规范化的播放列表地址区分不同视频，地址中的鉴权参数变化不影响命中
+        cache = SegmentCache(cache_dir, cache_max_bytes, dedupe) if cache_dir else None
+        playlist_id = normalize_url(media_url)
+        try:
+            ts_files = download_ts_files(playlist, download_dir, concurrency, retries, session, cache, playlist_id)
 
-    # 合并 TS 文件并转换为 MP4
-    merge_and_convert_to_mp4(ts_files, output_mp4)
+            # 合并 TS 文件并转换为 MP4，缓存中的分段不删除
+            merge_and_convert_to_mp4(ts_files, output_mp4, transcode, cleanup=cache is None)
+            if cache is None:
+                try:
+                    os.rmdir(playlist_work_dir(download_dir, playlist_id))
+                except OSError:
+                    pass
+        finally:
+            if cache is not None:
+                cache.close()
 
     print(f"Video saved as {output_mp4}")
 
 
 if __name__ == "__main__":
     # 输入 M3U8 URL 和输出的 MP4 文件名
-    m3u8_url = 'https://s3plus.sankuai.com/annualbill-private/m3u8/4c1b993b-82b7-4700-aa9e-372e6c6ebe49.m3u8?AWSAccessKeyId=SRV_u80fSKXwuNYN7Dt3y7nT5T2QhtZVtM7P&Expires=1735109263&Signature=bB6Q%2FFvLsFk49TsC4UU1c6IE2Vk%3D'  # 替换为你的 M3U8 文件地址
-    output_mp4 = 'output_video.mp4'
-    # ffmpeg_path = r'D:\Downloads\aaa\ffmpeg.exe'
     # ffmpeg下载地址：https://github.com/BtbN/FFmpeg-Builds/releases
+    parser = argparse.ArgumentParser(description='下载 M3U8 视频并合并为 MP4')
+    parser.add_argument('url', nargs='?', help='M3U8 文件地址，使用 --batch 时省略')
+    parser.add_argument('-o', '--output', default='output_video.mp4', help='输出的 MP4 文件名')
+    parser.add_argument('-j', '--concurrency', type=int, default=8, help='同时下载的分段数')
+    parser.add_argument('--retries', type=int, default=5, help='每个分段失败后的重试次数')
+    parser.add_argument('--dir', default='downloaded_ts', help='分段临时下载目录，中断后重新运行会跳过已完成的分段')
+    parser.add_argument('--pipe', action='store_true', help='边下载边写入 ffmpeg，不在磁盘上保存 TS 文件（不支持断点续传）')
+    parser.add_argument('--transcode', action='store_true', help='强制转码为 H.264/AAC，默认编码兼容时直接封装')
+    parser.add_argument('--quality', choices=['best', 'worst'], default='best', help='主播放列表中选择码率最高或最低的码流')
+    parser.add_argument('--max-height', type=int, help='只选择分辨率高度不超过该值的码流，例如 720')
+    parser.add_argument('--max-bandwidth', type=int, help='只选择码率不超过该值的码流（bit/s）')
+    parser.add_argument('--live', action='store_true', help='直播录制：轮询播放列表直到 EXT-X-ENDLIST 或达到 --duration')
+    parser.add_argument('--duration', type=float, help='直播最长录制时间（秒）')
+    parser.add_argument('--cache-dir', help='分段缓存目录，多次下载之间共享，替代 --dir')
+    parser.add_argument('--cache-max-gb', type=float, help='分段缓存大小上限（GB），超出时淘汰最久未使用的分段')
+    parser.add_argument('--dedupe', action='store_true', help='缓存按分段内容去重，内容相同的分段只保存一份')
+    parser.add_argument('--batch', metavar='JOBS.jsonl',
+                        help='批量模式：每行一个 JSON 任务 {"id": ..., "url": ..., "output": ...}，所有任务共用 -j 个下载线程')
+    parser.add_argument('--output-dir', default='.', help='批量模式中未指定 output 的任务输出目录')
+    parser.add_argument('--state', help='批量模式的任务状态文件，默认为任务文件名加 .state.json')
+    parser.add_argument('--max-active', type=int, default=4, help='批量模式中同时下载的任务数')
+    parser.add_argument('--rate-limit', type=float, help='批量模式的全局下载速度上限（MB/s）')
+    parser.add_argument('--per-host', type=int, help='批量模式中每个主机同时打开的连接数上限')
+    args = parser.parse_args()
 
-    main(m3u8_url, output_mp4)
-
+    if args.batch:
+        cache = SegmentCache(args.cache_dir, int(args.cache_max_gb * 1024 ** 3) if args.cache_max_gb else None,
+                             args.dedupe) if args.cache_dir else None
+        throttle = Throttle(int(args.rate_limit * 1048576) if args.rate_limit else None, args.per_host)
+        batch = BatchDownloader(load_batch_jobs(args.batch, args.output_dir), args.state or args.batch + '.state.json',
+                                args.concurrency, args.retries, args.dir, args.transcode, args.quality,
+                                args.max_height, args.max_bandwidth, args.max_active, throttle, cache)
+        try:
+            failed = batch.run()
+        finally:
+            if cache is not None:
+                cache.close()
+        print(f"批量下载结束，失败 {failed} 个任务" if failed else "批量下载全部完成")
+        sys.exit(1 if failed else 0)
+    if not args.url:
+        parser.error('需要 M3U8 文件地址或 --batch')
 
+    main(args.url, args.output, args.concurrency, args.retries, args.dir, args.pipe, args.transcode,
+         args.quality, args.max_height, args.max_bandwidth, args.live, args.duration,
+         args.cache_dir, int(args.cache_max_gb * 1024 ** 3) if args.cache_max_gb else None, args.dedupe)
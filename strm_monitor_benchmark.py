@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+file_to_strm_monitor 性能基准测试
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import builtins
+import resource
+import tempfile
+import threading
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from watchdog.events import FileCreatedEvent
+
+from file_to_strm_monitor import (
+    SyncDatabase, DirectoryMapping, MappingTrie, CloudDriveHandler, scan_existing_files
+)
+from generate_tmp_file import generate_random_filename, generate_random_content
+
+
+def _legacy_record(db_path, source_path, target_path):
+    """旧实现：每条记录单独连接、提交、关闭"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT OR REPLACE INTO synced_files (source_path, target_path) VALUES (?, ?)",
+        (source_path, target_path)
+    )
+    conn.commit()
+    conn.close()
+
+
+def _legacy_is_synced(db_path, source_path):
+    """旧实现：每次查询单独连接"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM synced_files WHERE source_path = ?", (source_path,))
+    result = cursor.fetchone()
+    conn.close()
+    return result is not None
+
+
+def bench_db(rows, batch_size, flush_interval_ms, work_dir):
+    """
+    对比旧的逐条连接写入与SyncDatabase批量写入的吞吐
+
+    Args:
+        rows: 写入的行数
+        batch_size: SyncDatabase批量提交行数
+        flush_interval_ms: SyncDatabase缓冲最长停留时间（毫秒）
+        work_dir: 存放测试数据库的目录
+
+    Returns:
+        dict: 各实现的 rows/sec
+    """
+    paths = [(f"/mnt/cloud/show/{i // 100}/ep{i}.mkv", f"/strm/show/{i // 100}/ep{i}.strm") for i in range(rows)]
+    results = {}
+
+    legacy_db = os.path.join(work_dir, "legacy.db")
+    SyncDatabase(legacy_db, flush_interval_ms=0).close()
+    start = time.perf_counter()
+    for source_path, target_path in paths:
+        if not _legacy_is_synced(legacy_db, source_path):
+            _legacy_record(legacy_db, source_path, target_path)
+    results["legacy"] = rows / (time.perf_counter() - start)
+
+    pooled_db = os.path.join(work_dir, "pooled.db")
+    start = time.perf_counter()
+    db = SyncDatabase(pooled_db, batch_size, flush_interval_ms)
+    for source_path, target_path in paths:
+        if not db.is_file_synced(source_path):
+            db.record_synced_file(source_path, target_path)
+    db.close()
+    results["pooled"] = rows / (time.perf_counter() - start)
+
+    return results
+
+
+def _linear_find(mappings, file_path):
+    """旧实现：线性遍历，返回第一个startswith匹配"""
+    for mapping in mappings:
+        if file_path.startswith(mapping.source_dir):
+            return mapping
+    return None
+
+
+def bench_mapping(mapping_count, path_count, seed=0):
+    """
+    对比线性查找与前缀树查找目录映射的速度
+
+    Args:
+        mapping_count: 映射数量
+        path_count: 查找的路径数量
+        seed: 随机种子
+
+    Returns:
+        dict: 各实现的 lookups/sec，以及两者结果不同的路径数
+    """
+    rng = random.Random(seed)
+    mappings = [DirectoryMapping(f"/mnt/cloud{i // 10}/lib{i}", f"/strm/lib{i}") for i in range(mapping_count)]
+    # 少量嵌套映射和同前缀目录，用于体现最长匹配与边界问题
+    mappings += [DirectoryMapping(f"/mnt/cloud{i}/lib{i * 10}/4K", f"/strm/4k{i}") for i in range(mapping_count // 10)]
+    paths = []
+    for _ in range(path_count):
+        i = rng.randrange(mapping_count)
+        lib = f"/mnt/cloud{i // 10}/lib{i}" + rng.choice(["", "", "", "0", "/4K"])
+        paths.append(f"{lib}/Show {rng.randrange(500)}/Season {rng.randrange(10)}/E{rng.randrange(30)}.mkv")
+
+    results = {}
+    start = time.perf_counter()
+    linear = [_linear_find(mappings, p) for p in paths]
+    results["linear"] = path_count / (time.perf_counter() - start)
+
+    trie = MappingTrie(mappings)
+    start = time.perf_counter()
+    found = [trie.find(p) for p in paths]
+    results["trie"] = path_count / (time.perf_counter() - start)
+
+    results["different"] = sum(1 for a, b in zip(linear, found) if a is not b)
+    return results
+
+
+def build_tree(root, depth, fanout, files_per_dir, video_ratio, file_size=0, seed=0):
+    """
+    生成模拟云盘目录结构：每层fanout个子目录，每个目录files_per_dir个文件
+
+    Args:
+        root: 根目录
+        depth: 子目录层数，0表示只有根目录
+        fanout: 每个目录的子目录数
+        files_per_dir: 每个目录的文件数
+        video_ratio: 视频文件所占比例
+        file_size: 每个文件的大小（字节）
+        seed: 随机种子
+
+    Returns:
+        dict: dirs 目录数, files 文件数, videos 视频文件数, leaves 最深层目录列表
+    """
+    random.seed(seed)
+    stats = {'dirs': 0, 'files': 0, 'videos': 0, 'leaves': []}
+    level = [root]
+    for current_depth in range(depth + 1):
+        next_level = []
+        for dir_path in level:
+            os.makedirs(dir_path, exist_ok=True)
+            stats['dirs'] += 1
+            for _ in range(files_per_dir):
+                is_video = random.random() < video_ratio
+                extension = random.choice(["mkv", "mp4", "ts"] if is_video else ["nfo", "jpg", "txt"])
+                with open(os.path.join(dir_path, generate_random_filename(extension)), 'wb') as f:
+                    f.write(generate_random_content(file_size))
+                stats['files'] += 1
+                stats['videos'] += is_video
+            if current_depth < depth:
+                next_level.extend(os.path.join(dir_path, f"d{i}") for i in range(fanout))
+            else:
+                stats['leaves'].append(dir_path)
+        level = next_level
+    return stats
+
+
+# 统计调用次数的文件系统函数；DirEntry.is_dir/stat使用scandir返回的缓存，不会出现在这里
+_COUNTED_OS_FUNCS = ('scandir', 'listdir', 'stat', 'lstat', 'mkdir', 'replace', 'remove', 'rmdir')
+
+
+@contextlib.contextmanager
+def instrument_fs(listdir_latency=0.0):
+    """
+    统计os层文件系统调用次数，并可给每次列目录注入延迟以模拟FUSE挂载
+
+    只统计当前进程中Python层的调用，多进程写STRM时子进程内的调用不计入。
+
+    Args:
+        listdir_latency: 每次scandir/listdir前的等待秒数
+
+    Yields:
+        dict: 函数名 -> 调用次数
+    """
+    counts = dict.fromkeys(_COUNTED_OS_FUNCS + ('open',), 0)
+    lock = threading.Lock()
+    originals = {name: getattr(os, name) for name in _COUNTED_OS_FUNCS}
+    original_open = builtins.open
+
+    def wrap(name, func):
+        delay = listdir_latency if name in ('scandir', 'listdir') else 0
+
+        def wrapper(*args, **kwargs):
+            with lock:
+                counts[name] += 1
+            if delay:
+                time.sleep(delay)
+            return func(*args, **kwargs)
+        return wrapper
+
+    for name, func in originals.items():
+        setattr(os, name, wrap(name, func))
+    builtins.open = wrap('open', original_open)
+    try:
+        yield counts
+    finally:
+        for name, func in originals.items():
+            setattr(os, name, func)
+        builtins.open = original_open
+
+
+def _peak_rss_mb():
+    """当前进程的峰值RSS（MB），Linux下ru_maxrss单位为KB，macOS为字节"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _run_scan(source, target, db_path, listdir_latency, scan_workers, write_workers):
+    """子进程中执行一次扫描"""
+    mapping = DirectoryMapping(source, target)
+    with instrument_fs(listdir_latency) as counts:
+        start = time.perf_counter()
+        scan_existing_files([mapping], db_path, scan_workers, write_workers=write_workers)
+        elapsed = time.perf_counter() - start
+    return {'elapsed': elapsed, 'calls': counts, 'peak_rss_mb': _peak_rss_mb()}
+
+
+def _run_burst(source, target, db_path, paths, listdir_latency, settle_seconds, event_workers):
+    """子进程中模拟一批watchdog创建事件，等待全部生成STRM"""
+    mapping = DirectoryMapping(source, target)
+    handler = CloudDriveHandler([mapping], db_path)
+    with instrument_fs(listdir_latency) as counts:
+        handler.start_event_queue(settle_seconds, workers=event_workers)
+        start = time.perf_counter()
+        for path in paths:
+            handler.dispatch(FileCreatedEvent(path))
+        while handler.event_queue.stats()['processed'] < len(paths):
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        lag = handler.event_queue.stats()['last_lag']
+        handler.close()
+    return {'elapsed': elapsed, 'last_lag': lag, 'calls': counts, 'peak_rss_mb': _peak_rss_mb()}
+
+
+def _in_subprocess(func, *args):
+    """在新进程中执行，保证每个场景的峰值RSS和缓存状态互不影响"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(func, *args).result()
+
+
+def bench_pipeline(work_dir, depth=3, fanout=8, files_per_dir=20, video_ratio=0.6, file_size=0,
+                   listdir_latency=0.0, scan_workers=4, write_workers=0, burst=1000, settle_seconds=0.2,
+                   event_workers=4, seed=0):
+    """
+    在合成目录树上测量冷扫描、无变化重扫和突发事件三个场景
+
+    Args:
+        work_dir: 存放目录树和数据库的目录，建议使用tmpfs
+        depth/fanout/files_per_dir/video_ratio/file_size: 目录树形状，见build_tree
+        listdir_latency: 每次列目录注入的延迟（秒）
+        scan_workers: 每个映射的并发列目录数
+        write_workers: 写STRM文件的进程数
+        burst: 突发事件场景新建的视频文件数
+        settle_seconds: 事件队列的静默时间
+        event_workers: 处理事件的线程数
+        seed: 随机种子
+
+    Returns:
+        tuple: (目录树统计, {场景: 结果})
+    """
+    source = os.path.join(work_dir, "src")
+    target = os.path.join(work_dir, "strm")
+    db_path = os.path.join(work_dir, "bench.db")
+    tree = build_tree(source, depth, fanout, files_per_dir, video_ratio, file_size, seed)
+
+    results = {}
+    results['cold'] = _in_subprocess(_run_scan, source, target, db_path, listdir_latency, scan_workers,
+                                     write_workers)
+    results['warm'] = _in_subprocess(_run_scan, source, target, db_path, listdir_latency, scan_workers,
+                                     write_workers)
+
+    rng = random.Random(seed)
+    paths = []
+    for i in range(burst):
+        path = os.path.join(rng.choice(tree['leaves']), f"burst{i}.mkv")
+        with open(path, 'wb') as f:
+            f.write(generate_random_content(file_size))
+        paths.append(path)
+    results['burst'] = _in_subprocess(_run_burst, source, target, db_path, paths, listdir_latency,
+                                      settle_seconds, event_workers)
+    return tree, results
+
+
+def _default_work_dir():
+    """优先使用tmpfs，排除磁盘IO的影响"""
+    return '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+
+
+def _format_calls(calls):
+    return ', '.join(f"{name} {count}" for name, count in calls.items() if count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='file_to_strm_monitor 性能基准测试')
+    parser.add_argument('--rows', type=int, default=20000, help='数据库基准写入行数')
+    parser.add_argument('--batch-size', type=int, default=500, help='数据库批量提交的行数')
+    parser.add_argument('--flush-ms', type=int, default=1000, help='数据库写入缓冲最长停留时间（毫秒）')
+    parser.add_argument('--work-dir', help='测试数据存放目录，默认使用临时目录')
+    parser.add_argument('--mappings', type=int, default=100, help='映射查找基准的映射数量')
+    parser.add_argument('--paths', type=int, default=1000000, help='映射查找基准的路径数量')
+    parser.add_argument('--suite', nargs='+', choices=['db', 'mapping', 'pipeline'], default=['db', 'mapping'],
+                        help='要运行的基准，pipeline为合成目录树上的扫描/事件基准')
+    parser.add_argument('--depth', type=int, default=3, help='合成目录树的子目录层数')
+    parser.add_argument('--fanout', type=int, default=8, help='合成目录树每个目录的子目录数')
+    parser.add_argument('--files-per-dir', type=int, default=20, help='合成目录树每个目录的文件数')
+    parser.add_argument('--video-ratio', type=float, default=0.6, help='合成目录树中视频文件的比例')
+    parser.add_argument('--file-size', type=int, default=0, help='合成文件的大小（字节）')
+    parser.add_argument('--listdir-latency-ms', type=float, default=0, help='每次列目录注入的延迟（毫秒），模拟FUSE挂载')
+    parser.add_argument('--scan-workers', type=int, default=4, help='扫描时每个映射的并发列目录数')
+    parser.add_argument('--workers', type=int, default=0, help='扫描时写STRM文件的进程数')
+    parser.add_argument('--burst', type=int, default=1000, help='突发事件场景新建的文件数')
+    parser.add_argument('--settle-seconds', type=float, default=0.2, help='突发事件场景的事件静默时间（秒）')
+    parser.add_argument('--event-workers', type=int, default=4, help='突发事件场景处理事件的线程数')
+    args = parser.parse_args()
+
+    if 'db' in args.suite:
+        with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+            results = bench_db(args.rows, args.batch_size, args.flush_ms, work_dir)
+        print(f"SQLite写入 ({args.rows} 行):")
+        print(f"  逐条连接: {results['legacy']:.0f} rows/sec")
+        print(f"  长连接批量: {results['pooled']:.0f} rows/sec")
+        print(f"  提升: {results['pooled'] / results['legacy']:.1f}x")
+
+    if 'mapping' in args.suite:
+        results = bench_mapping(args.mappings, args.paths)
+        print(f"映射查找 ({args.mappings} 个映射 x {args.paths} 条路径):")
+        print(f"  线性startswith: {results['linear']:.0f} lookups/sec")
+        print(f"  前缀树: {results['trie']:.0f} lookups/sec")
+        print(f"  提升: {results['trie'] / results['linear']:.1f}x, 结果不同(线性实现匹配错误): {results['different']}")
+
+    if 'pipeline' in args.suite:
+        with tempfile.TemporaryDirectory(dir=args.work_dir or _default_work_dir()) as work_dir:
+            tree, results = bench_pipeline(
+                work_dir, args.depth, args.fanout, args.files_per_dir, args.video_ratio, args.file_size,
+                args.listdir_latency_ms / 1000, args.scan_workers, args.workers, args.burst,
+                args.settle_seconds, args.event_workers
+            )
+        print(f"扫描/事件流水线 ({tree['dirs']} 个目录, {tree['files']} 个文件, {tree['videos']} 个视频, "
+              f"列目录延迟 {args.listdir_latency_ms}ms):")
+        for name, label in (('cold', '冷扫描'), ('warm', '无变化重扫')):
+            result = results[name]
+            print(f"  {label}: {result['elapsed']:.2f}s, {tree['files'] / result['elapsed']:.0f} files/sec, "
+                  f"{tree['dirs'] / result['elapsed']:.0f} dirs/sec, 峰值RSS {result['peak_rss_mb']:.1f} MB")
+            print(f"    调用: {_format_calls(result['calls'])}")
+        result = results['burst']
+        print(f"  突发事件 ({args.burst} 个, 静默 {args.settle_seconds}s): {result['elapsed']:.2f}s, "
+              f"{args.burst / result['elapsed']:.0f} events/sec, 最近批次延迟 {result['last_lag']:.2f}s, "
+              f"峰值RSS {result['peak_rss_mb']:.1f} MB")
+        print(f"    调用: {_format_calls(result['calls'])}")
+
+
+if __name__ == "__main__":
+    main()